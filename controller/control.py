@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module starts the controller with a configuration file.
+
+Usage: controller config/cntl_conf
+"""
+
+# taken first, so the startup time includes the imports
+import time
+START = time.time()
+
+import argparse
+import atexit
+import os
+import sys
+from configobj import ConfigObj
+import controller.feeds as feeds
+import controller.monitoring.monitor as mon
+import controller.response.responder as resp
+import controller.utilities.metrics as mt
+import controller.utilities.plan as pl
+import controller.utilities.profiler as prof
+import controller.utilities.registry as reg
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c), UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['control',
+           'main']
+
+
+def control(conf):
+    """
+    This function starts monitoring and controlling experiment as a loop back.
+
+    It initiates the responder as observer, and auditor as observable, and feed that will deliver data.
+    The auditor monitors experiment outcome, and if defined parameter reaches a threshold, it will
+    notify the observer.
+    The responder observer will take an action when it is notified. The action will be typically
+    changing process variable, and will be executed in a separate thread.
+
+    Parameters
+    ----------
+    conf : str
+        name of the configuration file
+
+    Returns
+    -------
+    nothing
+    """
+    if os.path.isfile(conf):
+        config = ConfigObj(conf)
+        try:
+            assert 'bounds' in config
+            assert 'checks' in config
+            assert 'pvs' in config
+            assert 'feed' in config
+            assert 'detector' in config
+        except:
+            print("configuration file must have defined following parameters: "
+                  "'bounds','checks','pvs','feed','detector'")
+            return
+    else:
+        print ('configuration file ' + conf + ' not found')
+        return
+
+    try:
+        plan = pl.compile_plan(config)
+    except Exception as e:
+        print ('invalid bounds or checks configuration', e)
+        return
+
+    cntl = resp.Responder(config, plan)
+    # monitor will start feed
+    monitor = mon.Monitor(config, plan)
+    monitor.register(cntl)
+
+    # profiling is triggered by SIGUSR1, or by /profile request to the metrics server
+    prof.install(prof.Profiler(config.get('profile_dir', '.'),
+                               seconds=float(config.get('profile_seconds', 10)),
+                               interval=float(config.get('profile_interval', 0.005))))
+
+    # allocation tracing per stage, reported at exit and by /memory request to the metrics server
+    if config.get('memory_trace', 'false').lower() == 'true':
+        import controller.utilities.memory as mem
+        memory = mem.enable(int(config['memory_budget']) if 'memory_budget' in config else None)
+        atexit.register(lambda: print (memory.report()))
+
+    if 'metrics_port' in config:
+        mt.start_server(config['metrics_port'])
+
+    # the optional parts are imported when configured
+    if 'record_dir' in config:
+        import controller.recording.recorder as rec
+        recorder = rec.Recorder(config['record_dir'],
+                                policy=config.get('record_policy', 'events'),
+                                every=int(config.get('record_every', 10)),
+                                shard_frames=int(config.get('record_shard_frames', 100)),
+                                format=config.get('record_format', 'npz'))
+        recorder.start()
+        monitor.recorder = recorder
+        cntl.recorder = recorder
+        atexit.register(recorder.stop)
+
+    if 'timeseries_file' in config:
+        import controller.recording.timeseries as ts
+        # a column for every known check, so the checks enabled by reloaded plan are stored too
+        timeseries = ts.TimeSeries(config['timeseries_file'], reg.check_names(),
+                                   int(config.get('timeseries_records', 100000)))
+        monitor.timeseries = timeseries
+        atexit.register(timeseries.flush)
+
+    if 'publish_address' in config:
+        import controller.event.publisher as pub
+        publisher = pub.Publisher(config['publish_address'],
+                                  conflate=config.get('publish_conflate', 'true').lower() == 'true',
+                                  hwm=int(config.get('publish_hwm', 4)),
+                                  queue_size=int(config.get('publish_queue', 8)))
+        publisher.start()
+        monitor.publisher = publisher
+        atexit.register(publisher.stop)
+
+    # the state saved before restart is restored before the first frame
+    if 'snapshot_file' in config:
+        import controller.utilities.snapshot as snap
+        snapshot = snap.Snapshot(config['snapshot_file'], config, monitor, cntl,
+                                 interval=float(config.get('snapshot_interval', 5.0)))
+        snapshot.restore()
+        snapshot.start()
+        atexit.register(snapshot.stop)
+
+    # recompile the plan when bounds or checks files change
+    watcher = pl.PlanWatcher(config, [monitor, cntl], plan)
+    watcher.start()
+
+    # only the configured feed backend is imported, so a feed not using channel access does not load it
+    try:
+        feed = feeds.get_feed(config['feed'])(config, monitor)
+    except ValueError as e:
+        print (e)
+        return
+
+    print ('controller started in %.3f s, channel access loaded: %s' % (time.time() - START,
+                                                                          'epics' in sys.modules))
+    feed.feed_data()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monitor detector frames and control the experiment.')
+    parser.add_argument('conf', nargs='?', default='config/cntl_conf', help='controller configuration file')
+    args = parser.parse_args()
+    control(args.conf)
+
+
+if __name__ == '__main__':
+    main()
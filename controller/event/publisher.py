@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module republishes the frames received by the controller, with their check results, on a ZeroMQ PUB socket,
+so local viewers and loggers do not open their own detector connection.
+
+Each frame is sent as multipart message: topic, JSON header with shape, dtype, counter, acquire time, and check
+results, and the frame buffer. The frame buffer is sent without copy; the frame stays retained until ZeroMQ is done
+with it. The monitor only hands the frame to the publisher thread, which either keeps the latest frame only
+(conflation), or a bounded queue dropping frames when full, so slow subscribers never slow down the monitor.
+"""
+
+import json
+import threading
+import time
+import numpy as np
+import controller.utilities.metrics as mt
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['Publisher',
+           'recv_frame']
+
+
+TOPIC = b'frame'
+
+
+class Publisher(threading.Thread):
+    """
+    This class publishes frames and check results on a ZeroMQ PUB socket in a background thread.
+    """
+
+    def __init__(self, address, conflate=True, hwm=4, queue_size=8):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        address : str
+            address the socket binds to, for example 'ipc:///tmp/controller' or 'tcp://127.0.0.1:5560'
+        conflate : bool
+            if True only the latest frame waits for sending, the older waiting frame is dropped
+        hwm : int
+            ZeroMQ send high water mark, number of messages queued for each subscriber before the socket drops them
+        queue_size : int
+            maximum number of frames waiting for sending, used without conflation
+        """
+        threading.Thread.__init__(self, name='publisher')
+        self.daemon = True
+        if zmq is None:
+            raise ValueError('publishing requires pyzmq')
+        # the ZeroMQ conflate option does not apply to multipart messages, the frames are conflated before sending
+        self.socket = zmq.Context.instance().socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, int(hwm))
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(address)
+        self.conflate = conflate
+        self.queue_size = max(int(queue_size), 1)
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.done = False
+        self.dropped = 0
+        # frames sent without copy, released when ZeroMQ does not reference them anymore
+        self.sending = []
+        mt.QUEUE_DEPTH.labels('publisher').set_function(lambda: len(self.waiting))
+
+
+    def drop(self, data):
+        data.release()
+        self.dropped += 1
+        mt.FRAMES_NOT_PUBLISHED.inc()
+
+
+    def publish(self, data, results):
+        """
+        This function hands the frame and its check results to the publisher thread. It does not block.
+
+        Parameters
+        ----------
+        data : Data
+            data instance that includes slice 2D data
+        results : dict
+            dictionary with check id key and tuple of evaluation and calculated result
+
+        Returns
+        -------
+        nothing
+        """
+        data.retain()
+        with self.cond:
+            if self.conflate:
+                for item in self.waiting:
+                    self.drop(item[0])
+                self.waiting = []
+            elif len(self.waiting) >= self.queue_size:
+                self.drop(data)
+                return
+            self.waiting.append((data, results))
+            self.cond.notify()
+
+
+    def header(self, data, results):
+        return json.dumps({'shape': data.slice.shape,
+                           'dtype': data.slice.dtype.str,
+                           'counter': data.counter,
+                           'timestamp': data.timestamp,
+                           'acq_time': data.acq_time,
+                           'results': {name: [int(results[name][0]), float(results[name][1])] for name in results}
+                           }).encode('utf-8')
+
+
+    def send(self, data, results):
+        # the PUB socket does not block, a message over the high water mark of a subscriber is dropped for it
+        self.socket.send(TOPIC, zmq.SNDMORE)
+        self.socket.send(self.header(data, results), zmq.SNDMORE)
+        tracker = self.socket.send(np.ascontiguousarray(data.slice), copy=False, track=True)
+        self.sending.append((tracker, data))
+
+
+    def release_sent(self):
+        sending = []
+        for tracker, data in self.sending:
+            if tracker.done:
+                data.release()
+            else:
+                sending.append((tracker, data))
+        self.sending = sending
+
+
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.waiting) == 0 and not self.done:
+                    # wake up while frames are being sent, to release them
+                    self.cond.wait(0.01 if len(self.sending) > 0 else None)
+                    self.release_sent()
+                if len(self.waiting) == 0:
+                    break
+                data, results = self.waiting.pop(0)
+            try:
+                self.send(data, results)
+            except Exception as e:
+                print ('publishing frame raises exception', e)
+                self.drop(data)
+            self.release_sent()
+
+        self.socket.close()
+        end = time.time() + 1.0
+        while len(self.sending) > 0 and time.time() < end:
+            time.sleep(0.01)
+            self.release_sent()
+
+
+    def stop(self):
+        """
+        This function sends the waiting frames and stops the publisher thread.
+        """
+        with self.cond:
+            self.done = True
+            self.cond.notify()
+        self.join()
+        if self.dropped > 0:
+            print ('publisher dropped frames', self.dropped)
+
+
+def recv_frame(socket, flags=0):
+    """
+    This function receives a frame published by the Publisher.
+
+    Parameters
+    ----------
+    socket : zmq.Socket
+        SUB socket connected to the publisher address and subscribed to the 'frame' topic
+    flags : int
+        ZeroMQ receive flags
+
+    Returns
+    -------
+    header : dict
+        shape, dtype, counter, timestamp, acquire time, and check results
+    frame : ndarray
+        the frame, a view of the received buffer
+    """
+    topic, header, buffer = socket.recv_multipart(flags, copy=False)
+    header = json.loads(header.bytes.decode('utf-8'))
+    frame = np.frombuffer(buffer.buffer, dtype=header['dtype']).reshape(header['shape'])
+    return header, frame
@@ -2,18 +2,31 @@
 # -*- coding: utf-8 -*-
 
 
+"""
+This module receives frames from ZeroMQ server and passes them to a queue.
+
+The receiver can be load tested on the local host with the controller.event.sender:
+
+Usage: python -m controller.event.receiver --port 5555 --delay 0.001
+"""
+
 from multiprocessing import Queue, Process
+import argparse
+import threading
 import numpy as np
 import zmq
 import time
 import sys
 import json
+import controller.utilities.utils as ut
+import controller.utilities.chunked as chk
 
 __author__ = "Barbara Frosik"
 __copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
 __docformat__ = 'restructuredtext en'
 __all__ = ['zmq_rec.zmq_rec',
            'zmq_rec.destroy',
+           'ReceiveStats',
            'init',
            'receive_zmq_send']
 
@@ -46,6 +59,68 @@ class zmq_rec():
         self.context.destroy()
 
 
+class ReceiveStats(object):
+    """
+    This class holds the receiver statistics: receive rate, lag of the frames, and dropped frames.
+
+    The lag is the time from sending the frame, given by 'image_timestamp' in the header, to receiving it. The
+    dropped frames are the gaps in 'image_number'. The queue depth is the number of received frames waiting for
+    the consuming process.
+    """
+
+    def __init__(self):
+        self.start = None
+        self.received = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.last_number = None
+        self.lag_sum = 0.0
+        self.lag_max = 0.0
+        self.queue_depth = 0
+        self.queue_depth_max = 0
+        self.interval = (time.time(), 0)
+
+
+    def add(self, msg, nbytes, dataq):
+        now = msg['receiving_timestamp']
+        if self.start is None:
+            self.start = now
+            self.interval = (now, 0)
+        self.received += 1
+        self.bytes += nbytes
+        number = msg['image_number']
+        if self.last_number is not None and number > self.last_number + 1:
+            self.dropped += number - self.last_number - 1
+        self.last_number = number
+        if 'image_timestamp' in msg:
+            lag = now - msg['image_timestamp']
+            self.lag_sum += lag
+            self.lag_max = max(self.lag_max, lag)
+        try:
+            self.queue_depth = dataq.qsize()
+        except NotImplementedError:
+            # multiprocessing queue does not implement qsize on some platforms
+            self.queue_depth = 0
+        self.queue_depth_max = max(self.queue_depth_max, self.queue_depth)
+
+
+    def report(self):
+        """
+        This function returns the statistics as string, the rate is given since the last report and overall.
+        """
+        now = time.time()
+        last_time, last_received = self.interval
+        self.interval = (now, self.received)
+        rate = (self.received - last_received) / (now - last_time) if now > last_time else 0.0
+        elapsed = now - self.start if self.start is not None else 0.0
+        return 'received %d, rate %.1f fps (overall %.1f fps, %.1f MB/s), dropped %d, lag mean %.4f s max %.4f s, ' \
+               'queue %d max %d' % \
+               (self.received, rate, self.received / elapsed if elapsed > 0 else 0.0,
+                self.bytes / elapsed / 1.0e6 if elapsed > 0 else 0.0, self.dropped,
+                self.lag_sum / self.received if self.received > 0 else 0.0, self.lag_max, self.queue_depth,
+                self.queue_depth_max)
+
+
 def init(config):
     """
     This function initializes variables according to configuration.
@@ -136,9 +211,11 @@ def init(config):
     return logger, limits, quality_checks, feedback, report_type, consumers, zmq_host, zmq_rcv_port, detector
 
 
-def receive_zmq_send(dataq, zmq_host, zmq_rcv_port):
+def receive_zmq_send(dataq, zmq_host, zmq_rcv_port, stats=None, report_interval=None):
     """
     This function receives data from socket and enqueues it into a queue until the end is detected.
+    The frames are enqueued as Data instances, and None is enqueued at the end. A frame with 'codec' in the header is
+    compressed, it is enqueued as chunked frame, see controller.utilities.chunked.from_header.
     Parameters
     ----------
     dataq : Queue
@@ -147,6 +224,10 @@ def receive_zmq_send(dataq, zmq_host, zmq_rcv_port):
         ZeroMQ server host name
     zmq_rcv_port : str
         ZeroMQ port
+    stats : ReceiveStats
+        if given, it is updated with each received frame
+    report_interval : float
+        if given, the statistics are printed in this interval in seconds
     Returns
     -------
     none
@@ -154,13 +235,15 @@ def receive_zmq_send(dataq, zmq_host, zmq_rcv_port):
 
     conn = zmq_rec(zmq_host, zmq_rcv_port)
     socket = conn.socket
+    if report_interval is not None and stats is None:
+        stats = ReceiveStats()
+    next_report = None
     interrupted = False
     while not interrupted:
         msg = socket.recv_json()
         key = msg.get("key")
         if key == "end":
-            data = containers.Data(const.DATA_STATUS_END)
-            dataq.put(data)
+            dataq.put(None)
             interrupted = True
             conn.destroy()
         elif key == "image":
@@ -171,12 +254,23 @@ def receive_zmq_send(dataq, zmq_host, zmq_rcv_port):
             #image_timestamp = msg['image_timestamp']
             theta = msg['rotation']
 
-            image = np.frombuffer(socket.recv(), dtype=dtype).reshape(shape)
-
-            data = containers.Data(const.DATA_STATUS_DATA, image, 'data')
-            data.theta = theta
-            data.image_number = image_number
+            buffer = socket.recv()
+            if 'codec' in msg:
+                data = ut.Data(None, {'rotation': ('rotation', theta)}, counter=image_number,
+                               timestamp=msg["receiving_timestamp"], chunked=chk.from_header(msg, buffer))
+            else:
+                image = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+                data = ut.Data(image, {'rotation': ('rotation', theta)}, counter=image_number,
+                               timestamp=msg["receiving_timestamp"])
             dataq.put(data)
+            if stats is not None:
+                stats.add(msg, len(buffer), dataq)
+                if report_interval is not None:
+                    if next_report is None:
+                        next_report = msg["receiving_timestamp"] + report_interval
+                    elif msg["receiving_timestamp"] >= next_report:
+                        next_report += report_interval
+                        print (stats.report())
 
 
 def verify(config):
@@ -206,4 +300,37 @@ def verify(config):
     p = Process(target=handler.handle_data, args=(dataq, limits, None, quality_checks, None, consumers, feedback_obj))
     p.start()
 
-    receive_zmq_send(dataq, zmq_host, zmq_rcv_port)
\ No newline at end of file
+    receive_zmq_send(dataq, zmq_host, zmq_rcv_port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Receive frames from ZeroMQ server and report the receive rate.')
+    parser.add_argument('--host', default='127.0.0.1', help='server host')
+    parser.add_argument('--port', type=int, default=5555, help='server port')
+    parser.add_argument('--delay', type=float, default=0.0, help='processing time per frame of the consumer')
+    parser.add_argument('--queue', type=int, default=0, help='maximum frames waiting for the consumer, 0 unbounded')
+    parser.add_argument('--report', type=float, default=1.0, help='report interval in seconds')
+    args = parser.parse_args()
+
+    if sys.version[0] == '2':
+        import Queue as tqueue
+    else:
+        import queue as tqueue
+    # the consumer is a thread simulating processing time, the queue fills when it does not keep up
+    dataq = tqueue.Queue(maxsize=args.queue)
+
+    def consume():
+        while dataq.get() is not None:
+            if args.delay > 0:
+                time.sleep(args.delay)
+
+    consumer = threading.Thread(target=consume, name='consumer')
+    consumer.start()
+    stats = ReceiveStats()
+    receive_zmq_send(dataq, args.host, args.port, stats, args.report)
+    consumer.join()
+    print (stats.report())
+
+
+if __name__ == '__main__':
+    main()
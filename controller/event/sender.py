@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module sends synthetic frames over ZeroMQ with the protocol of the receiver, to load test the receiver on the
+local host.
+
+Each frame is sent as JSON header with 'key', 'dtype', 'shape', 'image_number', 'rotation', and 'image_timestamp',
+followed by the raw frame buffer. With codec, the frame is compressed and the header has the codec fields of
+controller.utilities.chunked.compress. The stream ends with header with 'key' 'end'.
+
+Usage: python -m controller.event.sender --port 5555 --shape 1024 1024 --rate 100 --frames 1000 --codec bslz4
+"""
+
+import argparse
+import time
+import numpy as np
+import zmq
+import controller.utilities.chunked as chk
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['send_frames']
+
+
+def send_frames(port, shape=(512, 512), dtype='uint16', rate=None, no_frames=1000, drop=False, hwm=10, variants=8,
+                codec=None):
+    """
+    This function binds PAIR socket on the local host and sends synthetic frames to the receiver.
+
+    Parameters
+    ----------
+    port : int
+        local port the receiver connects to
+    shape : tuple
+        frame shape
+    dtype : str
+        frame data type
+    rate : float
+        target frames per second, as fast as possible if None
+    no_frames : int
+        number of frames to send
+    drop : bool
+        if True a frame is dropped when the receiver does not keep up, otherwise the sender waits
+    hwm : int
+        number of messages queued for the receiver
+    variants : int
+        number of distinct random frames sent in turns, so generating frames does not limit the rate
+    codec : str
+        'bslz4' or 'lz4' to send compressed frames, or None
+
+    Returns
+    -------
+    stats : dict
+        frames sent and dropped, elapsed time, achieved frame rate and bytes rate
+    """
+    context = zmq.Context()
+    socket = context.socket(zmq.PAIR)
+    socket.setsockopt(zmq.SNDHWM, hwm)
+    socket.bind('tcp://127.0.0.1:%d' % port)
+    flags = zmq.NOBLOCK if drop else 0
+
+    rng = np.random.default_rng()
+    frames = [rng.integers(0, 1000, shape).astype(dtype) for i in range(variants)]
+    # the frames are compressed once, the buffer and header codec fields of each frame
+    compressed = [chk.compress(frame, codec) for frame in frames] if codec is not None else None
+    period = 1.0 / rate if rate else 0.0
+    sent = 0
+    dropped = 0
+    start = None
+    for i in range(no_frames):
+        frame = frames[i % variants]
+        header = {'key': 'image', 'dtype': frame.dtype.str, 'shape': frame.shape, 'image_number': i,
+                  'rotation': 0.1 * i, 'image_timestamp': time.time()}
+        if compressed is not None:
+            frame, fields = compressed[i % variants]
+            header.update(fields)
+        # the first frame waits for the receiver to connect
+        send_flags = flags if sent > 0 else 0
+        try:
+            # a multipart message is queued whole, if the header is accepted so is the frame
+            socket.send_json(header, send_flags | zmq.SNDMORE)
+            socket.send(frame, send_flags, copy=False)
+            sent += 1
+        except zmq.Again:
+            dropped += 1
+        if start is None:
+            start = time.time()
+        if period > 0:
+            wait = start + (i + 1) * period - time.time()
+            if wait > 0:
+                time.sleep(wait)
+    elapsed = time.time() - start if start is not None else 0
+    socket.send_json({'key': 'end'})
+    socket.close(linger=-1)
+    context.term()
+
+    nbytes = len(compressed[0][0]) if compressed is not None else frames[0].nbytes
+    return {'sent': sent,
+            'dropped': dropped,
+            'elapsed': elapsed,
+            'frame_rate': sent / elapsed if elapsed > 0 else None,
+            'MB_rate': sent * nbytes / elapsed / 1.0e6 if elapsed > 0 else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send synthetic frames to the ZeroMQ receiver.')
+    parser.add_argument('--port', type=int, default=5555, help='local port')
+    parser.add_argument('--shape', type=int, nargs=2, default=(512, 512), help='frame rows and columns')
+    parser.add_argument('--dtype', default='uint16', help='frame data type')
+    parser.add_argument('--rate', type=float, default=None, help='frames per second, as fast as possible if not set')
+    parser.add_argument('--frames', type=int, default=1000, help='number of frames')
+    parser.add_argument('--drop', action='store_true', help='drop frames when the receiver does not keep up')
+    parser.add_argument('--hwm', type=int, default=10, help='messages queued for the receiver')
+    parser.add_argument('--codec', default=None, help='bslz4 or lz4 to send compressed frames')
+    args = parser.parse_args()
+
+    results = send_frames(args.port, tuple(args.shape), args.dtype, args.rate, args.frames, args.drop, args.hwm,
+                          codec=args.codec)
+    for key in results:
+        print (key, results[key])
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,73 @@
 __author__ = 'bfrosik'
+
+import importlib
+
+
+# maps the feed name used in configuration to the module implementing Feed; the module is imported when the feed
+# is used, so the libraries of other feeds, such as channel access, are not loaded
+FEEDS = {
+         'pv': 'controller.feeds.pv_feed',
+         'pva': 'controller.feeds.pva_feed',
+        }
+
+
+class FeedStats(object):
+    """
+    This class holds the feed statistics of missing frames and failed reads, and the frame shape, reported by the
+    feeds to the consumer with each feed event.
+    """
+
+    def __init__(self):
+        # number of counter gaps, and the frames missed in the gaps
+        self.gaps = 0
+        self.missing = 0
+        self.max_gap = 0
+        # number of times the feed skipped queued counters to read the latest frame, and frames skipped;
+        # the skipped frames are included in missing
+        self.resyncs = 0
+        self.skipped = 0
+        # image reads that were retried, and reads that failed after all retries
+        self.retries = 0
+        self.failed = 0
+        self.delivered = 0
+        # current frame shape and data type, and number of times the shape changed
+        self.shape = None
+        self.dtype = None
+        self.shape_changes = 0
+        # frames dropped because the frame shape changed while the frame was read
+        self.shape_drops = 0
+
+
+    def add_gap(self, length):
+        self.gaps += 1
+        self.missing += length
+        if length > self.max_gap:
+            self.max_gap = length
+
+
+    def __str__(self):
+        return 'gaps %d, missing %d, max gap %d, resyncs %d, skipped %d, retries %d, failed %d, delivered %d, ' \
+               'shape %s, shape changes %d, shape drops %d' % \
+               (self.gaps, self.missing, self.max_gap, self.resyncs, self.skipped, self.retries, self.failed,
+                self.delivered, self.shape, self.shape_changes, self.shape_drops)
+
+
+def get_feed(name):
+    """
+    This function imports the feed module for the feed name and returns its Feed class.
+
+    Parameters
+    ----------
+    name : str
+        feed name, as configured in 'feed'
+
+    Returns
+    -------
+    Feed : class
+        the feed class
+    """
+    try:
+        module = FEEDS[name]
+    except KeyError:
+        raise ValueError('feed ' + name + ' is not defined, available feeds: ' + ', '.join(sorted(FEEDS)))
+    return importlib.import_module(module).Feed
@@ -13,8 +13,12 @@ from epics.ca import CAThread
 import numpy as np
 import json
 import sys
+import threading
 import time
 import controller.utilities.utils as ut
+import controller.utilities.metrics as mt
+import controller.utilities.memory as mem
+from controller.feeds import FeedStats
 
 
 if sys.version[0] == '2':
@@ -25,9 +29,11 @@ else:
 __author__ = "Barbara Frosik"
 __copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
 __docformat__ = 'restructuredtext en'
-__all__ = ['handle_event',
+__all__ = ['FeedStats',
+           'handle_event',
            'on_change',
            'start_processes',
+           'connect',
            'get_pvs',
            'feed_data']
 
@@ -46,47 +52,237 @@ class Feed(object):
         self.detector = config['detector']
         with open(config['pvs']) as file:
             self.pvs = json.loads(file.read())
-        self.sizex = 0
-        self.sizey = 0
+        # timeout of a single image read, and number of times a failed read is repeated
+        self.read_timeout = float(config.get('read_timeout', 1.0))
+        self.read_retries = int(config.get('read_retries', 2))
+        # number of check stage threads, and number of frames waiting for the check stage
+        self.check_workers = int(config.get('check_workers', 1))
+        self.dataq = tqueue.Queue(maxsize=int(config.get('pipeline_depth', 2 * self.check_workers)))
+        # maximum number of queued frames a check stage thread evaluates in one batch
+        self.batch_size = int(config.get('batch_size', 1))
+        self.workers = []
+        # frames are read into buffers from the pool, the pool is created when the first frame is read
+        self.pool = None
+        self.pool_size = int(config.get('frame_pool', self.dataq.maxsize + self.check_workers + 2))
+        # frame shape (rows, columns), updated by the monitors on the array size PVs
+        self.shape = (0, 0)
         self.index = 0
         self.current_counter = None
+        self.stats = FeedStats()
+        # seconds to wait for the PVs to connect
+        self.connect_timeout = float(config.get('connect_timeout', 5.0))
+        self.acquiring = threading.Event()
+        self.acq_start = None
+        self.first_frame = True
+        mt.QUEUE_DEPTH.labels('feed').set_function(self.eventq.qsize)
+        mt.QUEUE_DEPTH.labels('check').set_function(self.dataq.qsize)
 
 
     def event(self, event_str):
-        # we will find out later how to handle the events
-        pass
+        """
+        This function reports feed event together with the feed statistics to the consuming process.
+        """
+        print ('feed event:', event_str, '(' + str(self.stats) + ')')
+        try:
+            self.app.feed_event(event_str, self.stats)
+        except AttributeError:
+            pass
 
 
     def deliver_data(self, data):
-        # process data in the same thread as the callback
-        self.app.process_data(data)
+        # pass data to the check stage; if the check stage is busy, wait, while the counters queue up and the
+        # fetch stage skips to the latest when it resumes
+        self.dataq.put(data)
 
 
-    def handle_event(self):
+    def check_stage(self):
         """
-        This function receives data, processes it, and delivers to consuming process.
-
-        This function is invoked at the beginning of the feed as a distinct thread. It reads data from a thread_dataq
-        inside a loop that delivers current counter value on change.
-        If the counter is not a consecutive number to the previous reading a 'missing' string is enqueued into
-        process_dataq in place of the data to mark the missing frames.
-        For every received frame data, it reads a data type from PV, and the two elements are delivered to a consuming
-        process via process_dataq as Data instance. If a sequence is defined, then the data type for this frame
-        determined from sequence is compared with the data type read from PV. If they are different, a warning log is
-        recorded.
-        On the loop exit an 'all_data' string is enqueud into the inter-process queue, and 'exit' string is enqueued
-        into the inter-thread queue, to notify the main thread of the exit event.
+        This function runs in a check stage thread. It dequeues the fetched data and delivers it to the consuming
+        process until None is dequeued.
+
+        With more than one check stage thread the frames may be processed out of order.
+        If frames queue up and the consuming process has 'process_batch' function, up to 'batch_size' waiting frames
+        are taken at once and evaluated in one batch, so the backlog drains faster.
+        """
+        batched = self.batch_size > 1 and hasattr(self.app, 'process_batch')
+        stop = False
+        while not stop:
+            batch = [self.dataq.get()]
+            while batched and batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.dataq.get_nowait())
+                except tqueue.Empty:
+                    break
+            if batch[-1] is None:
+                stop = True
+                batch.pop()
+            if len(batch) == 0:
+                continue
+            try:
+                if len(batch) == 1:
+                    self.app.process_data(batch[0])
+                else:
+                    self.app.process_batch(batch)
+            except Exception as e:
+                self.event('processing data raises exception ' + str(e))
+            finally:
+                for data in batch:
+                    data.release()
+
+
+    def latest_counter(self, current_ctr):
+        """
+        This function removes all counters waiting in the event queue and returns the latest one.
+
+        The image PV holds only the latest frame, so the frames for the older counters cannot be read anymore.
+        If the 'finish' is found in the queue, it is put back, so the feed exits after the latest frame.
+        """
+        finish = False
+        skipped = 0
+        while True:
+            try:
+                item = self.eventq.get_nowait()
+            except tqueue.Empty:
+                break
+            if item == 'finish':
+                finish = True
+            else:
+                current_ctr = item
+                skipped += 1
+        if skipped > 0:
+            self.stats.resyncs += 1
+            self.stats.skipped += skipped
+        if finish:
+            self.eventq.put('finish')
+        return current_ctr
+
+
+    def read_frame(self, shape):
+        """
+        This function reads the image, repeating the read if it times out or fails.
+
+        Parameters
+        ----------
+        shape : tuple
+            the frame shape
+
+        Returns
+        -------
+        slice : ndarray
+            the image as flat array, or None if all reads failed
+        """
+        for attempt in range(self.read_retries + 1):
+            try:
+                slice = caget(self.get_data_pv_name(), count=shape[0] * shape[1], timeout=self.read_timeout)
+                if slice is not None:
+                    return slice
+            except Exception as e:
+                print ('reading image raises exception', e)
+            if attempt < self.read_retries:
+                self.stats.retries += 1
+        self.stats.failed += 1
+        return None
+
+
+    def read_shape(self):
+        """
+        This function reads both array size PVs and returns the frame shape (rows, columns), or None if a read failed.
+        """
+        rows = caget(self.get_sizey_pv_name(), timeout=self.read_timeout)
+        columns = caget(self.get_sizex_pv_name(), timeout=self.read_timeout)
+        if rows is None or columns is None:
+            return None
+        return (int(rows), int(columns))
+
+
+    def fetch(self, counter):
+        """
+        This function reads the image into a buffer from the frame pool, and reads the other PVs.
+
+        The frame shape is taken from the array size monitors. The two sizes are posted by separate monitors, so the
+        monitored shape may combine the old and the new size. Both sizes are read again after the image, and if they
+        do not match the shape the image was read with, the frame is dropped and the shape is replaced by the read
+        one for the next frame. When the frame shape differs from the pool shape, a new pool is created and the
+        shape change is reported; the frames of the old shape still in processing are released to the old pool.
 
         Parameters
         ----------
-        data_pv : str
-            a PV string for the area detector data
+        counter : int
+            the frame counter
+
+        Returns
+        -------
+        data : Data
+            Data instance acquired from the pool, or None if the frame could not be read
+        """
+        shape = self.shape
+        with mem.stage('feed read'):
+            slice = self.read_frame(shape)
+        if slice is None:
+            self.event('reading image failed, possibly the detector exposure time is too small')
+            return None
+        read_shape = self.read_shape()
+        if read_shape is None:
+            self.stats.failed += 1
+            self.event('reading array size failed')
+            return None
+        if read_shape != shape:
+            self.shape = read_shape
+            self.stats.shape_drops += 1
+            self.event('frame shape changed to %d x %d while image %d x %d was read' %
+                       (read_shape[1], read_shape[0], shape[1], shape[0]))
+            return None
+        if slice.size != shape[0] * shape[1]:
+            self.stats.failed += 1
+            self.event('image size %d does not match %d x %d' % (slice.size, shape[1], shape[0]))
+            return None
+        if self.pool is None or self.pool.dtype != slice.dtype or self.pool.shape != shape:
+            self.pool = ut.FramePool(shape, slice.dtype, self.pool_size)
+            if self.stats.shape != shape:
+                if self.stats.shape is not None:
+                    self.stats.shape_changes += 1
+                self.stats.shape = shape
+                self.stats.dtype = slice.dtype
+                # reported before the first frame of the new shape is delivered, so the consumer can prepare
+                self.event('frame shape %d x %d' % (shape[1], shape[0]))
+
+        data = self.pool.acquire()
+        try:
+            with mem.stage('frame data'):
+                np.copyto(data.slice.reshape(-1), slice)
+                data.counter = counter
+                data.timestamp = time.time()
+                # read other pvs, the pvs dictionary of a pooled instance is reused
+                for pv in self.pvs:
+                    data.pvs[pv] = (self.pvs[pv], caget(self.pvs[pv], timeout=self.read_timeout))
+                data.set_pvs(data.pvs)
+        except Exception as e:
+            data.release()
+            self.stats.failed += 1
+            self.event('reading pvs raises exception ' + str(e))
+            return None
+        return data
 
-        frame_type_pv : str
-            a PV string for the area detector data type
 
-        logger : Logger
-            a Logger instance, typically synchronized with the consuming process logger
+    def handle_event(self):
+        """
+        This function is the fetch stage, it receives data and delivers it to the check stage.
+
+        This function is invoked at the beginning of the feed as a distinct thread. It reads counter values from
+        the event queue, that are enqueued on the counter change.
+        If the processing is slower than the detector, the counters accumulate in the queue. The feed then skips to
+        the latest counter, as only the latest frame can be read. If the counter is not a consecutive number to the
+        previous reading, the gap is counted in the feed statistics and reported by 'missing frames' event.
+        For every counter the image and the other PVs are read, and delivered to the check stage as Data
+        instance. The check stage threads run the consuming process, so reading the next frame overlaps with
+        processing the previous one. If the image cannot be read after the configured retries, the frame is counted
+        as missing and the feed continues with the next counter.
+        The loop exits when 'finish' is dequeued, the check stage threads are stopped after they process the
+        remaining data.
+
+        Parameters
+        ----------
+        none
 
         Returns
         -------
@@ -100,43 +296,43 @@ class Feed(object):
                     print ('done')
                     self.done = True
                 else:
-                    current_ctr = callback_item
+                    current_ctr = self.latest_counter(callback_item)
                     if current_ctr > self.current_counter + 1:
+                        missing = current_ctr - self.current_counter - 1
+                        self.stats.add_gap(missing)
+                        mt.MISSING_FRAMES.inc(missing)
                         self.event('missing frames')
-                    self.current_counter = current_ctr + 1
-
-                    try:
-                        print ('current cntr', self.current_counter)
-                        pv_pairs = {}
-                        slice = np.array(caget(self.get_data_pv_name()))
-                        print ('pvname', self.get_data_pv_name())
-                        # read other pvs
-                        for pv in self.pvs:
-                            pv_pairs[pv] = (self.pvs[pv], caget(self.pvs[pv]))
-                        print ('pv pairs', pv_pairs)
-                        if slice is None:
-                            self.done = True
-                            self.event('reading image times out, possibly the detector exposure time is too small')
-                        else:
-                            slice.resize(self.sizex, self.sizey)
-                            data = ut.Data(slice, pv_pairs)
-                            # deliver data to monitor
-                            self.deliver_data(data)
-                    except:
-                        self.done = True
-                        self.event('reading image raises exception, possibly the detector exposure time is too small')
+                    self.current_counter = current_ctr
+
+                    print ('current cntr', self.current_counter)
+                    data = self.fetch(current_ctr)
+                    if data is None:
+                        mt.FRAMES_DROPPED.inc()
+                        continue
+                    mt.FRAMES_RECEIVED.inc()
+                    # deliver data to check stage
+                    self.deliver_data(data)
+                    self.stats.delivered += 1
+                    if self.first_frame:
+                        self.first_frame = False
+                        print ('time to first frame %.3f s' % (time.time() - self.acq_start))
             except tqueue.Empty:
                 continue
 
+        for worker in self.workers:
+            self.dataq.put(None)
+        for worker in self.workers:
+            worker.join()
         self.finish()
 
 
-    def acq_done(self, pvname=None, **kws):
+    def on_acquire(self, pvname=None, **kws):
         """
-        A callback method that activates when pv acquire switches to off.
+        A callback method that activates when pv acquire changes.
 
-        If the value is 0, the function enqueues key word 'finish' into event queue that will be dequeued by the
-        'handle_event' function.
+        If the value is 1, the function signals the feed_data function waiting for the acquisition to start.
+        If the value is 0 after the acquisition started, the function enqueues key word 'finish' into event queue
+        that will be dequeued by the 'handle_event' function.
 
         Parameters
         ----------
@@ -147,7 +343,11 @@ class Feed(object):
         -------
         None
         """
-        if kws['value'] == 0:
+        if kws['value'] == 1:
+            if not self.acquiring.is_set():
+                self.acq_start = time.time()
+                self.acquiring.set()
+        elif kws['value'] == 0 and self.acquiring.is_set():
             self.eventq.put('finish')
 
 
@@ -176,13 +376,35 @@ class Feed(object):
         self.eventq.put(current_ctr)
 
 
+    def on_size(self, pvname=None, **kws):
+        """
+        A callback method that activates when an array size PV changes, for example when the detector ROI or
+        binning changes.
+
+        The frame shape is replaced as a whole tuple. The other size may not be posted yet, the fetch stage verifies
+        the shape by reading both sizes after the image.
+
+        Parameters
+        ----------
+        pvname : str
+            a PV string for the array size
+
+        Returns
+        -------
+        None
+        """
+        if pvname == self.get_sizex_pv_name():
+            self.shape = (self.shape[0], int(kws['value']))
+        else:
+            self.shape = (int(kws['value']), self.shape[1])
+
+
     def start_processes(self):
         """
-        This function starts processes and callbacks.
+        This function starts processes.
 
-        This is a main thread that starts thread reacting to the callback, starts the consuming process, and sets a
-        callback on the frame counter PV change. The function then awaits for the data in the exit queue that indicates
-        that all frames have been processed. The functin cancells the callback on exit.
+        This is a main thread that starts the check stage threads and the fetch stage thread reacting to the frame
+        counter callback. The counters enqueued by the callback before the threads started are processed first.
 
         Parameters
         ----------
@@ -192,14 +414,13 @@ class Feed(object):
         -------
         nothing
         """
-        data_thread = CAThread(target=self.handle_event, args=())
-        data_thread.start()
+        for i in range(self.check_workers):
+            worker = CAThread(target=self.check_stage, args=(), name='check-%d' % i)
+            worker.start()
+            self.workers.append(worker)
 
-        self.counter_pv = PV(self.get_counter_pv_name())
-        self.counter_pv.add_callback(self.on_change, index=1)
-
-        self.acq_pv = PV(self.get_acquire_pv_name())
-        self.acq_pv.add_callback(self.acq_done, index=2)
+        data_thread = CAThread(target=self.handle_event, args=(), name='fetch')
+        data_thread.start()
 
 
     def get_acquire_pv_name(self):
@@ -214,12 +435,44 @@ class Feed(object):
         return self.detector + ':image1:ArrayData'
 
 
+    def get_sizex_pv_name(self):
+        return self.detector + ':image1:ArraySize0_RBV'
+
+
+    def get_sizey_pv_name(self):
+        return self.detector + ':image1:ArraySize1_RBV'
+
+
+    def connect(self):
+        """
+        This function connects the detector PVs, and the other PVs, that include the PVs written by the adjusters.
+
+        All PVs are created first and connect concurrently, so the connection takes as long as the slowest PV. The
+        connected PVs are kept by pyepics, and the later reads reuse the connections. The PVs that did not connect
+        within the timeout are reported.
+
+        Returns
+        -------
+        nothing
+        """
+        start = time.time()
+        names = [self.get_acquire_pv_name(), self.get_counter_pv_name(), self.get_data_pv_name(),
+                 self.get_sizex_pv_name(), self.get_sizey_pv_name()] + [self.pvs[pv] for pv in self.pvs]
+        pvs = [PV(name) for name in names]
+        self.acq_pv, self.counter_pv, self.sizex_pv, self.sizey_pv = pvs[0], pvs[1], pvs[3], pvs[4]
+        end = start + self.connect_timeout
+        not_connected = [pv.pvname for pv in pvs if not pv.wait_for_connection(timeout=max(end - time.time(), 0))]
+        print ('time to connect %d pvs %.3f s' % (len(pvs), time.time() - start))
+        if len(not_connected) > 0:
+            print ('pvs not connected', not_connected)
+
+
     def feed_data(self):
         """
         This function is called by a client to start the process.
 
-        After all initial settings are completed, the method awaits for the area detector to start acquireing by polling
-        the PV. When the area detective is active it starts processing.
+        After all PVs are connected, the method awaits for the area detector to start acquiring, signalled by the
+        monitor on the acquire PV. When the area detector is active it starts processing.
 
         Parameters
         ----------
@@ -229,26 +482,21 @@ class Feed(object):
         -------
         nothing
         """
-        test = True
-
-        sizex_pv = self.detector + ':image1:ArraySize0_RBV'
-        sizey_pv = self.detector + ':image1:ArraySize1_RBV'
-        acquire_pv_name = self.get_acquire_pv_name()
-        while test:
-            self.sizex = caget(sizex_pv)
-            self.sizey = caget(sizey_pv)
-            ack = caget(acquire_pv_name)
-            if ack == 1:
-                test = False
-                self.start_processes()
-            else:
-                time.sleep(.005)
+        self.connect()
+        # the counter callback is set before the acquisition starts, so the first frame is not missed
+        self.counter_pv.add_callback(self.on_change, index=1)
+        self.acq_pv.add_callback(self.on_acquire, index=2)
+        # the monitor posts changes, the acquisition may already run
+        if self.acq_pv.get() == 1:
+            self.on_acquire(pvname=self.acq_pv.pvname, value=1)
+        while not self.acquiring.wait(1.0):
+            pass
 
-        # # start the infinit loop so the feed does not stop after this init
-        # if True:
-        #     time.sleep(10)
-        #
-        return caget(acquire_pv_name)
+        self.sizex_pv.add_callback(self.on_size, index=3)
+        self.sizey_pv.add_callback(self.on_size, index=3)
+        self.shape = (int(self.sizey_pv.get()), int(self.sizex_pv.get()))
+        self.start_processes()
+        return self.acq_pv.get()
 
 
     def finish(self):
@@ -260,5 +508,10 @@ class Feed(object):
             self.acq_pv.disconnect()
         except:
             pass
+        for pv in (self.sizex_pv, self.sizey_pv):
+            try:
+                pv.disconnect()
+            except:
+                pass
 
 
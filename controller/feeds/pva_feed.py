@@ -53,6 +53,10 @@ This module feeds the data coming from detector.
 """
 
 import controller.utilities.utils as ut
+import controller.utilities.metrics as mt
+import controller.utilities.memory as mem
+import controller.utilities.chunked as chk
+from controller.feeds import FeedStats
 import json
 import time
 import pvaccess
@@ -66,6 +70,10 @@ __all__ = ['start_feed',
            'on_change']
 
 
+# numpy type of the NDDataType_t code of uncompressed frame, given by the codec parameters
+ND_DTYPES = ['int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'int64', 'uint64', 'float32', 'float64']
+
+
 class Feed(object):
     """
     This class reads frames in a real time, and delivers to consumers.
@@ -82,6 +90,20 @@ class Feed(object):
         with open(config['pvs']) as file:
             self.pvs = json.loads(file.read())
         self.chan = None
+        self.dims = None
+        self.last_id = None
+        self.stats = FeedStats()
+
+
+    def event(self, event_str):
+        """
+        This function reports feed event together with the feed statistics to the consuming process.
+        """
+        print ('feed event:', event_str, '(' + str(self.stats) + ')')
+        try:
+            self.app.feed_event(event_str, self.stats)
+        except AttributeError:
+            pass
 
 
     def deliver_data(self, data):
@@ -92,18 +114,53 @@ class Feed(object):
     def on_change(self, v):
         uniqueId = v['uniqueId']
         print('uniqueId: ', uniqueId)
-
-        img = v['value'][0]['ushortValue']
-        slice = img.reshape(self.dims)
-
-        #acq_time = v["attribute"][self.ack_time]["value"][0]["value"]
-        pv_pairs = {}
-        for pv in self.pvs:
-            pv_pairs[pv] = (self.pvs[pv], v["attribute"][self.pvs[pv]]["value"][0]["value"])
-
-        data = ut.Data(slice, pv_pairs)
-        #data = ut.Data(slice, ack_time=acq_time)
-
+        mt.FRAMES_RECEIVED.inc()
+        if self.last_id is not None and uniqueId > self.last_id + 1:
+            mt.MISSING_FRAMES.inc(uniqueId - self.last_id - 1)
+            self.stats.add_gap(uniqueId - self.last_id - 1)
+        self.last_id = uniqueId
+
+        codec = v['codec']['name']
+        # the uncompressed frame is read as unsigned short array, the data type of compressed frame is given by the
+        # codec parameters
+        dtype = 'uint16' if codec == '' else ND_DTYPES[list(v['codec']['parameters'][0].values())[0]]
+        # the dimensions are sent with every array, so ROI or binning changes apply from the first changed frame
+        self.dims = tuple(d['size'] for d in reversed(v['dimension']))
+        if self.stats.shape != self.dims:
+            if self.stats.shape is not None:
+                self.stats.shape_changes += 1
+            self.stats.shape = self.dims
+            self.stats.dtype = dtype
+            # reported before the first frame of the new shape is delivered, so the consumer can prepare
+            self.event('frame shape %d x %d' % (self.dims[1], self.dims[0]))
+        with mem.stage('frame data'):
+            #acq_time = v["attribute"][self.ack_time]["value"][0]["value"]
+            pv_pairs = {}
+            for pv in self.pvs:
+                pv_pairs[pv] = (self.pvs[pv], v["attribute"][self.pvs[pv]]["value"][0]["value"])
+
+            if codec == '':
+                img = v['value'][0]['ushortValue']
+                slice = img.reshape(self.dims)
+                # the slice is a view of the received array, so the frame is not copied into a pool buffer
+                data = ut.Data(slice, pv_pairs, counter=uniqueId, timestamp=time.time())
+            else:
+                # the compressed frame is decompressed chunk by chunk by the checks
+                buffer = v['value'][0]['ubyteValue']
+                try:
+                    if codec == 'bslz4':
+                        chunked = chk.from_bslz4(buffer, self.dims, dtype)
+                    elif codec == 'lz4':
+                        # the frame is one LZ4 block, decompressed as one chunk
+                        chunked = chk.from_lz4(buffer, [len(buffer)], self.dims[0] * self.dims[1], self.dims, dtype)
+                    else:
+                        raise ValueError('codec ' + codec + ' is not supported')
+                except ValueError as e:
+                    print ('frame', uniqueId, 'not processed:', e)
+                    return
+                data = ut.Data(None, pv_pairs, counter=uniqueId, timestamp=time.time(), chunked=chunked)
+
+        self.stats.delivered += 1
         self.deliver_data(data)
 
 
@@ -125,7 +182,7 @@ class Feed(object):
         self.ack_time = labels.index("AckTime")
 
         self.chan.subscribe('update', self.on_change)
-        self.chan.startMonitor("value,attribute,uniqueId")
+        self.chan.startMonitor("value,dimension,attribute,uniqueId,codec")
 
         # start the infinit loop so the feed does not stop after this init
         if True:
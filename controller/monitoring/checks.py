@@ -4,16 +4,28 @@
 """
 This file is a suite of verification functions for scientific data.
 """
+import time
+import numpy as np
 import controller.utilities.utils as ut
+import controller.utilities.metrics as mt
+from controller.monitoring.masks import masked_sum, masked_count_over, masked_sum_batch
+import controller.monitoring.roi as roi
+import controller.monitoring.kernels as kn
+import controller.utilities.memory as mem
+from controller.utilities.registry import CheckSpec
 
 __author__ = "Barbara Frosik"
 __copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
 __docformat__ = 'restructuredtext en'
-__all__ = ['check_limit',
+__all__ = ['FrameStats',
+           'CheckProfile',
+           'check_limit',
            'intensity_rate',
            'Npix_oversat_cnt_rate',
            'Npix_undersat_cnt_rate',
-           'run_quality_checks']
+           'roi_intensity_rate',
+           'run_quality_checks',
+           'run_quality_checks_batch']
 
 
 E_IN_LIMITS = 0
@@ -24,6 +36,184 @@ E_LOW_LM = 3
 E_HIGH_LM = 4
 
 
+class FrameStats(object):
+    """
+    This class holds statistics of a frame shared by the checks. Each statistic is computed when first used, so
+    the checks evaluated on the same frame do not repeat a pass over the frame.
+
+    With the compiled kernels, the frame sum and the counts of pixels with rate over each of the plan thresholds are
+    computed together in one pass, when any of them is first used. For a compressed frame, they are computed chunk by
+    chunk without decompressing the whole frame.
+    """
+    __slots__ = ('data', 'max', 'min', 'rate', 'thresholds', 'sum', 'counts', 'index', 'bins')
+
+    def __init__(self, data, thresholds=()):
+        self.data = data
+        self.max = None
+        self.min = None
+        self.rate = None
+        self.thresholds = thresholds
+        self.sum = None
+        self.counts = None
+        self.index = None
+        self.bins = None
+
+
+    def reducible(self):
+        chunked = self.data.chunked
+        return (chunked is not None and chunked.frame is None) or kn.compiled(self.data.slice)
+
+
+    def reduce(self, mask):
+        if self.counts is None or mask is not self.index:
+            chunked = self.data.chunked
+            if chunked is not None and chunked.frame is None:
+                self.sum, self.counts = chunked.reductions(self.data.acq_time, self.thresholds, mask)
+            else:
+                self.sum, self.counts = kn.frame_reductions(self.data.slice, self.data.acq_time, self.thresholds,
+                                                            mask)
+            self.index = mask
+
+
+    def binned(self, bin, mask):
+        """
+        This function returns the sums of bin x bin blocks of pixels, excluding masked pixels, for the preview
+        evaluation.
+
+        The frame is binned only if its pixels are unsigned integers, so a block sum bounds the pixels of the block,
+        and the frame shape is a multiple of bin. Otherwise None is returned.
+        """
+        if self.bins is None or self.bins[0] != bin or self.bins[1] is not mask:
+            slice = self.data.slice
+            rows, cols = slice.shape
+            binned = None
+            if slice.dtype.kind == 'u' and slice.itemsize <= 4 and rows % bin == 0 and cols % bin == 0:
+                # the rows are added first, the column blocks are then added on the smaller array; the 32 bit
+                # accumulator holds the block sums of 8 and 16 bit pixels
+                accumulator = np.uint32 if slice.itemsize <= 2 and bin <= 16 else np.int64
+                summed = slice[0::bin].astype(accumulator)
+                for i in range(1, bin):
+                    summed += slice[i::bin]
+                binned = summed[:, 0::bin].copy()
+                for i in range(1, bin):
+                    binned += summed[:, i::bin]
+                if mask is not None:
+                    blocks = (mask // cols // bin) * (cols // bin) + mask % cols // bin
+                    binned -= np.bincount(blocks, weights=slice.ravel()[mask],
+                                          minlength=binned.size).astype(accumulator).reshape(binned.shape)
+            self.bins = (bin, mask, binned)
+        return self.bins[2]
+
+
+    def masked_sum(self, mask):
+        """
+        This function sums the frame pixels, excluding masked pixels.
+        """
+        if self.reducible():
+            self.reduce(mask)
+            return self.sum
+        return masked_sum(self.data.slice, mask)
+
+
+    def count_rate_over(self, threshold, mask):
+        """
+        This function counts pixels with rate (intensity divided by acquire time) over threshold, excluding masked
+        pixels.
+
+        If the frame maximum rate is not over the threshold, no pixel is, and if the frame minimum rate is over the
+        threshold, every pixel is. In these cases the count is known without the counting pass. The division is
+        monotonic, so the result is the same as counting.
+        """
+        if threshold in self.thresholds and self.reducible():
+            self.reduce(mask)
+            return int(self.counts[self.thresholds.index(threshold)])
+        slice = self.data.slice
+        acq_time = self.data.acq_time
+        if self.max is None:
+            self.max = slice.max()
+        if self.max / acq_time <= threshold:
+            return 0
+        if self.min is None:
+            self.min = slice.min()
+        if self.min / acq_time > threshold:
+            return slice.size - (0 if mask is None else len(mask))
+        if slice.dtype.kind in 'iu':
+            return int(kn.counts_numpy(slice, acq_time, (threshold,), mask)[0])
+        if self.rate is None:
+            self.rate = slice / acq_time
+        return masked_count_over(self.rate, threshold, mask)
+
+
+class CheckProfile(object):
+    """
+    This class profiles the cost, the limit hit rate, and the event rate of each check at runtime, and orders the
+    checks of a plan. The event rate is the fraction of evaluated frames the check raised event for, it is reported
+    with the check metrics.
+
+    A check with 'skips' is a gate: when it reaches a limit, the checks it skips are not evaluated. The gates are
+    evaluated first, the gate with the lowest cost per saved time first; the other checks follow in the order of
+    cost. The outcome does not depend on the order, the order only decides how much time the skips save.
+    """
+
+    def __init__(self, alpha=0.05, reorder_every=100):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        alpha : float
+            weight of the latest frame in the moving averages
+        reorder_every : int
+            number of frames between reordering the checks
+        """
+        self.alpha = alpha
+        self.reorder_every = reorder_every
+        # moving averages of seconds per evaluation, of the fraction of evaluations at limit, and of the fraction of
+        # evaluations out of thresholds; the updates from more check stage threads are not locked, a lost update only
+        # delays the averages
+        self.cost = {}
+        self.limit_rate = {}
+        self.event_rate = {}
+        self.frames = 0
+        self.ordered = (None, None)
+
+
+    def update(self, name, seconds, eval):
+        hit = 1.0 if eval in (E_LOW_LM, E_HIGH_LM) else 0.0
+        cost = self.cost.get(name)
+        self.cost[name] = seconds if cost is None else cost + self.alpha * (seconds - cost)
+        rate = self.limit_rate.get(name)
+        self.limit_rate[name] = hit if rate is None else rate + self.alpha * (hit - rate)
+        event = 0.0 if eval == E_IN_THRESHOLDS else 1.0
+        rate = self.event_rate.get(name)
+        self.event_rate[name] = event if rate is None else rate + self.alpha * (event - rate)
+        mt.CHECK_EVENT_RATE.labels(name).set(self.event_rate[name])
+
+
+    def rank(self, checks):
+        present = set(ck.name for ck in checks)
+
+        def gate_score(ck):
+            saved = self.limit_rate.get(ck.name, 0.0) * sum(self.cost.get(n, 0.0) for n in ck.skips if n in present)
+            return self.cost.get(ck.name, 0.0) / saved if saved > 0 else float('inf')
+
+        gates = sorted([ck for ck in checks if len(ck.skips) > 0], key=gate_score)
+        others = sorted([ck for ck in checks if len(ck.skips) == 0], key=lambda ck: self.cost.get(ck.name, 0.0))
+        return tuple(gates + others)
+
+
+    def order(self, plan):
+        """
+        This function returns the plan checks in evaluation order, it is called once per frame.
+        """
+        self.frames += 1
+        plan_ordered, ordered = self.ordered
+        if plan_ordered is not plan or self.frames % self.reorder_every == 0:
+            ordered = self.rank(plan.checks)
+            self.ordered = (plan, ordered)
+        return ordered
+
+
 def check_limit(res, limits):
     """
     This evaluates given result value against limits.
@@ -33,27 +223,17 @@ def check_limit(res, limits):
     res : float
         calculated result
 
-    limits : dictionary
-        a dictionary containing limit values
+    limits : Bounds
+        compiled bounds containing limit values
     Returns
     -------
     result : int
         evaluation result
     """
-    try:
-        ll = limits['low_limit']
-        if res < ll:
-            return E_LOW_LM
-    except KeyError:
-        pass
-
-    try:
-        hl = limits['high_limit']
-        if res > hl:
-            return E_HIGH_LM
-    except KeyError:
-        pass
-
+    if res < limits.low_limit:
+        return E_LOW_LM
+    if res > limits.high_limit:
+        return E_HIGH_LM
     return E_IN_LIMITS
 
 
@@ -66,27 +246,17 @@ def check_threshold(res, thresholds):
     res : float
         calculated result
 
-    thresholds : dictionary
-        a dictionary containing threshold values
+    thresholds : Bounds
+        compiled bounds containing threshold values
     Returns
     -------
     result : int
         evaluation result
     """
-    try:
-        lt = thresholds['low_threshold']
-        if res < lt:
-            return E_LOW_TH
-    except KeyError:
-        pass
-
-    try:
-        ht = thresholds['high_threshold']
-        if res > ht:
-            return E_HIGH_TH
-    except KeyError:
-        pass
-
+    if res < thresholds.low_threshold:
+        return E_LOW_TH
+    if res > thresholds.high_threshold:
+        return E_HIGH_TH
     return E_IN_THRESHOLDS
 
 
@@ -101,33 +271,48 @@ def intensity_rate(**kws):
     ----------
     data : Data
         data instance that includes slice 2D data
-    bounds : dictionary
-        a dictionary containing threshold values for the check
+    bounds : Bounds
+        compiled bounds for the check
+    pix_bounds : Bounds
+        compiled per pixel rate bounds
+    mask : ndarray
+        flat indices of pixels excluded from the check, or None
     Returns
     -------
     eval : int
         result of evaluation
+    res : float
+        calculated result
     args : Event
         Event instance contains result value, and tuple with acquire time pv name and value
     """
-    bounds = kws['bounds']
+    this_bounds = kws['bounds']
     data = kws['data']
-    acq_time_pair = data.acq_time
-    acq_time = acq_time_pair[1]
+    acq_time = data.acq_time
+    stats = kws.get('stats')
+
+    if stats is not None:
+        res = stats.masked_sum(kws['mask'])/acq_time
+    else:
+        res = masked_sum(data.slice, kws['mask'])/acq_time
+    return evaluate_rate(res, this_bounds, data)
+
 
-    this_bounds = bounds['intensity_rate']
-    res = data.slice.sum()/acq_time
+def evaluate_rate(res, this_bounds, data):
+    """
+    This function evaluates the intensity rate against limits and thresholds, and creates the event arguments.
+    """
     eval = check_limit(res, this_bounds)
     # if the result did not exceeded limit, check if it over threshold
     if eval == E_IN_LIMITS:
         eval = check_threshold(res, this_bounds)
         if eval == E_IN_THRESHOLDS:
-            return eval, None
+            return eval, res, None
 
     args = {}
     args['result'] = res
-    args['ack_time'] = acq_time_pair
-    return eval, args
+    args['acq_time'] = (data.acq_time_pv, data.acq_time)
+    return eval, res, args
 
 
 def Npix_oversat_cnt_rate(**kws):
@@ -142,41 +327,51 @@ def Npix_oversat_cnt_rate(**kws):
     ----------
     data : Data
         data instance that includes slice 2D data
-    bounds : dictionary
-        a dictionary containing threshold values for the check
+    bounds : Bounds
+        compiled bounds for the check
+    pix_bounds : Bounds
+        compiled per pixel rate bounds
+    mask : ndarray
+        flat indices of pixels excluded from the check, or None
+    stats : FrameStats
+        statistics of the frame shared by the checks, or None
     Returns
     -------
     eval : int
         result of evaluation
+    res : float
+        calculated result
     args : Event
         Event instance contains result value, and tuple with acquire time pv name and value
     """
-    bounds = kws['bounds']
+    this_bounds = kws['bounds']
+    sub_bounds = kws['pix_bounds']
+    mask = kws['mask']
     data = kws['data']
+    acq_time = data.acq_time
 
-    this_bounds = bounds['Npix_oversat_cnt_rate']
-    sub_bounds = bounds['pix_sat_cnt_rate']
-    acq_time_pair = data.acq_time
-    acq_time = acq_time_pair[1]
+    stats = kws.get('stats')
+    if stats is None:
+        stats = FrameStats(data)
 
-    rate = data.slice/acq_time
-
-    points_over_hlimit = (rate > sub_bounds['high_limit']).sum()
+    points_over_hlimit = stats.count_rate_over(sub_bounds.high_limit, mask)
     # find if number of pixels with saturation rate (intensity divided by acquire time) over limit exceeds the
     # number point saturation rate limit
     eval = check_limit(points_over_hlimit, this_bounds)
     # if the result do not exceed limit, check the threshold
     args = None
     if eval == E_IN_LIMITS:
-        points_over_threshold = (rate > sub_bounds['target']).sum()
+        points_over_threshold = stats.count_rate_over(sub_bounds.target, mask)
         print ('point over thr', points_over_threshold)
         eval = check_threshold(points_over_threshold, this_bounds)
-        if eval != E_IN_THRESHOLDS:
-            args = {}
-            args['points_over_threshold'] = points_over_threshold
-            args['ack_time'] = acq_time_pair
+    else:
+        points_over_threshold = points_over_hlimit
+    if eval != E_IN_THRESHOLDS:
+        args = {}
+        args['points_over_threshold'] = points_over_threshold
+        args['acq_time'] = (data.acq_time_pv, acq_time)
 
-    return eval, args
+    return eval, points_over_threshold, args
 
 
 def Npix_undersat_cnt_rate(**kws):
@@ -191,66 +386,388 @@ def Npix_undersat_cnt_rate(**kws):
     ----------
     data : Data
         data instance that includes slice 2D data
-    bounds : dictionary
-        a dictionary containing threshold values for the check
+    bounds : Bounds
+        compiled bounds for the check
+    pix_bounds : Bounds
+        compiled per pixel rate bounds
+    mask : ndarray
+        flat indices of pixels excluded from the check, or None
+    stats : FrameStats
+        statistics of the frame shared by the checks, or None
     Returns
     -------
     eval : int
         result of evaluation
+    res : float
+        calculated result
     args : Event
         Event instance contains result value, and tuple with acquire time pv name and value
     """
 
-    bounds = kws['bounds']
+    this_bounds = kws['bounds']
+    sub_bounds = kws['pix_bounds']
+    mask = kws['mask']
     data = kws['data']
+    acq_time = data.acq_time
 
-    this_bounds = bounds['Npix_undersat_cnt_rate']
-    sub_bounds = bounds['pix_sat_cnt_rate']
-    acq_time_pair = data.acq_time
-    acq_time = acq_time_pair[1]
-
-    rate = data.slice/acq_time
+    stats = kws.get('stats')
+    if stats is None:
+        stats = FrameStats(data)
 
-    points_over_llimit = (rate > sub_bounds['low_limit']).sum()
+    points_over_llimit = stats.count_rate_over(sub_bounds.low_limit, mask)
 
     # find if number of pixels with saturation rate (intensity divided by acquire time) over low limit is not enough
     eval = check_limit(points_over_llimit, this_bounds)
     # if the result do not exceed limit, check the threshold
     args = None
     if eval == E_IN_LIMITS:
-        points_over_threshold = (rate > sub_bounds['target']).sum()
+        points_over_threshold = stats.count_rate_over(sub_bounds.target, mask)
         eval = check_threshold(points_over_threshold, this_bounds)
-        if eval != E_IN_THRESHOLDS:
-            args = {}
-            args['points_over_threshold'] = points_over_threshold
-            args['ack_time'] = acq_time_pair
+    else:
+        points_over_threshold = points_over_llimit
+    if eval != E_IN_THRESHOLDS:
+        args = {}
+        args['points_over_threshold'] = points_over_threshold
+        args['acq_time'] = (data.acq_time_pv, acq_time)
 
-    return eval, args
+    return eval, points_over_threshold, args
 
 
-# maps the quality check ID to the function object
-function_mapper = {
-                   'intensity_rate': intensity_rate,
-                   'Npix_oversat_cnt_rate': Npix_oversat_cnt_rate,
-                   'Npix_undersat_cnt_rate': Npix_undersat_cnt_rate,
-                  }
+def evaluate_array(res, bounds):
+    """
+    This evaluates array of result values against limits and thresholds, in the order of check_limit and
+    check_threshold.
 
-def run_quality_checks(data, checks, bounds):
+    Parameters
+    ----------
+    res : ndarray
+        calculated results
+
+    bounds : Bounds
+        compiled bounds containing limit and threshold values
+    Returns
+    -------
+    result : ndarray
+        evaluation result for each value
+    """
+    evals = evaluate_thresholds_array(res, bounds)
+    limits = evaluate_limits_array(res, bounds)
+    return np.where(limits != E_IN_LIMITS, limits, evals)
+
+
+def evaluate_limits_array(res, limits):
+    """
+    This evaluates array of result values against limits, as check_limit.
+    """
+    evals = np.zeros(len(res), dtype=np.int8)
+    evals[res > limits.high_limit] = E_HIGH_LM
+    evals[res < limits.low_limit] = E_LOW_LM
+    return evals
+
+
+def evaluate_thresholds_array(res, thresholds):
+    """
+    This evaluates array of result values against thresholds, as check_threshold.
+    """
+    evals = np.zeros(len(res), dtype=np.int8)
+    evals[res > thresholds.high_threshold] = E_HIGH_TH
+    evals[res < thresholds.low_threshold] = E_LOW_TH
+    return evals
+
+
+def roi_intensity_rate(**kws):
+    """
+    This function validates rate of intensity in regions of interest of the frame.
+
+    It sums the pixels intensity in each ROI and divides the sums by acquire time. All ROIs are summed in one pass over
+    the frame. Each ROI result is compared with limits and thresholds. The ROI with the most severe evaluation,
+    a limit before a threshold, determines the check evaluation. If it exceeds limits or thresholds, an Event instance
+    is created and returned.
+
+    Parameters
+    ----------
+    data : Data
+        data instance that includes slice 2D data
+    bounds : Bounds
+        compiled bounds for the check, applied to every ROI
+    params : RoiSet
+        the ROI definition
+    mask : ndarray
+        flat indices of pixels excluded from the check, or None
+    Returns
+    -------
+    eval : int
+        result of evaluation
+    res : float
+        calculated result of the ROI determining the evaluation, or the highest ROI result if in bounds
+    args : Event
+        Event instance contains result value, index of the ROI, results of all ROIs, and tuple with acquire time pv
+        name and value
+    """
+    this_bounds = kws['bounds']
+    data = kws['data']
+    acq_time = data.acq_time
+
+    rates = kws['params'].sums(data.slice, kws['mask'])/acq_time
+    evals = evaluate_array(rates, this_bounds)
+    index = int(evals.argmax())
+    eval = int(evals[index])
+    if eval == E_IN_THRESHOLDS:
+        return eval, rates.max(), None
+
+    args = {}
+    args['result'] = rates[index]
+    args['roi'] = index
+    args['rois'] = rates
+    args['acq_time'] = (data.acq_time_pv, acq_time)
+    return eval, rates[index], args
+
+
+def batch_args(evals, data, key, values):
+    """
+    This function creates list of event arguments for frames in a batch, None for frames without event.
+    """
+    args = [None] * len(evals)
+    for i in np.flatnonzero(evals != E_IN_THRESHOLDS):
+        args[i] = {key: values[i], 'acq_time': (data[i].acq_time_pv, data[i].acq_time)}
+    return args
+
+
+def intensity_rate_batch(**kws):
+    """
+    This function is intensity_rate evaluating a batch of frames in one call.
+
+    Parameters
+    ----------
+    frames : ndarray
+        3D array of frames, the first axis is the frame
+    acq_times : ndarray
+        acquire time of each frame
+    data : list
+        Data instances of the frames
+    bounds : Bounds
+        compiled bounds for the check
+    mask : ndarray
+        flat indices of pixels excluded from the check, or None
+    Returns
+    -------
+    evals : ndarray
+        result of evaluation for each frame
+    res : ndarray
+        calculated result for each frame
+    args : list
+        event arguments for each frame, None if the frame is in bounds
+    """
+    if kn.compiled(kws['frames']):
+        res = kn.batch_reductions(kws['frames'], kws['acq_times'], (), kws['mask'])[0]/kws['acq_times']
+    else:
+        res = masked_sum_batch(kws['frames'], kws['mask'])/kws['acq_times']
+    evals = evaluate_array(res, kws['bounds'])
+    return evals, res, batch_args(evals, kws['data'], 'result', res)
+
+
+def Npix_cnt_rate_batch(pix_limit, **kws):
+    """
+    This function evaluates the Npix checks for a batch of frames. The count of pixels with rate over the pixel
+    limit is evaluated against limits; the frames within limits are evaluated by the count of pixels over the pixel
+    target against thresholds.
+    """
+    this_bounds = kws['bounds']
+    sub_bounds = kws['pix_bounds']
+    mask = kws['mask']
+    frames = kws['frames']
+
+    if kn.compiled(frames):
+        # both counts in one pass
+        thresholds = (pix_limit(sub_bounds), sub_bounds.target)
+        order = np.argsort(thresholds)
+        position = order.argsort()
+        counts = kn.batch_reductions(frames, kws['acq_times'], np.take(thresholds, order), mask)[1]
+        points = counts[:, position[0]]
+        evals = evaluate_limits_array(points, this_bounds)
+        within = np.flatnonzero(evals == E_IN_LIMITS)
+        points[within] = counts[within, position[1]]
+        evals[within] = evaluate_thresholds_array(points[within], this_bounds)
+        return evals, points, batch_args(evals, kws['data'], 'points_over_threshold', points)
+
+    acq_times = kws['acq_times']
+    points = kn.batch_counts_numpy(frames, acq_times, (pix_limit(sub_bounds),), mask)[:, 0]
+    evals = evaluate_limits_array(points, this_bounds)
+    within = np.flatnonzero(evals == E_IN_LIMITS)
+    if len(within) > 0:
+        for i in within:
+            points[i] = kn.counts_numpy(frames[i], acq_times[i], (sub_bounds.target,), mask)[0]
+        evals[within] = evaluate_thresholds_array(points[within], this_bounds)
+    return evals, points, batch_args(evals, kws['data'], 'points_over_threshold', points)
+
+
+def Npix_oversat_cnt_rate_batch(**kws):
+    """
+    This function is Npix_oversat_cnt_rate evaluating a batch of frames in one call, with parameters as
+    intensity_rate_batch.
+    """
+    return Npix_cnt_rate_batch(lambda sub_bounds: sub_bounds.high_limit, **kws)
+
+
+def Npix_undersat_cnt_rate_batch(**kws):
+    """
+    This function is Npix_undersat_cnt_rate evaluating a batch of frames in one call, with parameters as
+    intensity_rate_batch.
+    """
+    return Npix_cnt_rate_batch(lambda sub_bounds: sub_bounds.low_limit, **kws)
+
+
+def roi_intensity_rate_batch(**kws):
+    """
+    This function is roi_intensity_rate evaluating a batch of frames in one call, with parameters as
+    intensity_rate_batch, and the RoiSet params.
+    """
+    this_bounds = kws['bounds']
+    data = kws['data']
+    rates = kws['params'].sums(kws['frames'], kws['mask'])/kws['acq_times'][:, None]
+    roi_evals = evaluate_array(rates.ravel(), this_bounds).reshape(rates.shape)
+    index = roi_evals.argmax(axis=1)
+    frames = np.arange(len(rates))
+    evals = roi_evals[frames, index]
+    res = np.where(evals != E_IN_THRESHOLDS, rates[frames, index], rates.max(axis=1))
+    args = [None] * len(evals)
+    for i in np.flatnonzero(evals != E_IN_THRESHOLDS):
+        args[i] = {'result': res[i], 'roi': int(index[i]), 'rois': rates[i],
+                   'acq_time': (data[i].acq_time_pv, data[i].acq_time)}
+    return evals, res, args
+
+
+def intensity_rate_preview(**kws):
+    """
+    This function is intensity_rate evaluated on the binned frame, with parameters as intensity_rate, and the bin.
+    The sum of the block sums is the frame sum, so the evaluation and the result are exact.
+    """
+    binned = kws['stats'].binned(kws['bin'], kws['mask'])
+    if binned is None:
+        return None
+    data = kws['data']
+    return evaluate_rate(binned.sum(dtype=np.int64)/data.acq_time, kws['bounds'], data)
+
+
+def count_bounds(binned, bin, threshold, acq_time):
+    """
+    This function bounds the count of pixels with rate over threshold from the block sums of unsigned pixels.
+
+    A pixel is over the threshold if its value is not below the integer cut. If a block sum exceeds bin * bin
+    times the cut less one, at least one pixel of the block is over, and a block with sum s has at most s // cut
+    pixels over. If the cut is not positive, masked pixels are not told apart from zero pixels, and None is
+    returned.
+
+    Returns
+    -------
+    low : int
+        the count is not lower
+    high : int
+        the count is not higher
+    """
+    cut = int(kn.integer_cuts([threshold], acq_time)[0])
+    if cut <= 0:
+        return None
+    over = binned[binned >= cut]
+    return np.count_nonzero(over > bin * bin * (cut - 1)), int(np.minimum(over // cut, bin * bin).sum(dtype=np.int64))
+
+
+def Npix_cnt_rate_preview(pix_limit, **kws):
+    """
+    This function evaluates the Npix checks on the binned frame, with parameters as Npix_oversat_cnt_rate, and the
+    bin.
+
+    The frame is decided on the binned frame only if the bounds of both counts are within the limits and thresholds,
+    so the frame has no event; the result is the middle of the bounds of the count over the pixel target, off by at
+    most half of their difference. Otherwise None is returned and the frame is evaluated in full resolution, so the
+    events and the adjustments use exact results.
+    """
+    this_bounds = kws['bounds']
+    sub_bounds = kws['pix_bounds']
+    bin = kws['bin']
+    binned = kws['stats'].binned(bin, kws['mask'])
+    if binned is None:
+        return None
+    acq_time = kws['data'].acq_time
+    bounds = count_bounds(binned, bin, pix_limit(sub_bounds), acq_time)
+    if bounds is None or any(check_limit(count, this_bounds) != E_IN_LIMITS for count in bounds):
+        return None
+    bounds = count_bounds(binned, bin, sub_bounds.target, acq_time)
+    if bounds is None:
+        return None
+    low, high = bounds
+    if check_threshold(low, this_bounds) != E_IN_THRESHOLDS or check_threshold(high, this_bounds) != E_IN_THRESHOLDS:
+        return None
+    return E_IN_THRESHOLDS, (low + high) / 2.0, None
+
+
+def Npix_oversat_cnt_rate_preview(**kws):
+    return Npix_cnt_rate_preview(lambda sub_bounds: sub_bounds.high_limit, **kws)
+
+
+def Npix_undersat_cnt_rate_preview(**kws):
+    return Npix_cnt_rate_preview(lambda sub_bounds: sub_bounds.low_limit, **kws)
+
+
+# the built-in checks, registered by name in controller.utilities.registry
+intensity_rate_check = CheckSpec(intensity_rate, intensity_rate_batch,
+                                 inputs=('data', 'bounds', 'mask', 'stats'),
+                                 batch_inputs=('frames', 'acq_times', 'data', 'bounds', 'mask'),
+                                 pvs=('acq_time',), preview=intensity_rate_preview)
+
+Npix_oversat_cnt_rate_check = CheckSpec(Npix_oversat_cnt_rate, Npix_oversat_cnt_rate_batch,
+                                        inputs=('data', 'bounds', 'pix_bounds', 'mask', 'stats'),
+                                        batch_inputs=('frames', 'acq_times', 'data', 'bounds', 'pix_bounds', 'mask'),
+                                        pvs=('acq_time',), preview=Npix_oversat_cnt_rate_preview)
+
+Npix_undersat_cnt_rate_check = CheckSpec(Npix_undersat_cnt_rate, Npix_undersat_cnt_rate_batch,
+                                         inputs=('data', 'bounds', 'pix_bounds', 'mask', 'stats'),
+                                         batch_inputs=('frames', 'acq_times', 'data', 'bounds', 'pix_bounds', 'mask'),
+                                         pvs=('acq_time',), preview=Npix_undersat_cnt_rate_preview)
+
+roi_intensity_rate_check = CheckSpec(roi_intensity_rate, roi_intensity_rate_batch, roi.compile_rois,
+                                     inputs=('data', 'bounds', 'params', 'mask'),
+                                     batch_inputs=('frames', 'acq_times', 'data', 'bounds', 'params', 'mask'),
+                                     pvs=('acq_time',))
+
+
+def rate_thresholds(plan):
+    """
+    This function returns sorted per pixel rate thresholds of the checks taking the per pixel bounds. The frame
+    statistics count the pixels over all of them in one pass.
+    """
+    thresholds = set()
+    for ck in plan.checks:
+        if ck.pix_bounds is not None and 'pix_bounds' in ck.inputs:
+            thresholds.update(value for value in (ck.pix_bounds.low_limit, ck.pix_bounds.high_limit,
+                                                  ck.pix_bounds.target) if value is not None)
+    return tuple(sorted(thresholds))
+
+
+def run_quality_checks(data, plan, results=None, profile=None, preview=None):
     """
     This function runs evaluation methods.
 
-    This function calls the checks that are included in argument 'check' list. If the check returns event, it is added
+    This function calls the checks that are included in the plan. If the check returns event, it is added
     to event dictionary. Each event is an Event instance that contains fields applicable to the adjuster function that
     corresponds to the check.
+    If a check reaches a limit, the checks it skips are not evaluated, or their results are dropped if they were
+    already evaluated. With a profile, the checks are evaluated in the order of the profile.
+    With preview bin, the checks having preview function are first evaluated on the frame binned by the bin, and
+    in full resolution only if the binned frame does not decide the evaluation.
 
     Parameters
     ----------
     data : Data
         data instance that includes slice 2D data
-    checks : list
-        a list of quality checks to apply
-    bounds : dictionary
-        a dictionary containing threshold values for the checks
+    plan : Plan
+        compiled control plan containing checks with bounds
+    results : dict
+        if given, it is filled with check id key and tuple of evaluation and calculated result as value
+    profile : CheckProfile
+        if given, it orders the checks and is updated with the check cost and limit hit
+    preview : int
+        bin of the preview evaluation, or None
     Returns
     -------
     events_dict : dict
@@ -259,16 +776,109 @@ def run_quality_checks(data, checks, bounds):
 
     """
 
+    # flat indices of masked pixels for this frame shape
+    mask = plan.mask.for_shape(data.shape) if plan.mask is not None else None
+    stats = FrameStats(data, rate_thresholds(plan))
     events_dict = {}
-    for ck in checks:
-        print ('check', ck)
-        function = function_mapper[ck]
-        eval, args = function(data=data, bounds=bounds)
+    skipped = set()
+    for ck in (plan.checks if profile is None else profile.order(plan)):
+        if ck.name in skipped:
+            continue
+        print ('check', ck.name)
+        with mem.stage('check ' + ck.name):
+            start = time.time()
+            evaluated = None
+            if preview is not None and ck.preview_call is not None:
+                evaluated = ck.preview_call(data, mask, stats, bin=preview)
+                (mt.PREVIEW_DECIDED if evaluated is not None else mt.PREVIEW_FALLBACKS).labels(ck.name).inc()
+            if evaluated is None:
+                evaluated = ck.call(data, mask, stats)
+            eval, res, args = evaluated
+            duration = time.time() - start
+        mt.CHECK_SECONDS.labels(ck.name).observe(duration)
+        if profile is not None:
+            profile.update(ck.name, duration, eval)
+        if results is not None:
+            results[ck.name] = (eval, res)
         if eval != E_IN_THRESHOLDS:
             print ('event, args', args)
-            events_dict[ck] = ut.Event(args)
-
+            events_dict[ck.name] = ut.Event(**args)
+            events_dict[ck.name].counter = data.counter
+            if eval in (E_LOW_LM, E_HIGH_LM):
+                skipped.update(ck.skips)
+                for name in ck.skips:
+                    events_dict.pop(name, None)
+                    if results is not None:
+                        results.pop(name, None)
+
+    for name in events_dict:
+        mt.EVENTS.labels(name).inc()
     if len(events_dict) > 0:
         return events_dict
     else:
-        return None
\ No newline at end of file
+        return None
+
+
+def run_quality_checks_batch(data, plan, results=None):
+    """
+    This function runs evaluation methods on a batch of frames.
+
+    The frames are stacked into 3D array and each check with a batch function evaluates all frames in one call.
+    A check without batch function is called for each frame. Each function is given the inputs the check declares.
+    All frames must have the same shape. The checks skipped by a check at limit are dropped from the frame results,
+    as in run_quality_checks.
+
+    Parameters
+    ----------
+    data : list
+        list of Data instances
+    plan : Plan
+        compiled control plan containing checks with bounds
+    results : list
+        if given, it is filled with dictionary of results for each frame, as in run_quality_checks
+    Returns
+    -------
+    events : list
+        for each frame dictionary with check id key and Event as value, or None if the frame has no event
+    """
+    # the frames are stacked only if a batch function takes them
+    stacked = any('frames' in ck.batch_inputs for ck in plan.checks if ck.batch is not None)
+    with mem.stage('batch frames', len(data)):
+        frames = np.stack([d.slice for d in data]) if stacked else None
+    acq_times = np.array([d.acq_time for d in data], dtype=np.float64)
+    mask = plan.mask.for_shape(data[0].shape) if plan.mask is not None else None
+    thresholds = rate_thresholds(plan)
+    events = [{} for d in data]
+    skipped = [set() for d in data]
+    if results is not None:
+        results.extend({} for d in data)
+    for ck in plan.checks:
+        with mem.stage('batch check ' + ck.name, len(data)):
+            start = time.time()
+            if ck.batch is not None:
+                inputs = {'frames': frames, 'acq_times': acq_times, 'data': data, 'bounds': ck.bounds,
+                          'pix_bounds': ck.pix_bounds, 'params': ck.params, 'mask': mask}
+                evals, res, args = ck.batch(**{name: inputs[name] for name in ck.batch_inputs})
+            else:
+                evaluated = [ck.call(d, mask, FrameStats(d, thresholds)) for d in data]
+                evals, res, args = zip(*evaluated)
+            duration = (time.time() - start) / len(data)
+        for i in range(len(data)):
+            mt.CHECK_SECONDS.labels(ck.name).observe(duration)
+            if results is not None:
+                results[i][ck.name] = (evals[i], res[i])
+            if evals[i] != E_IN_THRESHOLDS:
+                events[i][ck.name] = ut.Event(**args[i])
+                events[i][ck.name].counter = data[i].counter
+            if evals[i] in (E_LOW_LM, E_HIGH_LM):
+                skipped[i].update(ck.skips)
+
+    # the checks skipped by a check at limit are evaluated in the batch, their results are dropped
+    for i in range(len(data)):
+        for name in skipped[i]:
+            events[i].pop(name, None)
+            if results is not None:
+                results[i].pop(name, None)
+        for name in events[i]:
+            mt.EVENTS.labels(name).inc()
+    return [ev if len(ev) > 0 else None for ev in events]
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module computes the frame reductions of the intensity and Npix checks: the masked sum of the frame, and the
+masked counts of pixels with rate (intensity divided by acquire time) over each of given thresholds.
+
+If Numba is installed, the reductions are computed by a compiled loop, in one pass over the frame and without
+temporary arrays. Numba is imported with the first compiled reduction, so importing the checks does not load it, and
+the loops are compiled for a frame data type by warm, when the plan is prepared for a frame shape, so the compilation
+does not fall on the check timing. The loop runs parallel over frame rows in one thread at a time; a thread calling
+it while it runs in other thread runs the loop serially. The rate of integer pixel is over a threshold if the pixel
+value is not below an integer cut computed once per frame, so the loop does not divide. Otherwise NumPy functions are
+used; they compare integer pixels with the cuts in the frame data type too, so the counts allocate a boolean frame,
+not a float rate frame. The compiled loop is used for integer frames only; it gives the same results as NumPy, which
+can be verified on the running host with:
+
+    python -m controller.monitoring.kernels --shape 2048 2048
+"""
+
+import argparse
+import importlib.util
+import threading
+import time
+import types
+import numpy as np
+from controller.monitoring.masks import masked_sum, masked_count_over, masked_sum_batch, masked_count_over_batch
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['BACKEND',
+           'frame_reductions',
+           'batch_reductions',
+           'warm',
+           'verify']
+
+
+def reduce_rows(frames, cuts, sums, counts):
+    """
+    This function sums each row of each frame in 3D array into sums, and counts the pixels not below each cut of the
+    frame into counts. The rows of all frames are processed in one parallel loop. A row is read from memory once, it
+    stays in cache while it is summed and counted for each cut, and each of the simple loops is vectorized.
+    """
+    n, rows, cols = frames.shape
+    k = cuts.shape[1]
+    for i in prange(n * rows):
+        f = i // rows
+        row = frames[f, i % rows]
+        s = np.int64(0)
+        for c in range(cols):
+            s += row[c]
+        sums[f, i % rows] = s
+        for j in range(k):
+            cut = cuts[f, j]
+            count = np.int64(0)
+            for c in range(cols):
+                if row[c] >= cut:
+                    count += 1
+            counts[f, i % rows, j] = count
+
+
+def reduce_masked(flat, cuts, index, sums, counts):
+    """
+    This function subtracts the masked pixels of each frame in 2D array of flattened frames from the frame sums and
+    counts.
+    """
+    k = cuts.shape[1]
+    for f in range(flat.shape[0]):
+        for i in index:
+            v = flat[f, i]
+            sums[f] -= v
+            for j in range(k):
+                if v >= cuts[f, j]:
+                    counts[f, j] -= 1
+                else:
+                    break
+
+
+# the numba module when imported by load, the backend is numba if the module is installed
+numba = None
+prange = range
+BACKEND = 'numba' if importlib.util.find_spec('numba') is not None else 'numpy'
+load_lock = threading.Lock()
+# held while the parallel loop runs, the threading layer runs one parallel loop at a time
+parallel_lock = threading.Lock()
+
+
+def renamed(function, name):
+    """
+    This function returns a copy of the function with other name. The Numba cache is indexed by the function name and
+    signature, not by the compile options, so the parallel and serial loops compiled from one function are renamed to
+    be cached in separate files.
+    """
+    copy = types.FunctionType(function.__code__, function.__globals__, name, function.__defaults__,
+                              function.__closure__)
+    copy.__qualname__ = name
+    return copy
+
+
+def load():
+    """
+    This function imports Numba and compiles the loops, once. If Numba cannot be imported, the backend changes to
+    numpy. Returns True if the compiled loops are available.
+    """
+    global numba, prange, BACKEND, reduce_rows_parallel, reduce_rows_serial, reduce_masked_compiled
+    with load_lock:
+        if numba is None and BACKEND == 'numba':
+            try:
+                import numba as nb
+            except ImportError:
+                BACKEND = 'numpy'
+                return False
+            # the workqueue layer is built in Numba and shuts down from any thread, unlike tbb; it does not run
+            # concurrent parallel loops, they are serialized by parallel_lock; a layer chosen by the
+            # NUMBA_THREADING_LAYER environment variable is kept
+            if nb.config.THREADING_LAYER == 'default':
+                nb.config.THREADING_LAYER = 'workqueue'
+            # the loops are compiled with numba prange, the Python loops use range
+            prange = nb.prange
+            # the loops release the GIL, so the chunks of compressed frame are reduced in parallel threads
+            reduce_rows_parallel = nb.njit(parallel=True, nogil=True, cache=True)(renamed(reduce_rows,
+                                                                                        'reduce_rows_parallel'))
+            reduce_rows_serial = nb.njit(nogil=True, cache=True)(renamed(reduce_rows, 'reduce_rows_serial'))
+            reduce_masked_compiled = nb.njit(nogil=True, cache=True)(reduce_masked)
+            numba = nb
+        return numba is not None
+
+
+# integer pixel values are exact in float64 within this range
+MAX_VALUE = 2 ** 53
+
+
+def integer_cuts(thresholds, acq_time):
+    """
+    This function returns for each threshold the smallest integer pixel value with rate over the threshold.
+
+    The float division is monotonic, so integer pixel has rate over the threshold if and only if it is not below the
+    cut. The cut is found by evaluating the rate as NumPy does, so counting the pixels not below the cut gives the
+    same count as comparing the rates.
+    """
+    cuts = np.empty(len(thresholds), dtype=np.int64)
+    for j, threshold in enumerate(thresholds):
+        if np.isnan(threshold) or threshold == np.inf:
+            cuts[j] = MAX_VALUE
+            continue
+        cut = int(np.clip(np.floor(threshold * acq_time), -MAX_VALUE, MAX_VALUE))
+        while cut > -MAX_VALUE and float(cut) / acq_time > threshold:
+            cut -= 1
+        while cut < MAX_VALUE and not float(cut) / acq_time > threshold:
+            cut += 1
+        cuts[j] = cut
+    return cuts
+
+
+def compiled_reductions(frames, acq_times, thresholds, index, parallel=True):
+    """
+    This function computes the reductions of 3D array of frames with the compiled loops, the rows are reduced in
+    parallel unless parallel is False, or the parallel loop runs in other thread.
+    """
+    load()
+    n, rows, cols = frames.shape
+    cuts = np.array([integer_cuts(thresholds, float(acq_time)) for acq_time in acq_times], dtype=np.int64)
+    cuts = cuts.reshape(n, len(thresholds))
+    # partial results of each row, summed after the loop
+    sums = np.zeros((n, rows), dtype=np.int64)
+    counts = np.zeros((n, rows, len(thresholds)), dtype=np.int64)
+    if parallel and parallel_lock.acquire(blocking=False):
+        try:
+            reduce_rows_parallel(frames, cuts, sums, counts)
+        finally:
+            parallel_lock.release()
+    else:
+        reduce_rows_serial(frames, cuts, sums, counts)
+    sums = sums.sum(axis=1)
+    counts = counts.sum(axis=1)
+    if index is not None:
+        reduce_masked_compiled(frames.reshape(n, rows * cols), cuts, np.asarray(index, dtype=np.intp), sums, counts)
+    return sums, counts
+
+
+def counts_numpy(frame, acq_time, thresholds, index):
+    """
+    This function counts pixels with rate over each threshold with NumPy, excluding masked pixels. Integer pixels are
+    compared with the integer cuts as the frame data type, so the only temporary is a boolean frame; other frames are
+    divided by the acquire time.
+    """
+    if frame.dtype.kind not in 'iu':
+        rate = frame / acq_time
+        return np.array([masked_count_over(rate, t, index) for t in thresholds], dtype=np.int64)
+    info = np.iinfo(frame.dtype)
+    counts = np.empty(len(thresholds), dtype=np.int64)
+    for j, cut in enumerate(integer_cuts(thresholds, acq_time)):
+        if cut > info.max:
+            counts[j] = 0
+        elif cut <= info.min:
+            counts[j] = frame.size - (0 if index is None else len(index))
+        else:
+            counts[j] = masked_count_over(frame, frame.dtype.type(cut - 1), index)
+    return counts
+
+
+def batch_counts_numpy(frames, acq_times, thresholds, index):
+    """
+    This function counts pixels with rate over each threshold in each frame in 3D array, as counts_numpy.
+    """
+    counts = np.empty((len(frames), len(thresholds)), dtype=np.int64)
+    for f in range(len(frames)):
+        counts[f] = counts_numpy(frames[f], float(acq_times[f]), thresholds, index)
+    return counts
+
+
+def frame_reductions_numpy(frame, acq_time, thresholds, index):
+    # the reference reductions, comparing the rates
+    rate = frame / acq_time
+    return masked_sum(frame, index), np.array([masked_count_over(rate, t, index) for t in thresholds],
+                                               dtype=np.int64)
+
+
+def batch_reductions_numpy(frames, acq_times, thresholds, index):
+    rate = frames / acq_times[:, None, None]
+    counts = np.zeros((len(frames), len(thresholds)), dtype=np.int64)
+    for j, t in enumerate(thresholds):
+        counts[:, j] = masked_count_over_batch(rate, t, index)
+    return masked_sum_batch(frames, index), counts
+
+
+def compiled(frame):
+    # the compiled loop compares integer pixels with integer cuts, and accumulates the sum exactly
+    if BACKEND != 'numba' or frame.dtype.kind not in 'iu' or frame.itemsize > 4 or frame.ndim < 2:
+        return False
+    return numba is not None or load()
+
+
+def warm(dtype, masked=False):
+    """
+    This function compiles the loops for frames of the data type, with the masked pixels loop if masked. The loops
+    compiled by an earlier run are loaded from the Numba cache.
+
+    Returns
+    -------
+    warmed : bool
+        True if the compiled loops are used for the data type
+    """
+    frames = np.zeros((1, 2, 8), dtype=dtype)
+    if not compiled(frames):
+        return False
+    index = np.zeros(1, dtype=np.intp) if masked else None
+    for parallel in (True, False):
+        compiled_reductions(frames, [1.0], np.array([1.0]), index, parallel)
+    return True
+
+
+def frame_reductions(frame, acq_time, thresholds, index, parallel=True):
+    """
+    This function computes the masked sum of the frame and the masked counts of pixels with rate over thresholds.
+
+    Parameters
+    ----------
+    frame : ndarray
+        2D frame
+    acq_time : float
+        acquire time of the frame
+    thresholds : ndarray
+        sorted pixel rate thresholds
+    index : ndarray
+        flat indices of masked pixels, or None
+    parallel : bool
+        if False, the compiled loop runs in the calling thread only
+
+    Returns
+    -------
+    sum : number
+        sum of the pixels, excluding masked pixels
+    counts : ndarray
+        number of pixels with rate over each threshold, excluding masked pixels
+    """
+    if compiled(frame):
+        sums, counts = compiled_reductions(np.ascontiguousarray(frame)[None], [acq_time], thresholds, index,
+                                           parallel)
+        return sums[0], counts[0]
+    return masked_sum(frame, index), counts_numpy(frame, acq_time, thresholds, index)
+
+
+def batch_reductions(frames, acq_times, thresholds, index):
+    """
+    This function computes the reductions of frame_reductions for each frame in 3D array of frames.
+
+    Returns
+    -------
+    sums : ndarray
+        sum of each frame
+    counts : ndarray
+        2D array of counts, the first axis is the frame and the second is the threshold
+    """
+    if compiled(frames):
+        return compiled_reductions(np.ascontiguousarray(frames), acq_times, thresholds, index)
+    return masked_sum_batch(frames, index), batch_counts_numpy(frames, acq_times, thresholds, index)
+
+
+def verify(shape=(512, 512), frames=4, dtypes=('uint8', 'uint16', 'uint32', 'int32'), seed=0):
+    """
+    This function compares the compiled reductions with the NumPy reductions on random frames, with and without
+    mask, for each data type.
+
+    Returns
+    -------
+    mismatches : list
+        description of each mismatch, empty if the results are identical
+    """
+    if BACKEND != 'numba' or not load():
+        return []
+    rng = np.random.default_rng(seed)
+    mismatches = []
+    for dtype in dtypes:
+        high = min(np.iinfo(dtype).max, 100000)
+        data = rng.integers(0, high, (frames,) + tuple(shape)).astype(dtype)
+        acq_times = rng.uniform(0.001, 1.0, frames)
+        rates = data / acq_times[:, None, None]
+        # thresholds include pixel rates, so the comparison at equal rate is verified
+        thresholds = np.sort(np.append(rng.choice(rates.ravel(), 3), [0.0, np.inf]))
+        for index in (None, np.sort(rng.choice(data[0].size, data[0].size // 100, replace=False))):
+            expected = batch_reductions_numpy(data, acq_times, thresholds, index)
+            computed = compiled_reductions(data, acq_times, thresholds, index)
+            for name, e, c in zip(('sum', 'counts'), expected, computed):
+                if not np.array_equal(e, c):
+                    mismatches.append('%s batch %s, mask %s' % (dtype, name, index is not None))
+            for f in range(frames):
+                expected = frame_reductions_numpy(data[f], acq_times[f], thresholds, index)
+                computed = frame_reductions(data[f], acq_times[f], thresholds, index)
+                for name, e, c in zip(('sum', 'counts'), expected, computed):
+                    if not np.array_equal(e, c):
+                        mismatches.append('%s frame %d %s, mask %s' % (dtype, f, name, index is not None))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify and time the frame reductions.')
+    parser.add_argument('--shape', type=int, nargs=2, default=(512, 512), help='frame rows and columns')
+    parser.add_argument('--frames', type=int, default=4, help='number of frames')
+    args = parser.parse_args()
+
+    load()
+    print ('backend', BACKEND)
+    mismatches = verify(tuple(args.shape), args.frames)
+    for mismatch in mismatches:
+        print ('mismatch', mismatch)
+    if BACKEND == 'numba':
+        print ('compiled reductions are identical to NumPy' if len(mismatches) == 0 else 'verification failed')
+
+    frame = np.random.default_rng().integers(0, 4096, tuple(args.shape)).astype(np.uint16)
+    thresholds = np.array([100.0, 1000.0, 10000.0])
+    for name, function in (('numpy', frame_reductions_numpy), (BACKEND, frame_reductions)):
+        function(frame, 0.1, thresholds, None)
+        start = time.time()
+        for i in range(10):
+            function(frame, 0.1, thresholds, None)
+        print ('%s %.3f ms per frame' % (name, (time.time() - start) * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module handles masks of detector pixels that are excluded from the checks, such as module gaps, dead and hot
+pixels.
+
+A mask is compiled for a frame shape into flat index array of the masked pixels. The checks run the reduction on
+the whole frame and subtract the contribution of the masked pixels, which are few, so no masked copy of the frame
+is made.
+
+Usage: python -m controller.monitoring.masks mask.npy --dark dark.npy --flat flat.npy --module 195 487 --gap 17 7
+"""
+
+import argparse
+import numpy as np
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['Mask',
+           'load_mask',
+           'module_gap_mask',
+           'mask_from_series',
+           'masked_sum',
+           'masked_count_over',
+           'masked_sum_batch',
+           'masked_count_over_batch']
+
+
+class Mask(object):
+    """
+    This class holds a boolean mask, where True marks excluded pixel, and the mask compiled for frame shapes.
+    """
+
+    def __init__(self, mask):
+        self.mask = np.asarray(mask, dtype=bool)
+        self.compiled = {}
+
+
+    def for_shape(self, shape):
+        """
+        This function returns flat indices of masked pixels for a frame of the given shape.
+
+        If the frame is binned, that is the mask shape is a multiple of the frame shape, a binned pixel is masked if
+        any of its pixels is masked. If the mask shape differs otherwise, the mask does not apply and None is returned.
+        """
+        try:
+            return self.compiled[shape]
+        except KeyError:
+            mask = self.mask
+            if mask.shape != shape and len(shape) == 2 and shape[0] > 0 and shape[1] > 0 and \
+                    mask.shape[0] % shape[0] == 0 and mask.shape[1] % shape[1] == 0:
+                bin = (mask.shape[0] // shape[0], mask.shape[1] // shape[1])
+                print ('mask binned by', bin, 'for frame shape', shape)
+                mask = mask.reshape(shape[0], bin[0], shape[1], bin[1]).any(axis=(1, 3))
+            if mask.shape != shape:
+                print ('mask shape', self.mask.shape, 'does not match frame shape', shape, ', mask not applied')
+                index = None
+            else:
+                index = np.flatnonzero(mask)
+                if index.size == 0:
+                    index = None
+            self.compiled[shape] = index
+            return index
+
+
+def load_mask(file):
+    """
+    This function loads mask from npy file, or from npz file containing 'mask' array.
+
+    Parameters
+    ----------
+    file : str
+        mask file name
+
+    Returns
+    -------
+    mask : Mask
+        loaded mask
+    """
+    loaded = np.load(file)
+    if hasattr(loaded, 'files'):
+        with loaded:
+            return Mask(loaded['mask'])
+    return Mask(loaded)
+
+
+def module_gap_mask(shape, module, gap):
+    """
+    This function creates mask of the gaps between detector modules.
+
+    Parameters
+    ----------
+    shape : tuple
+        frame shape (rows, columns)
+    module : tuple
+        module size in pixels (rows, columns), for Pilatus (195, 487), for Eiger (514, 1030)
+    gap : tuple
+        gap between modules in pixels (rows, columns), for Pilatus (17, 7), for Eiger (37, 10)
+
+    Returns
+    -------
+    mask : ndarray
+        boolean array, True in the gaps
+    """
+    rows = np.arange(shape[0]) % (module[0] + gap[0]) >= module[0]
+    cols = np.arange(shape[1]) % (module[1] + gap[1]) >= module[1]
+    return rows[:, None] | cols[None, :]
+
+
+def mask_from_series(darks=None, flats=None, hot_sigma=5.0, dead_fraction=0.1):
+    """
+    This function finds hot pixels in a series of dark frames, and dead pixels in a series of flat frames.
+
+    A pixel is hot if its mean dark count exceeds the mean of all pixels by more than hot_sigma standard deviations.
+    A pixel is dead if its mean flat count is below dead_fraction of the median of all pixels.
+
+    Parameters
+    ----------
+    darks : ndarray
+        3D array of dark frames
+    flats : ndarray
+        3D array of flat field frames
+    hot_sigma : float
+        number of standard deviations above mean marking hot pixel
+    dead_fraction : float
+        fraction of median marking dead pixel
+
+    Returns
+    -------
+    mask : ndarray
+        boolean array, True for hot and dead pixels
+    """
+    mask = None
+    if darks is not None:
+        dark = np.asarray(darks).mean(axis=0)
+        mask = dark > dark.mean() + hot_sigma * dark.std()
+    if flats is not None:
+        flat = np.asarray(flats).mean(axis=0)
+        dead = flat < dead_fraction * np.median(flat)
+        mask = dead if mask is None else mask | dead
+    return mask
+
+
+def masked_sum(frame, index):
+    """
+    This function sums the frame pixels, excluding the masked pixels given by flat index array.
+    """
+    total = frame.sum()
+    if index is not None:
+        total -= frame.ravel().take(index).sum()
+    return total
+
+
+def masked_count_over(frame, threshold, index):
+    """
+    This function counts the frame pixels over threshold, excluding the masked pixels given by flat index array.
+    """
+    count = np.count_nonzero(frame > threshold)
+    if index is not None:
+        count -= np.count_nonzero(frame.ravel().take(index) > threshold)
+    return count
+
+
+def masked_sum_batch(frames, index):
+    """
+    This function sums the pixels of each frame in 3D array, excluding the masked pixels given by flat index array.
+    """
+    flat = frames.reshape(len(frames), -1)
+    total = flat.sum(axis=1)
+    if index is not None:
+        total -= flat[:, index].sum(axis=1)
+    return total
+
+
+def masked_count_over_batch(frames, threshold, index):
+    """
+    This function counts the pixels over threshold in each frame in 3D array, excluding the masked pixels given by
+    flat index array.
+    """
+    flat = frames.reshape(len(frames), -1)
+    count = np.count_nonzero(flat > threshold, axis=1)
+    if index is not None:
+        count -= np.count_nonzero(flat[:, index] > threshold, axis=1)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create detector mask file.')
+    parser.add_argument('output', help='output npy file')
+    parser.add_argument('--dark', help='npy file with 3D array of dark frames')
+    parser.add_argument('--flat', help='npy file with 3D array of flat field frames')
+    parser.add_argument('--shape', type=int, nargs=2, help='frame shape, needed if no dark or flat is given')
+    parser.add_argument('--module', type=int, nargs=2, help='module size in pixels (rows columns)')
+    parser.add_argument('--gap', type=int, nargs=2, help='gap between modules in pixels (rows columns)')
+    parser.add_argument('--hot-sigma', type=float, default=5.0, help='standard deviations marking hot pixel')
+    parser.add_argument('--dead-fraction', type=float, default=0.1, help='fraction of median marking dead pixel')
+    args = parser.parse_args()
+
+    darks = np.load(args.dark, mmap_mode='r') if args.dark else None
+    flats = np.load(args.flat, mmap_mode='r') if args.flat else None
+    mask = mask_from_series(darks, flats, args.hot_sigma, args.dead_fraction)
+    shape = mask.shape if mask is not None else tuple(args.shape)
+    if args.module is not None:
+        gaps = module_gap_mask(shape, args.module, args.gap or (0, 0))
+        mask = gaps if mask is None else mask | gaps
+    if mask is None:
+        parser.error('nothing to mask, give dark, flat, or module')
+    np.save(args.output, mask)
+    print ('masked pixels', np.count_nonzero(mask), 'of', mask.size)
+
+
+if __name__ == '__main__':
+    main()
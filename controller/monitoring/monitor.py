@@ -5,29 +5,118 @@
 Monitor receives data from Feed, run suite of checks and if any event is discovered, notifies responder.
 """
 
-import json
 from controller.utilities.utils import Observable
 import controller.monitoring.checks as checks
+import controller.utilities.plan as pl
+import controller.utilities.memory as mem
 
 
 class Monitor(Observable):
-    def __init__(self, config):
+    def __init__(self, config, plan=None):
         """
         constructor
         """
-        with open(config['bounds']) as file:
-            self.bounds = json.loads(file.read())
-        with open(config['checks']) as file:
-            self.checks = json.loads(file.read())
+        Observable.__init__(self)
+        # the plan can be replaced by PlanWatcher at any time, it is read once per frame
+        self.plan = plan if plan is not None else pl.compile_plan(config)
+        # runtime cost and hit rate of the checks, deciding evaluation order
+        self.profile = checks.CheckProfile()
+        # bin of the preview evaluation on binned frames, or None to evaluate in full resolution
+        self.preview = int(config['preview_bin']) if int(config.get('preview_bin', 1)) > 1 else None
+        # optional Recorder receiving check results and frames
+        self.recorder = None
+        # optional Publisher republishing frames with check results
+        self.publisher = None
+        # optional TimeSeries storing check results of every frame
+        self.timeseries = None
+        # statistics of missing frames and failed reads, updated by the feed
+        self.feed_stats = None
+        self.shape = None
 
 
     def process_data(self, data):
         """
         This function runs applicable checks.
         All events returned by the checks are passed with notify function to the observer.
+        The events are returned, or None if no event was found.
         """
-        events = checks.run_quality_checks(data, self.checks, self.bounds)
+        if not self.keeps_results():
+            events = checks.run_quality_checks(data, self.plan, profile=self.profile, preview=self.preview)
+        else:
+            results = {}
+            events = checks.run_quality_checks(data, self.plan, results, self.profile, self.preview)
+            self.deliver_results(data, results, events)
         print ('events',events)
         if events is not None:
             # if event is detected, call notify
-            self.notify(events)
+            with mem.stage('notify'):
+                self.notify(events)
+        return events
+
+
+    def process_batch(self, data):
+        """
+        This function runs applicable checks on a batch of frames, evaluating each check for all frames in one call.
+
+        The frames are evaluated in runs of the same shape. If no check has a batch function, or with preview, the
+        frames are evaluated one by one. Each frame is recorded with its results, and the events of the latest eventful
+        frame are passed with notify function to the observer, as the responder adjusts to the current state. The list
+        of events for each frame is returned.
+        """
+        events = []
+        start = 0
+        while start < len(data):
+            end = start + 1
+            while end < len(data) and data[end].shape == data[start].shape:
+                end += 1
+            run = data[start:end]
+            results = [] if self.keeps_results() else None
+            # without batch functions, or with preview, the frames are evaluated one by one, in the order of the
+            # profile
+            if len(run) == 1 or self.preview is not None or all(ck.batch is None for ck in self.plan.checks):
+                for d in run:
+                    if results is not None:
+                        results.append({})
+                    events.append(checks.run_quality_checks(d, self.plan, None if results is None else results[-1],
+                                                            self.profile, self.preview))
+            else:
+                events.extend(checks.run_quality_checks_batch(run, self.plan, results))
+            if results is not None:
+                for d, res, ev in zip(run, results, events[start:end]):
+                    self.deliver_results(d, res, ev)
+            start = end
+        print ('events', events)
+        latest = [ev for ev in events if ev is not None]
+        if len(latest) > 0:
+            with mem.stage('notify'):
+                self.notify(latest[-1])
+        return events
+
+
+    def keeps_results(self):
+        return self.recorder is not None or self.publisher is not None or self.timeseries is not None
+
+
+    def deliver_results(self, data, results, events):
+        """
+        This function passes the check results of a frame to the recorder, publisher, and time series.
+        """
+        if self.recorder is not None:
+            self.recorder.record_frame(data, results, events)
+        if self.publisher is not None:
+            self.publisher.publish(data, results)
+        if self.timeseries is not None:
+            self.timeseries.append(data, results)
+
+
+    def feed_event(self, event_str, stats):
+        """
+        This function receives events from the feed, such as missing frames, with the feed statistics.
+
+        When the frame shape changes, the plan is prepared for the new shape before its first frame is delivered.
+        """
+        self.feed_stats = stats
+        shape = getattr(stats, 'shape', None)
+        if shape is not None and shape != self.shape:
+            self.shape = shape
+            pl.prepare_plan(self.plan, shape, getattr(stats, 'dtype', None))
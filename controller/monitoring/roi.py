@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module computes statistics of regions of interest (ROI) in a frame.
+
+The ROIs are either a grid of equal blocks, for example detector modules, or a list of rectangles. All edges of the
+ROIs split the frame into cells, and the cells are summed in one pass with np.add.reduceat. The ROI sums are then
+taken from the summed area table of the cells, so the frame is read once regardless of the number of ROIs.
+"""
+
+import numpy as np
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['RoiSet',
+           'compile_rois']
+
+
+class RoiSet(object):
+    """
+    This class holds the ROI definition and the ROI geometry compiled for frame shapes.
+    """
+
+    def __init__(self, grid=None, rois=None):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        grid : tuple
+            number of blocks in rows and columns
+        rois : list
+            list of rectangles [row start, row end, column start, column end], the ends are exclusive
+        """
+        if (grid is None) == (rois is None):
+            raise ValueError('ROI check needs either grid or rois')
+        self.grid = None if grid is None else (int(grid[0]), int(grid[1]))
+        self.rois = None if rois is None else np.array(rois, dtype=np.intp).reshape(-1, 4)
+        self.compiled = {}
+
+
+    def rectangles(self, shape):
+        if self.grid is not None:
+            row_edges = np.arange(self.grid[0] + 1) * shape[0] // self.grid[0]
+            col_edges = np.arange(self.grid[1] + 1) * shape[1] // self.grid[1]
+            r, c = np.meshgrid(np.arange(self.grid[0]), np.arange(self.grid[1]), indexing='ij')
+            r, c = r.ravel(), c.ravel()
+            return np.stack([row_edges[r], row_edges[r + 1], col_edges[c], col_edges[c + 1]], axis=1)
+        rois = self.rois.copy()
+        rois[:, 0:2] = np.clip(rois[:, 0:2], 0, shape[0])
+        rois[:, 2:4] = np.clip(rois[:, 2:4], 0, shape[1])
+        return rois
+
+
+    def for_shape(self, shape, mask=None):
+        """
+        This function compiles the ROIs for a frame shape.
+
+        Parameters
+        ----------
+        shape : tuple
+            frame shape
+        mask : ndarray
+            flat indices of masked pixels, or None
+
+        Returns
+        -------
+        geometry : tuple
+            row edges and column edges of the cells, the ROI corners indices in the summed area table, and the cell
+            of every masked pixel
+        """
+        try:
+            return self.compiled[shape]
+        except KeyError:
+            rects = self.rectangles(shape)
+            row_edges = np.unique(np.concatenate(([0], rects[:, 0], rects[:, 1])))
+            col_edges = np.unique(np.concatenate(([0], rects[:, 2], rects[:, 3])))
+            # reduceat sums from each edge to the next one, the edge at the frame end would make an empty cell
+            row_edges = row_edges[row_edges < shape[0]]
+            col_edges = col_edges[col_edges < shape[1]]
+            # indices of the ROI corners in the summed area table, that has a leading row and column of zeros
+            corners = np.stack([np.searchsorted(row_edges, rects[:, 0]),
+                                np.searchsorted(row_edges, rects[:, 1]),
+                                np.searchsorted(col_edges, rects[:, 2]),
+                                np.searchsorted(col_edges, rects[:, 3])], axis=1)
+            cells = None
+            if mask is not None:
+                rows, cols = np.unravel_index(mask, shape)
+                cells = (np.searchsorted(row_edges, rows, side='right') - 1) * len(col_edges) + \
+                        np.searchsorted(col_edges, cols, side='right') - 1
+            geometry = (row_edges, col_edges, corners, cells)
+            self.compiled[shape] = geometry
+            return geometry
+
+
+    @staticmethod
+    def take(cell_sums, corners):
+        shape = cell_sums.shape
+        table = np.zeros(shape[:-2] + (shape[-2] + 1, shape[-1] + 1))
+        table[..., 1:, 1:] = cell_sums.cumsum(axis=-2).cumsum(axis=-1)
+        r0, r1, c0, c1 = corners[:, 0], corners[:, 1], corners[:, 2], corners[:, 3]
+        return table[..., r1, c1] - table[..., r0, c1] - table[..., r1, c0] + table[..., r0, c0]
+
+
+    def sums(self, frame, mask=None):
+        """
+        This function returns the sum of pixels in every ROI, excluding masked pixels.
+
+        Parameters
+        ----------
+        frame : ndarray
+            2D frame, or 3D array of frames
+        mask : ndarray
+            flat indices of masked pixels, or None
+
+        Returns
+        -------
+        sums : ndarray
+            sum of each ROI, for 3D array the first axis is the frame
+        """
+        row_edges, col_edges, corners, cells = self.for_shape(frame.shape[-2:], mask)
+        # the rows of each band of cells are summed with buffered casting; reduceat with float64 type would convert
+        # the whole frame to a float64 temporary
+        row_ends = np.append(row_edges[1:], frame.shape[-2])
+        bands = np.stack([frame[..., start:end, :].sum(axis=-2, dtype=np.float64)
+                          for start, end in zip(row_edges, row_ends)], axis=-2)
+        cell_sums = np.add.reduceat(bands, col_edges, axis=-1)
+        if cells is not None:
+            ncells = cell_sums.shape[-2] * cell_sums.shape[-1]
+            flat = frame.reshape(-1, frame.shape[-2] * frame.shape[-1])
+            # offset the cells of each frame, so all frames are counted in one bincount
+            offsets = (np.arange(len(flat)) * ncells)[:, None]
+            cell_sums -= np.bincount((cells + offsets).ravel(), weights=flat[:, mask].ravel(),
+                                     minlength=len(flat) * ncells).reshape(cell_sums.shape)
+        return self.take(cell_sums, corners)
+
+
+def compile_rois(bounds):
+    """
+    This function creates RoiSet from the check bounds dictionary containing 'grid' or 'rois' entry.
+    """
+    return RoiSet(bounds.get('grid'), bounds.get('rois'))
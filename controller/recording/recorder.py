@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module records frames, check results, and PV writes issued by the controller.
+
+Each record carries the counter of its frame, and the check results and frames carry the frame acquire time, so the
+rates can be recovered in replay. A PV write is recorded with the counter of the frame whose event caused it.
+
+The records are enqueued into a bounded queue and written by a background thread into compressed shards, either npz
+files or HDF5 files if h5py is installed. When the queue is full the record is dropped and counted, so the
+recording never blocks the monitor.
+"""
+
+import itertools
+import os
+import sys
+import threading
+import time
+import numpy as np
+import controller.utilities.metrics as mt
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+if sys.version[0] == '2':
+    import Queue as tqueue
+else:
+    import queue as tqueue
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['Recorder',
+           'load_shard']
+
+
+POLICY_ALL = 'all'
+POLICY_EVENTS = 'events'
+POLICY_NTH = 'nth'
+
+
+class Recorder(threading.Thread):
+    """
+    This class records frames, check results, and PV writes into shards in a background thread.
+
+    Check results are recorded for every frame. The frame itself is recorded according to the policy: 'all' records
+    every frame, 'events' records frames for which a check raised event, and 'nth' records every nth frame.
+    """
+
+    def __init__(self, dir, policy=POLICY_EVENTS, every=10, shard_frames=100, queue_size=256, format='npz'):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        dir : str
+            directory where the shards are written
+        policy : str
+            frame sampling policy, 'all', 'events', or 'nth'
+        every : int
+            recording interval used by the 'nth' policy
+        shard_frames : int
+            number of results in one shard
+        queue_size : int
+            maximum number of records waiting to be written
+        format : str
+            shard format, 'npz' or 'hdf5'
+        """
+        threading.Thread.__init__(self, name='recorder')
+        self.daemon = True
+        if policy not in (POLICY_ALL, POLICY_EVENTS, POLICY_NTH):
+            raise ValueError('unknown recording policy ' + policy)
+        if format == 'hdf5' and h5py is None:
+            raise ValueError('recording format hdf5 requires h5py')
+        self.dir = dir
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        self.policy = policy
+        self.every = max(int(every), 1)
+        self.shard_frames = shard_frames
+        self.format = format
+        self.recordq = tqueue.Queue(maxsize=queue_size)
+        mt.QUEUE_DEPTH.labels('recorder').set_function(self.recordq.qsize)
+        self.index = itertools.count()
+        self.dropped = 0
+        self.shard_no = 0
+        self.clear()
+
+
+    def clear(self):
+        self.results = []
+        self.frames = []
+        self.puts = []
+
+
+    def enqueue(self, item):
+        try:
+            self.recordq.put_nowait(item)
+            return True
+        except tqueue.Full:
+            self.dropped += 1
+            mt.RECORDS_DROPPED.inc()
+            return False
+
+
+    def record_frame(self, data, results, events):
+        """
+        This function enqueues the check results and, if selected by the policy, the frame.
+
+        It is called by the monitor for each frame and does not block.
+
+        Parameters
+        ----------
+        data : Data
+            data instance that includes slice 2D data
+        results : dict
+            dictionary with check id key and tuple of evaluation and calculated result
+        events : dict
+            dictionary of events found in the frame, or None
+
+        Returns
+        -------
+        nothing
+        """
+        # the monitor can run in more check stage threads, next() on count is atomic
+        index = next(self.index)
+        if self.policy == POLICY_ALL:
+            keep = True
+        elif self.policy == POLICY_EVENTS:
+            keep = events is not None
+        else:
+            keep = index % self.every == 0
+        if keep:
+            # the frame is copied by the writer thread, and released afterwards
+            data.retain()
+            if not self.enqueue(('frame', index, data.counter, time.time(), data.acq_time, results, events is not None,
+                                 data)):
+                data.release()
+        else:
+            self.enqueue(('frame', index, data.counter, time.time(), data.acq_time, results, events is not None, None))
+
+
+    def record_put(self, pvname, value, counter=-1):
+        """
+        This function enqueues PV write issued by the responder.
+
+        Parameters
+        ----------
+        pvname : str
+            name of the written pv
+        value : float
+            written value
+        counter : int
+            counter of the frame whose event caused the write
+        """
+        self.enqueue(('put', counter, time.time(), pvname, value))
+
+
+    def run(self):
+        while True:
+            item = self.recordq.get()
+            if item is None:
+                break
+            if item[0] == 'put':
+                self.puts.append(item[1:])
+                continue
+            index, counter, ts, acq_time, results, eventful, data = item[1:]
+            frame = None
+            if data is not None:
+                frame = data.slice.copy()
+                data.release()
+            if frame is not None and len(self.frames) > 0 and frame.shape != self.frames[0][4].shape:
+                # frames in a shard are stacked, so the shard is closed when the frame shape changes
+                self.flush()
+            self.results.append((index, counter, ts, acq_time, results, eventful))
+            if frame is not None:
+                self.frames.append((index, counter, ts, acq_time, frame))
+            if len(self.results) >= self.shard_frames:
+                self.flush()
+        self.flush()
+
+
+    def shard_arrays(self):
+        """
+        This function converts the buffered records into arrays stored in the shard.
+        """
+        arrays = {}
+        names = sorted(set(name for r in self.results for name in r[4]))
+        arrays['result_index'] = np.array([r[0] for r in self.results], dtype=np.int64)
+        arrays['result_counter'] = np.array([r[1] for r in self.results], dtype=np.int64)
+        arrays['result_time'] = np.array([r[2] for r in self.results], dtype=np.float64)
+        # a frame without acquire time pv is recorded with nan acquire time
+        arrays['result_acq_time'] = np.array([np.nan if r[3] is None else r[3] for r in self.results],
+                                             dtype=np.float64)
+        arrays['result_event'] = np.array([r[5] for r in self.results], dtype=bool)
+        arrays['check_names'] = np.array(names, dtype=str)
+        evals = np.full((len(self.results), len(names)), -1, dtype=np.int8)
+        values = np.full((len(self.results), len(names)), np.nan)
+        for i, r in enumerate(self.results):
+            for j, name in enumerate(names):
+                if name in r[4]:
+                    evals[i, j], values[i, j] = r[4][name]
+        arrays['result_eval'] = evals
+        arrays['result_value'] = values
+        if len(self.frames) > 0:
+            arrays['frame_index'] = np.array([f[0] for f in self.frames], dtype=np.int64)
+            arrays['frame_counter'] = np.array([f[1] for f in self.frames], dtype=np.int64)
+            arrays['frame_time'] = np.array([f[2] for f in self.frames], dtype=np.float64)
+            arrays['frame_acq_time'] = np.array([np.nan if f[3] is None else f[3] for f in self.frames],
+                                                dtype=np.float64)
+            arrays['frames'] = np.stack([f[4] for f in self.frames])
+            # the shape of the frames can be read without reading the frames
+            arrays['frame_shape'] = np.array(arrays['frames'].shape[1:], dtype=np.int64)
+        arrays['put_counter'] = np.array([p[0] for p in self.puts], dtype=np.int64)
+        arrays['put_time'] = np.array([p[1] for p in self.puts], dtype=np.float64)
+        arrays['put_pv'] = np.array([p[2] for p in self.puts], dtype=str)
+        arrays['put_value'] = np.array([p[3] for p in self.puts], dtype=np.float64)
+        return arrays
+
+
+    def flush(self):
+        """
+        This function writes buffered records into a new shard.
+        """
+        if len(self.results) == 0 and len(self.puts) == 0:
+            return
+        arrays = self.shard_arrays()
+        name = os.path.join(self.dir, 'shard_%06d' % self.shard_no)
+        if self.format == 'hdf5':
+            with h5py.File(name + '.h5', 'w') as file:
+                for key in arrays:
+                    if key == 'frames':
+                        file.create_dataset(key, data=arrays[key], chunks=(1,) + arrays[key].shape[1:],
+                                            compression='gzip')
+                    elif arrays[key].dtype.kind == 'U':
+                        file.create_dataset(key, data=arrays[key].astype('S'))
+                    else:
+                        file.create_dataset(key, data=arrays[key])
+        else:
+            np.savez_compressed(name + '.npz', **arrays)
+        self.shard_no += 1
+        self.clear()
+
+
+    def stop(self):
+        """
+        This function writes the remaining records and stops the writer thread.
+        """
+        self.recordq.put(None)
+        self.join()
+        if self.dropped > 0:
+            print ('recorder dropped records', self.dropped)
+
+
+def load_shard(name, keys=None):
+    """
+    This function loads a shard written by the Recorder into a dictionary of arrays.
+
+    Parameters
+    ----------
+    name : str
+        shard file name
+    keys : sequence
+        names of the arrays to load, all arrays if None; the arrays not in the shard are not loaded
+
+    Returns
+    -------
+    arrays : dict
+        dictionary of shard arrays
+    """
+    if name.endswith('.h5'):
+        with h5py.File(name, 'r') as file:
+            return {key: file[key][()] for key in file if keys is None or key in keys}
+    with np.load(name) as file:
+        return {key: file[key] for key in file.files if keys is None or key in keys}
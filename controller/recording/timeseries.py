@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module stores the check results of every frame in a memory mapped ring of fixed size records, for post-mortem
+analysis.
+
+The file has a header followed by a NumPy structured array. A record holds the frame counter, time, acquire time,
+and the evaluation and the result of each check. The records are written into the ring slot by slot, and the oldest
+records are overwritten when the ring is full. The header holds the number of records written, that is updated
+after the record, so another process can read the file while the controller is running.
+
+Usage: python -m controller.recording.timeseries results.ts --counter 100 200
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import numpy as np
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['TimeSeries',
+           'record_dtype',
+           'open_timeseries']
+
+
+MAGIC = b'CTLTS001'
+HEADER_SIZE = 4096
+# offsets of the header fields following the magic
+CAPACITY = 8
+WRITTEN = 16
+DESCR_SIZE = 24
+DESCR = 32
+
+
+def record_dtype(names):
+    """
+    This function returns the record type for the given check names.
+
+    The values are stored as float32, a record for four checks takes 40 bytes.
+    """
+    fields = [('counter', '<i8'), ('time', '<f8'), ('acq_time', '<f4')]
+    for name in names:
+        fields.append((name + '_eval', 'i1'))
+        fields.append((name, '<f4'))
+    return np.dtype(fields)
+
+
+class TimeSeries(object):
+    """
+    This class holds the memory mapped ring of check results.
+
+    The controller creates the TimeSeries with the check names and appends a record per frame. A reader opens the
+    file with open_timeseries and queries the records.
+    """
+
+    def __init__(self, file, names=None, capacity=100000):
+        """
+        Constructor
+
+        If the file exists and has the same check names and capacity, the records are kept and appending continues.
+        Otherwise the file is created. If names are not given, the file is opened for reading.
+
+        Parameters
+        ----------
+        file : str
+            file name
+        names : list
+            check names, a column for each
+        capacity : int
+            number of records in the ring
+        """
+        self.file = file
+        self.lock = threading.Lock()
+        if names is not None:
+            names = list(names)
+            if not self.matches(file, names, int(capacity)):
+                self.create(file, names, int(capacity))
+        self.open(file, names is not None)
+
+
+    @staticmethod
+    def matches(file, names, capacity):
+        try:
+            header = np.memmap(file, dtype=np.uint8, mode='r', shape=(HEADER_SIZE,))
+        except (OSError, ValueError):
+            return False
+        descr = read_descr(header)
+        return descr is not None and descr['names'] == names and int(header[CAPACITY:WRITTEN].view('<u8')[0]) == \
+            capacity and os.path.getsize(file) == HEADER_SIZE + capacity * record_dtype(names).itemsize
+
+
+    @staticmethod
+    def create(file, names, capacity):
+        descr = json.dumps({'names': names}).encode('utf-8')
+        if DESCR + len(descr) > HEADER_SIZE:
+            raise ValueError('too many check names for the time series header')
+        header = np.zeros(HEADER_SIZE, dtype=np.uint8)
+        header[:CAPACITY] = np.frombuffer(MAGIC, dtype=np.uint8)
+        header[CAPACITY:WRITTEN].view('<u8')[0] = capacity
+        header[DESCR_SIZE:DESCR].view('<u8')[0] = len(descr)
+        header[DESCR:DESCR + len(descr)] = np.frombuffer(descr, dtype=np.uint8)
+        with open(file, 'wb') as f:
+            f.write(header.tobytes())
+            f.truncate(HEADER_SIZE + capacity * record_dtype(names).itemsize)
+
+
+    def open(self, file, writable):
+        mode = 'r+' if writable else 'r'
+        header = np.memmap(file, dtype=np.uint8, mode=mode, shape=(HEADER_SIZE,))
+        descr = read_descr(header)
+        if descr is None:
+            raise ValueError(file + ' is not a time series file')
+        self.names = descr['names']
+        self.dtype = record_dtype(self.names)
+        self.capacity = int(header[CAPACITY:WRITTEN].view('<u8')[0])
+        self.header = header
+        self.written = header[WRITTEN:DESCR_SIZE].view('<u8')
+        self.records = np.memmap(file, dtype=self.dtype, mode=mode, offset=HEADER_SIZE, shape=(self.capacity,))
+        # record assembled before it is copied into the ring
+        self.record = np.zeros(1, dtype=self.dtype)
+
+
+    def append(self, data, results):
+        """
+        This function appends record with the check results of a frame.
+
+        It is called by the monitor for each frame. The checks that are not in the results are stored with
+        evaluation -1 and NaN result.
+
+        Parameters
+        ----------
+        data : Data
+            data instance of the frame
+        results : dict
+            dictionary with check id key and tuple of evaluation and calculated result
+
+        Returns
+        -------
+        nothing
+        """
+        record = self.record
+        with self.lock:
+            record['counter'] = data.counter
+            record['time'] = time.time()
+            record['acq_time'] = data.acq_time if data.acq_time is not None else np.nan
+            for name in self.names:
+                eval, res = results.get(name, (-1, np.nan))
+                record[name + '_eval'] = eval
+                record[name] = res
+            written = int(self.written[0])
+            self.records[written % self.capacity] = record[0]
+            # the count is updated after the record, so the reader does not take a partly written record
+            self.written[0] = written + 1
+
+
+    def snapshot(self):
+        """
+        This function returns copy of the records in the ring, the oldest first.
+
+        The records overwritten by the writer during the copy are left out, including the record that may be being
+        written.
+        """
+        written = int(self.written[0])
+        first = max(written - self.capacity, 0)
+        start = first % self.capacity
+        records = np.concatenate((self.records[start:], self.records[:start])) if written > self.capacity \
+            else np.array(self.records[:written])
+        # the writer may have wrapped over the oldest records while they were copied
+        overwritten = int(self.written[0]) + 1 - self.capacity - first
+        if overwritten > 0:
+            records = records[overwritten:]
+        return records
+
+
+    def query(self, counters=None, times=None):
+        """
+        This function returns the records with counter or time in the given range.
+
+        Parameters
+        ----------
+        counters : tuple
+            first and last counter, inclusive
+        times : tuple
+            start and end time in seconds since epoch, inclusive
+
+        Returns
+        -------
+        records : ndarray
+            structured array of the records, the oldest first
+        """
+        records = self.snapshot()
+        selected = np.ones(len(records), dtype=bool)
+        if counters is not None:
+            selected &= (records['counter'] >= counters[0]) & (records['counter'] <= counters[1])
+        if times is not None:
+            selected &= (records['time'] >= times[0]) & (records['time'] <= times[1])
+        return records[selected]
+
+
+    def flush(self):
+        self.records.flush()
+        self.header.flush()
+
+
+def read_descr(header):
+    if bytes(header[:CAPACITY]) != MAGIC:
+        return None
+    size = int(header[DESCR_SIZE:DESCR].view('<u8')[0])
+    return json.loads(bytes(header[DESCR:DESCR + size]).decode('utf-8'))
+
+
+def open_timeseries(file):
+    """
+    This function opens time series file for reading, while the controller may be writing it.
+
+    Parameters
+    ----------
+    file : str
+        file name
+
+    Returns
+    -------
+    timeseries : TimeSeries
+        the opened time series
+    """
+    return TimeSeries(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query check results time series.')
+    parser.add_argument('file', help='time series file')
+    parser.add_argument('--counter', type=int, nargs=2, help='first and last frame counter')
+    parser.add_argument('--time', type=float, nargs=2, help='start and end time in seconds since epoch')
+    parser.add_argument('--last', type=float, help='seconds before now')
+    args = parser.parse_args()
+
+    ts = open_timeseries(args.file)
+    times = tuple(args.time) if args.time else None
+    if args.last is not None:
+        times = (time.time() - args.last, time.time())
+    records = ts.query(args.counter, times)
+    print (' '.join(records.dtype.names))
+    for record in records:
+        print (' '.join(str(value) for value in record))
+    print ('records', len(records), 'of', min(int(ts.written[0]), ts.capacity), 'in ring')
+
+
+if __name__ == '__main__':
+    main()
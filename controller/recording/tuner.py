@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module tunes the check bounds offline on recorded frames.
+
+The frames are read through a memory map of npy file holding 3D array of frames. The frames recorded by the Recorder
+are first stacked into such file by load_recording, which also returns the recorded acquire time and time of each
+frame. In the first pass the statistic of each check is computed once per frame, in parallel on all cores:
+
+- intensity rate, the masked sum of the frame divided by acquire time,
+- the number of pixels with rate over each candidate pixel rate bound, exact for the candidates,
+- the maximum and minimum ROI rate.
+
+In the second pass a grid of candidate bounds is swept on the statistics. A check raises event when its result is
+below the low threshold or limit, or above the high threshold or limit, as in controller.monitoring.checks. The
+events that would be adjusted are counted with the responder delay: after an adjustment the events of the check are
+ignored for 'adjust_time' seconds.
+
+Usage: python -m controller.recording.tuner frames.npy config/bounds.json --acq-time 0.1 --period 0.1
+       python -m controller.recording.tuner recording_dir config/bounds.json
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import numpy as np
+import controller.monitoring.masks as msk
+import controller.monitoring.roi as roi
+import controller.recording.recorder as rc
+import controller.utilities.plan as pl
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['load_recording',
+           'frame_statistics',
+           'sweep',
+           'count_adjustments',
+           'tune']
+
+
+# state of a worker process, set by init_worker
+worker = {}
+
+
+def load_recording(dir, frames_file, shape=None):
+    """
+    This function stacks the frames recorded by the Recorder into npy file, so the workers can map it, and returns the
+    recorded acquire time and time of each frame.
+
+    The shards are read one at a time, so the recording does not have to fit in memory. The frames of other shape
+    than the tuned one are skipped. The Recorder should record with policy 'all', otherwise the statistics are
+    biased towards the recorded frames.
+
+    Parameters
+    ----------
+    dir : str
+        directory with the shards written by the Recorder
+    frames_file : str
+        npy file the frames are written to
+    shape : tuple
+        shape of the tuned frames, the shape of the first recorded frame if None
+
+    Returns
+    -------
+    acq_times : ndarray
+        acquire time of each frame, nan for a frame recorded without acquire time
+    times : ndarray
+        time of each frame in seconds
+    """
+    names = sorted(glob.glob(os.path.join(dir, 'shard_*.npz')) + glob.glob(os.path.join(dir, 'shard_*.h5')))
+    selected = []
+    for name in names:
+        shard = rc.load_shard(name, ('frame_shape', 'frame_acq_time', 'frame_time'))
+        if 'frame_shape' not in shard:
+            continue
+        frame_shape = tuple(int(n) for n in shard['frame_shape'])
+        if shape is None:
+            shape = frame_shape
+        if frame_shape == tuple(shape):
+            selected.append((name, shard))
+    if len(selected) == 0:
+        raise ValueError('no frames recorded in ' + dir)
+    acq_times = np.concatenate([shard['frame_acq_time'] for name, shard in selected])
+    times = np.concatenate([shard['frame_time'] for name, shard in selected])
+
+    stack = None
+    start = 0
+    for name, shard in selected:
+        frames = rc.load_shard(name, ('frames',))['frames']
+        if stack is None:
+            stack = np.lib.format.open_memmap(frames_file, mode='w+', dtype=frames.dtype,
+                                              shape=(len(acq_times),) + tuple(shape))
+        stack[start:start + len(frames)] = frames
+        start += len(frames)
+    stack.flush()
+    del stack
+    return acq_times, times
+
+
+def init_worker(frames_file, acq_times, mask, pix_grid, rois):
+    # each process maps the frames file, the frames are read by the page cache and not copied between processes
+    worker['frames'] = np.load(frames_file, mmap_mode='r')
+    worker['acq_times'] = acq_times
+    worker['mask'] = mask
+    worker['pix_grid'] = pix_grid
+    worker['rois'] = rois
+
+
+def chunk_statistics(chunk):
+    """
+    This function computes the check statistics of frames from start to end index in the worker process.
+    """
+    start, end = chunk
+    frames = np.asarray(worker['frames'][start:end])
+    acq_times = worker['acq_times'][start:end]
+    pix_grid = worker['pix_grid']
+    index = worker['mask'].for_shape(frames.shape[1:]) if worker['mask'] is not None else None
+
+    intensity = msk.masked_sum_batch(frames, index) / acq_times
+    over = np.empty((len(frames), len(pix_grid)), dtype=np.int64)
+    for i in range(len(frames)):
+        # bin of each pixel is the number of candidates below the pixel rate, so the pixel is over candidate j
+        # if its bin is greater than j
+        bins = np.searchsorted(pix_grid, frames[i].ravel() / acq_times[i], side='left')
+        counts = np.bincount(bins, minlength=len(pix_grid) + 1)
+        if index is not None:
+            counts -= np.bincount(bins[index], minlength=len(pix_grid) + 1)
+        over[i] = counts[::-1].cumsum()[::-1][1:]
+    roi_max = roi_min = None
+    if worker['rois'] is not None:
+        rates = worker['rois'].sums(frames, index) / acq_times[:, None]
+        roi_max = rates.max(axis=1)
+        roi_min = rates.min(axis=1)
+    return intensity, over, roi_max, roi_min
+
+
+def frame_statistics(frames_file, acq_times, pix_grid, mask=None, rois=None, chunk=64, processes=None):
+    """
+    This function computes the check statistics of every frame in parallel.
+
+    Parameters
+    ----------
+    frames_file : str
+        npy file with 3D array of frames
+    acq_times : ndarray
+        acquire time of each frame
+    pix_grid : ndarray
+        sorted candidate pixel rate bounds
+    mask : Mask
+        mask of excluded pixels, or None
+    rois : RoiSet
+        ROIs of the ROI check, or None
+    chunk : int
+        number of frames processed by a worker at once
+    processes : int
+        number of worker processes, all cores if None
+
+    Returns
+    -------
+    stats : dict
+        'intensity_rate' array, 'pix_over' 2D array of pixel counts over each pixel rate candidate, and 'roi_max',
+        'roi_min' arrays if rois are given
+    """
+    no_frames = len(np.load(frames_file, mmap_mode='r'))
+    chunks = [(start, min(start + chunk, no_frames)) for start in range(0, no_frames, chunk)]
+    pool = multiprocessing.Pool(processes, init_worker, (frames_file, acq_times, mask, pix_grid, rois))
+    try:
+        parts = pool.map(chunk_statistics, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    stats = {'intensity_rate': np.concatenate([p[0] for p in parts]),
+             'pix_over': np.concatenate([p[1] for p in parts])}
+    if rois is not None:
+        stats['roi_max'] = np.concatenate([p[2] for p in parts])
+        stats['roi_min'] = np.concatenate([p[3] for p in parts])
+    return stats
+
+
+def sweep(low_values, high_values, lows, highs):
+    """
+    This function counts for every pair of candidate low and high bound the frames with event.
+
+    A frame has event if its low value is below the low bound, or its high value is above the high bound. For a
+    check with one result per frame both values are the result; for the ROI check they are the minimum and the
+    maximum ROI result.
+
+    Parameters
+    ----------
+    low_values : ndarray
+        result compared with low bound for each frame
+    high_values : ndarray
+        result compared with high bound for each frame
+    lows : ndarray
+        candidate low bounds
+    highs : ndarray
+        candidate high bounds
+
+    Returns
+    -------
+    events : ndarray
+        2D array of number of frames with event, indexed by low and high candidate
+    """
+    below = np.searchsorted(np.sort(low_values), lows, side='left')
+    above = len(high_values) - np.searchsorted(np.sort(high_values), highs, side='right')
+    both = np.array([np.count_nonzero((low_values < low)[:, None] & (high_values[:, None] > highs[None, :]),
+                                      axis=0) for low in lows])
+    return below[:, None] + above[None, :] - both
+
+
+def count_adjustments(event_times, adjust_time):
+    """
+    This function counts the events the responder adjusts. After an adjustment the events are ignored for
+    adjust_time seconds.
+    """
+    count = 0
+    i = 0
+    while i < len(event_times):
+        count += 1
+        i = np.searchsorted(event_times, event_times[i] + adjust_time, side='right')
+    return count
+
+
+def candidates(values, current, levels):
+    """
+    This function returns sorted candidate bounds: the quantiles of the values and the current bound.
+    """
+    values = values[np.isfinite(values)]
+    grid = np.quantile(values, np.linspace(0, 1, levels)) if len(values) > 0 else np.array([])
+    if np.isfinite(current):
+        grid = np.append(grid, current)
+    return np.unique(grid)
+
+
+def effective(bounds):
+    # an event is raised below the higher of the low threshold and low limit, and above the lower of the high ones
+    return max(bounds.low_threshold, bounds.low_limit), min(bounds.high_threshold, bounds.high_limit)
+
+
+def tune_check(name, low_values, high_values, bounds, times, adjust_time, levels, fixed_events=None):
+    """
+    This function sweeps the low and high threshold of a check, keeping the limits, and returns the report.
+    """
+    low, high = effective(bounds)
+    lows = np.append(candidates(low_values, bounds.low_threshold, levels), -np.inf)
+    highs = np.append(candidates(high_values, bounds.high_threshold, levels), np.inf)
+    # the limits still apply to every candidate threshold
+    lows_eff = np.maximum(lows, bounds.low_limit)
+    highs_eff = np.minimum(highs, bounds.high_limit)
+    events = sweep(low_values, high_values, lows_eff, highs_eff)
+    adjustments = np.zeros_like(events)
+    for i in range(len(lows)):
+        for j in range(len(highs)):
+            eventful = (low_values < lows_eff[i]) | (high_values > highs_eff[j])
+            if fixed_events is not None:
+                eventful |= fixed_events
+            adjustments[i, j] = count_adjustments(times[eventful], adjust_time)
+            if fixed_events is not None:
+                events[i, j] = np.count_nonzero(eventful)
+    current = (low_values < low) | (high_values > high)
+    if fixed_events is not None:
+        current |= fixed_events
+    return {'check': name,
+            'low_threshold': lows,
+            'high_threshold': highs,
+            'events': events,
+            'adjustments': adjustments,
+            'current_events': int(np.count_nonzero(current)),
+            'current_adjustments': count_adjustments(times[current], adjust_time)}
+
+
+def tune(frames_file, bounds, acq_times, period, adjust_time=5.0, mask=None, levels=20, processes=None, times=None):
+    """
+    This function computes the statistics of the recorded frames and sweeps the bounds of each configured check.
+
+    Parameters
+    ----------
+    frames_file : str
+        npy file with 3D array of frames
+    bounds : dict
+        bounds dictionary, as in bounds.json
+    acq_times : ndarray
+        acquire time of each frame
+    period : float
+        time between frames in seconds
+    adjust_time : float
+        responder delay after adjustment in seconds
+    mask : Mask
+        mask of excluded pixels, or None
+    levels : int
+        number of candidate values of each bound
+    processes : int
+        number of worker processes, all cores if None
+    times : ndarray
+        time of each frame in seconds, such as recorded by the Recorder; if None, the frames are period apart
+
+    Returns
+    -------
+    reports : list
+        report of each check, with candidate low and high thresholds and 2D arrays of events and adjustments
+    """
+    pix = pl.compile_bounds(bounds[pl.PIX_BOUNDS]) if pl.PIX_BOUNDS in bounds else None
+    rois = roi.compile_rois(bounds['roi_intensity_rate']) if 'roi_intensity_rate' in bounds else None
+    no_frames = len(acq_times)
+    times = np.arange(no_frames) * period if times is None else np.asarray(times, dtype=np.float64)
+
+    # the Npix checks compare counts over the configured pixel limits, and the target is swept
+    pix_fixed = []
+    if pix is not None:
+        pix_fixed = [v for v in (pix.high_limit, pix.low_limit, pix.target) if v is not None and np.isfinite(v)]
+    sample = np.load(frames_file, mmap_mode='r')
+    peak = float(np.max(sample[::max(no_frames // 16, 1)])) / float(np.min(acq_times))
+    pix_targets = np.geomspace(max(peak / 1.0e4, 1.0), max(peak, 2.0), levels)
+    pix_grid = np.unique(np.concatenate((pix_targets, pix_fixed)))
+    stats = frame_statistics(frames_file, acq_times, pix_grid, mask, rois, processes=processes)
+
+    reports = []
+    if 'intensity_rate' in bounds:
+        res = stats['intensity_rate']
+        reports.append(tune_check('intensity_rate', res, res, pl.compile_bounds(bounds['intensity_rate']), times,
+                                  adjust_time, levels))
+    if rois is not None:
+        reports.append(tune_check('roi_intensity_rate', stats['roi_min'], stats['roi_max'],
+                                  pl.compile_bounds(bounds['roi_intensity_rate']), times, adjust_time, levels))
+    for name, limit in (('Npix_oversat_cnt_rate', 'high_limit'), ('Npix_undersat_cnt_rate', 'low_limit')):
+        if name not in bounds or pix is None:
+            continue
+        check_bounds = pl.compile_bounds(bounds[name])
+        # frames over the count limits, for count of pixels over the pixel limit, have event for every candidate
+        limit_counts = stats['pix_over'][:, np.searchsorted(pix_grid, getattr(pix, limit))]
+        limited = (limit_counts < check_bounds.low_limit) | (limit_counts > check_bounds.high_limit)
+        if pix.target is not None:
+            # the thresholds are swept on the count of pixels over the pixel target, for frames within limits
+            counts = stats['pix_over'][:, np.searchsorted(pix_grid, pix.target)].astype(np.float64)
+            counts[limited] = np.nan
+            report = tune_check(name, counts, counts, check_bounds._replace(low_limit=-np.inf, high_limit=np.inf),
+                                times, adjust_time, levels, limited)
+            report['pix_target'] = pix.target
+            reports.append(report)
+        # the pixel target sweep, with the current thresholds
+        sweep_events = []
+        for j in range(len(pix_grid)):
+            counts = stats['pix_over'][:, j]
+            eventful = limited | (counts < check_bounds.low_threshold) | (counts > check_bounds.high_threshold)
+            sweep_events.append(int(np.count_nonzero(eventful)))
+        reports.append({'check': name, 'pix_target': pix_grid, 'pix_target_events': np.array(sweep_events)})
+    return reports
+
+
+def print_report(report, frames):
+    if 'events' not in report:
+        print ('%s: events for pixel rate target' % report['check'])
+        for target, events in zip(report['pix_target'], report['pix_target_events']):
+            print ('    %14.6g %8d' % (target, events))
+        return
+    print ('%s: %d frames, current bounds give %d events and %d adjustments' %
+           (report['check'], frames, report['current_events'], report['current_adjustments']))
+    # the sweep of the high threshold with the low threshold disabled, and of the low with high disabled
+    print ('    %14s %8s %8s' % ('high_threshold', 'events', 'adjusts'))
+    for j, high in enumerate(report['high_threshold']):
+        print ('    %14.6g %8d %8d' % (high, report['events'][-1, j], report['adjustments'][-1, j]))
+    print ('    %14s %8s %8s' % ('low_threshold', 'events', 'adjusts'))
+    for i, low in enumerate(report['low_threshold']):
+        print ('    %14.6g %8d %8d' % (low, report['events'][i, -1], report['adjustments'][i, -1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep check bounds on recorded frames.')
+    parser.add_argument('frames', help='npy file with 3D array of frames, or directory with recorder shards')
+    parser.add_argument('bounds', help='bounds json file')
+    parser.add_argument('--acq-time', help='acquire time, or npy file with acquire time of each frame; defaults to '
+                                           'the recorded acquire time')
+    parser.add_argument('--period', type=float, default=None, help='time between frames, defaults to acquire time; '
+                                                                   'recorded frames use the recorded time')
+    parser.add_argument('--stack', help='npy file the recorded frames are stacked into, defaults to frames.npy in '
+                                        'the recording directory')
+    parser.add_argument('--adjust-time', type=float, default=5.0, help='responder delay after adjustment')
+    parser.add_argument('--mask', help='mask file')
+    parser.add_argument('--levels', type=int, default=20, help='number of candidates of each bound')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, all cores by default')
+    parser.add_argument('--output', help='npz file where the sweep arrays are saved')
+    args = parser.parse_args()
+
+    frames_file = args.frames
+    recorded = times = None
+    if os.path.isdir(args.frames):
+        frames_file = args.stack if args.stack else os.path.join(args.frames, 'frames.npy')
+        recorded, times = load_recording(args.frames, frames_file)
+        times = times - times[0]
+    no_frames = len(np.load(frames_file, mmap_mode='r'))
+    if args.acq_time is None:
+        if recorded is None or not np.all(np.isfinite(recorded)):
+            parser.error('--acq-time is required for frames without recorded acquire time')
+        acq_times = recorded
+    else:
+        try:
+            acq_times = np.full(no_frames, float(args.acq_time))
+        except ValueError:
+            acq_times = np.load(args.acq_time).astype(np.float64)
+    period = args.period if args.period is not None else float(np.mean(acq_times))
+    with open(args.bounds) as file:
+        bounds = json.loads(file.read())
+    mask = msk.load_mask(args.mask) if args.mask else None
+
+    reports = tune(frames_file, bounds, acq_times, period, args.adjust_time, mask, args.levels, args.processes,
+                   times)
+    for report in reports:
+        print_report(report, no_frames)
+    if args.output:
+        arrays = {}
+        for i, report in enumerate(reports):
+            for key in report:
+                arrays['%d_%s' % (i, key)] = np.asarray(report[key])
+        np.savez(args.output, **arrays)
+
+
+if __name__ == '__main__':
+    main()
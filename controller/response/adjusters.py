@@ -5,8 +5,9 @@
 This file is a suite of control functions.
 """
 
-from epics import caput
 import math
+import time
+import controller.utilities.metrics as mt
 
 
 __author__ = "Barbara Frosik"
@@ -16,9 +17,36 @@ __all__ = [
            'intensity_rate_adj',
            'Npix_oversat_cnt_rate_adj',
            'Npix_undersat_cnt_rate_adj',
+           'roi_intensity_rate_adj',
            'adjust']
 
 
+# the largest factor the Npix adjusters change the acquire time by in one adjustment
+MAX_STEP = 10.0
+# the Npix adjusters do not adjust when the log of the count to target ratio is closer to zero
+MIN_ADJUST = 0.01
+
+
+def caput(pvname, value, **kws):
+    """
+    This function writes the pv with pyepics caput. The pyepics is imported at the first write and the function is
+    replaced with the pyepics caput, so the channel access is not loaded until an adjustment is made.
+    """
+    global caput
+    from epics import caput
+    return caput(pvname, value, **kws)
+
+
+def limit_step(acq_time, new_acq_time):
+    """
+    This function limits the change of acquire time to MAX_STEP times either way. It returns None if the new acquire
+    time is not a positive number.
+    """
+    if not new_acq_time > 0:
+        return None
+    return min(max(new_acq_time, acq_time / MAX_STEP), acq_time * MAX_STEP)
+
+
 def intensity_rate_adj(**kws):
     """
     This method adjusts pv that affects intensity od data.
@@ -27,15 +55,16 @@ def intensity_rate_adj(**kws):
     ----------
     event : Event
         Event instance containing result value, and tuple with acquire time pv name and value
-    bounds : dict
-        dictionary of bounds, including target value
+    bounds : Bounds
+        compiled bounds, including target value
 
     Returns
     -------
-    nothing
+    put : tuple
+        the written pv name and value
     """
     bounds = kws['bounds']
-    target = bounds['target']
+    target = bounds.target
     # Event instance for this adjuster contains result and a tuple with acquire time pv name and value
     event = kws['event']
     res = event.result
@@ -44,6 +73,7 @@ def intensity_rate_adj(**kws):
     # the rate (intensity sum/acq_time) should be adjusted towards target by changing acq_time
     new_ack_time = res / target * acq_time_pair[1]
     caput(acq_time_pair[0], new_ack_time)
+    return acq_time_pair[0], new_ack_time
 
 
 def Npix_oversat_cnt_rate_adj(**kws):
@@ -54,24 +84,36 @@ def Npix_oversat_cnt_rate_adj(**kws):
     ----------
     event : Event
         Event instance containing rate value, and tuple with acquire time pv name and value
-    bounds : dict
-        dictionary of bounds, including target
+    bounds : Bounds
+        compiled bounds, including target
     Returns
     -------
-    nothing
+    put : tuple
+        the written pv name and value, or None if not adjusted
     """
     bounds = kws['bounds']
-    target = bounds['target']
+    target = bounds.target
     event = kws['event']
     points_over_threshold = event.points_over_threshold
     acq_time_pair = event.acq_time
 
+    # no saturated point does not tell how to change the acquire time
+    if points_over_threshold <= 0 or target is None or target <= 0:
+        print ('not adjusted, points over threshold', points_over_threshold, 'target', target)
+        return None
     # Too many points over saturation threshold
     adjust = math.log(points_over_threshold/target)
-
-    new_ack_time = acq_time_pair[1] / adjust
+    if abs(adjust) < MIN_ADJUST:
+        print ('not adjusted, points over threshold', points_over_threshold, 'at target', target)
+        return None
+
+    new_ack_time = limit_step(acq_time_pair[1], acq_time_pair[1] / adjust)
+    if new_ack_time is None:
+        print ('not adjusted, points over threshold', points_over_threshold, 'target', target)
+        return None
     print ('old acq_time, new_acq_time', acq_time_pair[1], new_ack_time)
     caput(acq_time_pair[0], new_ack_time)
+    return acq_time_pair[0], new_ack_time
 
 
 def Npix_undersat_cnt_rate_adj(**kws):
@@ -82,51 +124,101 @@ def Npix_undersat_cnt_rate_adj(**kws):
     ----------
     event : Event
         Event instance containing rate value, and tuple with acquire time pv name and value
-    bounds : dict
-        dictionary of bounds, including target
+    bounds : Bounds
+        compiled bounds, including target
     Returns
     -------
-    nothing
+    put : tuple
+        the written pv name and value, or None if not adjusted
     """
     bounds = kws['bounds']
-    target = bounds['target']
+    target = bounds.target
     event = kws['event']
     points_over_threshold = event.points_over_threshold
     acq_time_pair = event.acq_time
 
-    # Too little points over saturation threshold
-    adjust = math.log(target/points_over_threshold)
-
-    new_ack_time = acq_time_pair[1] / adjust
+    if target is None or target <= 0:
+        print ('not adjusted, target', target)
+        return None
+    if points_over_threshold <= 0:
+        # no point over the threshold, the acquire time is increased by the largest step
+        new_ack_time = acq_time_pair[1] * MAX_STEP
+    else:
+        # Too little points over saturation threshold
+        adjust = math.log(target/points_over_threshold)
+        if abs(adjust) < MIN_ADJUST:
+            print ('not adjusted, points over threshold', points_over_threshold, 'at target', target)
+            return None
+        new_ack_time = limit_step(acq_time_pair[1], acq_time_pair[1] / adjust)
+        if new_ack_time is None:
+            print ('not adjusted, points over threshold', points_over_threshold, 'target', target)
+            return None
     print ('old acq_time, new_acq_time', acq_time_pair[1], new_ack_time)
     caput(acq_time_pair[0], new_ack_time)
+    return acq_time_pair[0], new_ack_time
 
 
 
-# maps the adjuster ID to the function object
-function_mapper = {
-                   'intensity_rate': intensity_rate_adj,
-                   'Npix_oversat_cnt_rate': Npix_oversat_cnt_rate_adj,
-                   'Npix_undersat_cnt_rate': Npix_undersat_cnt_rate_adj,
-                  }
+def roi_intensity_rate_adj(**kws):
+    """
+    This method adjusts pv that affects intensity of data, driven by the ROI that raised the event.
 
-def adjust(events, bounds):
+    Parameters
+    ----------
+    event : Event
+        Event instance containing result value of the ROI, results of all ROIs, and tuple with acquire time pv name
+        and value
+    bounds : Bounds
+        compiled bounds, including target value
+
+    Returns
+    -------
+    put : tuple
+        the written pv name and value
     """
-    This function runs validation methods applicable to the frame data type and enqueues results.
-    This function calls all the quality checks and creates Results object that holds results of each quality check, and
-    attributes, such data type, index, and status. This object is then enqueued into the "resultsq" queue.
+    bounds = kws['bounds']
+    target = bounds.target
+    event = kws['event']
+    res = event.result
+    acq_time_pair = event.acq_time
+
+    # the rate of the ROI should be adjusted towards target by changing acq_time, as for the whole frame
+    new_ack_time = res / target * acq_time_pair[1]
+    print ('ROI', event.roi, 'old acq_time, new_acq_time', acq_time_pair[1], new_ack_time)
+    caput(acq_time_pair[0], new_ack_time)
+    return acq_time_pair[0], new_ack_time
+
+
+def adjust(events, plan):
+    """
+    This function runs adjuster functions corresponding to the events.
+
     Parameters
     ----------
     events : dict
         dictionary with the key of check function name, and value of tuple containing event and result
-    bounds : dictionary
-        a dictionary containing target values for the checks
+    plan : Plan
+        compiled control plan containing the adjusters and target values for the checks
     Returns
     -------
-    events : dict
+    puts : list
+        list of (pv name, value, counter) tuples written by the adjusters, the counter is the counter of the frame that
+        raised the event
 
     """
 
+    puts = []
     for ev in events:
-        function = function_mapper[ev]
-        function(event=events[ev], bounds=bounds)
+        # the event may come from a check removed by the plan reload
+        ck = plan.by_name.get(ev)
+        if ck is None:
+            print ('event', ev, 'not adjusted, the check is not in plan version', plan.version)
+        elif ck.adjuster is not None:
+            start = time.time()
+            put = ck.adjuster(event=events[ev], bounds=ck.bounds)
+            # an adjuster that writes no pv returns None
+            if put is not None:
+                puts.append(tuple(put) + (events[ev].counter,))
+            mt.PUT_SECONDS.observe(time.time() - start)
+            mt.ADJUSTMENTS.labels(ev).inc()
+    return puts
@@ -5,24 +5,27 @@
 responder receives event in update function, and runs corresponding adjusters.
 """
 
-import json
 import time
 from controller.utilities.utils import Observer
 import controller.response.adjusters as aj
+import controller.utilities.plan as pl
+import controller.utilities.memory as mem
 
 
 class Responder(Observer):
-    def __init__(self, config):
+    def __init__(self, config, plan=None):
         """
         constructor
         """
-        with open(config['bounds']) as file:
-            self.bounds = json.loads(file.read())
+        # the plan can be replaced by PlanWatcher at any time
+        self.plan = plan if plan is not None else pl.compile_plan(config)
         self.adjust_time = float(config['adjust_time'])
         # adjusted dictionary holds events that happend no longer than adjust_time
         # during the adjustment time the events are ignored to allow the control loop delay
         # the dictionary values are the time the delay will expire expire
         self.adjusted = {}
+        # optional Recorder receiving the pv writes
+        self.recorder = None
 
 
     def include_delay(self, events):
@@ -44,7 +47,7 @@ class Responder(Observer):
         """
 
         now = time.time()
-        for ev in self.adjusted:
+        for ev in list(self.adjusted):
             if self.adjusted[ev] < now:
                 self.adjusted.pop(ev)
         new_events = {}
@@ -65,7 +68,11 @@ class Responder(Observer):
         print ('events1',events)
         print(events, type(events))
         events = self.include_delay(events)
-        aj.adjust(events, self.bounds)
+        with mem.stage('adjust'):
+            puts = aj.adjust(events, self.plan)
+        if self.recorder is not None:
+            for pvname, value, counter in puts:
+                self.recorder.record_put(pvname, value, counter)
 
 
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module runs the controller in a closed loop with simulated detector, and reports how many frames it takes to
+converge and the loop throughput.
+
+The controller converges when the configured bounds can be reached by the acquire time. The configuration in
+config/sim sets the intensity rate bounds the simulated detector reaches when its spot saturates:
+
+    python -m controller.simulation.benchmark config/sim/cntl_conf --frames 400 --period 0.02
+
+The command exits with status 1 if the controller did not converge.
+"""
+
+import argparse
+import json
+import sys
+import time
+from configobj import ConfigObj
+import controller.simulation.detector as sd
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['benchmark']
+
+
+class Tracker(object):
+    """
+    This class delivers data to the monitor and records for every frame whether events were found.
+    """
+
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.eventful = []
+        self.start = None
+        self.end = None
+
+
+    def process_data(self, data):
+        if self.start is None:
+            self.start = time.time()
+        events = self.monitor.process_data(data)
+        self.eventful.append(events is not None)
+        self.end = time.time()
+
+
+    def process_batch(self, data):
+        if self.start is None:
+            self.start = time.time()
+        events = self.monitor.process_batch(data)
+        self.eventful.extend(ev is not None for ev in events)
+        self.end = time.time()
+
+
+    def feed_event(self, event_str, stats):
+        self.monitor.feed_event(event_str, stats)
+
+
+    def frames_to_convergence(self, settle):
+        """
+        This function returns number of frames processed before the first run of 'settle' frames without events.
+        """
+        quiet = 0
+        for i, eventful in enumerate(self.eventful):
+            quiet = 0 if eventful else quiet + 1
+            if quiet == settle:
+                return i + 1 - settle
+        return None
+
+
+def benchmark(conf, no_frames=200, settle=10, timeout=600, **sim_args):
+    """
+    This function runs the controller with simulated detector and returns the benchmark results.
+
+    Parameters
+    ----------
+    conf : str
+        name of the controller configuration file
+    no_frames : int
+        number of frames the detector acquires
+    settle : int
+        number of consecutive frames without events that counts as converged
+    timeout : float
+        maximum time in seconds to wait for the feed to finish
+    sim_args : dict
+        keyword arguments passed to SimDetector
+
+    Returns
+    -------
+    results : dict
+        frames generated and processed, frames to convergence, whether the controller converged, number of
+        adjustments, throughput in frames per second, and final acquire time
+    """
+    config = ConfigObj(conf)
+    ca = sd.SimChannelAccess()
+    sd.install(ca)
+    # imported after install, so the modules bind the simulated channel access
+    import controller.feeds.pv_feed as pvf
+    import controller.monitoring.monitor as mon
+    import controller.response.responder as resp
+    import controller.utilities.plan as pl
+
+    with open(config['pvs']) as file:
+        acq_time_pv = json.loads(file.read())['acq_time']
+    detector = sd.SimDetector(ca, config['detector'], acq_time_pv=acq_time_pv, **sim_args)
+
+    plan = pl.compile_plan(config)
+    monitor = mon.Monitor(config, plan)
+    monitor.register(resp.Responder(config, plan))
+    tracker = Tracker(monitor)
+    feed = pvf.Feed(config, tracker)
+
+    detector.start(no_frames)
+    feed.feed_data()
+    detector.thread.join()
+    end = time.time() + timeout
+    while not getattr(feed, 'done', False) and time.time() < end:
+        time.sleep(.01)
+    for worker in feed.workers:
+        worker.join(max(end - time.time(), 0))
+    # let the responder threads complete
+    time.sleep(.1)
+
+    elapsed = (tracker.end - tracker.start) if tracker.start is not None else 0
+    processed = len(tracker.eventful)
+    converged = tracker.frames_to_convergence(settle)
+    return {'frames_generated': detector.counter,
+            'frames_missing': feed.stats.missing,
+            'frames_processed': processed,
+            'frames_to_convergence': converged,
+            'converged': converged is not None,
+            'adjustments': len([put for put in ca.puts if put[1] == acq_time_pv]),
+            'throughput': processed / elapsed if elapsed > 0 else None,
+            'final_acq_time': detector.acq_time()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark controller convergence with simulated detector.')
+    parser.add_argument('conf', help='controller configuration file')
+    parser.add_argument('--frames', type=int, default=200, help='number of frames to acquire')
+    parser.add_argument('--settle', type=int, default=10, help='frames without events counted as converged')
+    parser.add_argument('--shape', type=int, nargs=2, default=(512, 512), help='frame rows and columns')
+    parser.add_argument('--acq-time', type=float, default=0.1, help='initial acquire time')
+    parser.add_argument('--drift', type=float, default=0.0, help='relative flux drift per frame')
+    parser.add_argument('--period', type=float, default=None, help='frame period, defaults to acquire time')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    args = parser.parse_args()
+
+    results = benchmark(args.conf, args.frames, args.settle, shape=args.shape, acq_time=args.acq_time,
+                        drift=args.drift, frame_period=args.period, seed=args.seed)
+    for key in results:
+        print (key, results[key])
+    if not results['converged']:
+        print ('controller did not converge in', results['frames_processed'], 'frames')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
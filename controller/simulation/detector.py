@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module simulates area detector and channel access, so the controller can run in a closed loop without beamline.
+
+The SimDetector produces frames with Poisson noise, where the counts are proportional to the acquire time PV. The
+flux can drift between frames, and the pixels saturate at the configured count. The SimChannelAccess provides
+in-process caget, caput, and PV that are used in place of the pyepics functions.
+"""
+
+import sys
+import threading
+import time
+import types
+import numpy as np
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['SimChannelAccess',
+           'SimDetector',
+           'install']
+
+
+class SimChannelAccess(object):
+    """
+    This class holds simulated PVs and provides caget, caput, and PV with the pyepics signatures.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.values = {}
+        self.callbacks = {}
+        self.put_hooks = {}
+        self.lock = threading.Lock()
+        # every caput is recorded as (time, pv name, value)
+        self.puts = []
+        sim = self
+
+        class PV(object):
+            """
+            Simulated pyepics PV.
+            """
+            def __init__(self, pvname, callback=None, **kws):
+                self.pvname = pvname
+                self.connected = True
+                if callback is not None:
+                    self.add_callback(callback)
+
+            @property
+            def value(self):
+                return sim.caget(self.pvname)
+
+            def get(self, **kws):
+                return sim.caget(self.pvname)
+
+            def put(self, value, **kws):
+                sim.caput(self.pvname, value)
+
+            def add_callback(self, callback, index=None, **kws):
+                return sim.add_callback(self.pvname, callback, index)
+
+            def remove_callback(self, index):
+                sim.remove_callback(self.pvname, index)
+
+            def wait_for_connection(self, timeout=None):
+                return True
+
+            def disconnect(self):
+                sim.remove_callback(self.pvname)
+
+        self.PV = PV
+
+
+    def caget(self, pvname, **kws):
+        return self.values.get(pvname)
+
+
+    def caput(self, pvname, value, **kws):
+        with self.lock:
+            self.puts.append((time.time(), pvname, value))
+        hook = self.put_hooks.get(pvname)
+        if hook is not None:
+            value = hook(value)
+        self.set(pvname, value)
+        return 1
+
+
+    def set(self, pvname, value):
+        """
+        This function sets value of the PV and runs the PV callbacks, as the IOC would post a monitor.
+        """
+        self.values[pvname] = value
+        for callback in list(self.callbacks.get(pvname, {}).values()):
+            callback(pvname=pvname, value=value)
+
+
+    def add_callback(self, pvname, callback, index=None):
+        callbacks = self.callbacks.setdefault(pvname, {})
+        if index is None:
+            index = len(callbacks) + 1
+        callbacks[index] = callback
+        return index
+
+
+    def remove_callback(self, pvname, index=None):
+        if index is None:
+            self.callbacks.pop(pvname, None)
+        else:
+            self.callbacks.get(pvname, {}).pop(index, None)
+
+
+class SimDetector(object):
+    """
+    This class simulates area detector producing frames in a thread.
+
+    The photon flux per pixel is a gaussian spot on a flat background. A frame is a Poisson sample of the flux
+    multiplied by the current acquire time, clipped at the saturation count. The flux is multiplied by
+    (1 + drift) after each frame.
+    """
+
+    def __init__(self, ca, detector, acq_time_pv=None, shape=(512, 512), background=50.0, peak=1.0e6,
+                 sigma=20.0, drift=0.0, saturation=1048575, acq_time=0.1, frame_period=None, seed=None):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        ca : SimChannelAccess
+            simulated channel access holding the detector PVs
+        detector : str
+            detector name, the PV prefix
+        acq_time_pv : str
+            acquire time PV name, defaults to detector + ':cam1:AcquireTime'
+        shape : tuple
+            frame shape (rows, columns)
+        background : float
+            flat background flux in counts per second per pixel
+        peak : float
+            flux in the center of the spot in counts per second per pixel
+        sigma : float
+            width of the spot in pixels
+        drift : float
+            relative flux change per frame
+        saturation : int
+            pixel count at which the pixel saturates
+        acq_time : float
+            initial acquire time in seconds
+        frame_period : float
+            time between frames in seconds; if None the acquire time is used
+        seed : int
+            random generator seed
+        """
+        self.ca = ca
+        self.detector = detector
+        self.acq_time_pv = acq_time_pv or detector + ':cam1:AcquireTime'
+        self.shape = tuple(shape)
+        self.drift = drift
+        self.saturation = saturation
+        self.frame_period = frame_period
+        self.rng = np.random.default_rng(seed)
+
+        self.background = background
+        self.peak = peak
+        self.sigma = sigma
+        self.set_shape(self.shape)
+        self.flux_scale = 1.0
+        self.counter = 0
+        self.thread = None
+        self.done = threading.Event()
+
+        ca.set(self.acq_time_pv, acq_time)
+        ca.set(detector + ':cam1:ArrayCounter_RBV', 0)
+        ca.set(detector + ':cam1:Acquire', 0)
+        # a detector does not accept non positive acquire time
+        ca.put_hooks[self.acq_time_pv] = lambda value: max(float(value), 1.0e-6)
+
+
+    def set_shape(self, shape):
+        """
+        This function changes the frame shape, as changing the detector ROI or binning. The size PVs are posted
+        before the next frame.
+        """
+        self.shape = tuple(shape)
+        y, x = np.indices(self.shape)
+        cy, cx = self.shape[0] / 2.0, self.shape[1] / 2.0
+        self.flux = self.background + self.peak * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2.0 * self.sigma ** 2))
+        self.ca.set(self.detector + ':image1:ArraySize0_RBV', self.shape[1])
+        self.ca.set(self.detector + ':image1:ArraySize1_RBV', self.shape[0])
+
+
+    def acq_time(self):
+        return self.ca.caget(self.acq_time_pv)
+
+
+    def make_frame(self):
+        """
+        This function produces the next frame for the current acquire time and flux.
+        """
+        frame = self.rng.poisson(self.flux * (self.flux_scale * self.acq_time()))
+        np.minimum(frame, self.saturation, out=frame)
+        self.flux_scale *= 1.0 + self.drift
+        return frame.astype(np.uint32)
+
+
+    def acquire(self, no_frames):
+        self.ca.set(self.detector + ':cam1:Acquire', 1)
+        for i in range(no_frames):
+            if self.done.is_set():
+                break
+            start = time.time()
+            frame = self.make_frame()
+            self.ca.set(self.detector + ':image1:ArrayData', frame.ravel())
+            self.counter += 1
+            self.ca.set(self.detector + ':cam1:ArrayCounter_RBV', self.counter)
+            period = self.frame_period if self.frame_period is not None else self.acq_time()
+            wait = period - (time.time() - start)
+            if wait > 0:
+                time.sleep(wait)
+        self.ca.set(self.detector + ':cam1:Acquire', 0)
+
+
+    def start(self, no_frames):
+        """
+        This function starts acquisition of given number of frames in a thread.
+        """
+        self.done.clear()
+        self.thread = threading.Thread(target=self.acquire, args=(no_frames,), name='sim-detector')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def install(ca):
+    """
+    This function installs the simulated channel access in place of pyepics.
+
+    Modules 'epics' and 'epics.ca' are replaced in sys.modules, so the feed and adjusters modules imported afterwards
+    use the simulated functions. Already imported controller modules are patched.
+
+    Parameters
+    ----------
+    ca : SimChannelAccess
+        simulated channel access
+
+    Returns
+    -------
+    nothing
+    """
+    epics = types.ModuleType('epics')
+    epics.caget = ca.caget
+    epics.caput = ca.caput
+    epics.PV = ca.PV
+    epics_ca = types.ModuleType('epics.ca')
+    epics_ca.CAThread = threading.Thread
+    epics.ca = epics_ca
+    sys.modules['epics'] = epics
+    sys.modules['epics.ca'] = epics_ca
+
+    for name in ('controller.feeds.pv_feed', 'controller.response.adjusters'):
+        module = sys.modules.get(name)
+        if module is None:
+            continue
+        for attr in ('caget', 'caput', 'PV'):
+            if hasattr(module, attr):
+                setattr(module, attr, getattr(epics, attr))
+        if hasattr(module, 'CAThread'):
+            module.CAThread = threading.Thread
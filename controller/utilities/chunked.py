@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module holds compressed frames as chunks, so the frame reductions of the checks can be computed chunk by chunk.
+
+A compressed frame is split into chunks of consecutive pixels that are decompressed independently. The chunks are
+decompressed in parallel threads, and each decompressed chunk is reduced into the frame sum and threshold counts
+while it is in cache, so the whole decompressed frame is not written to and read back from memory. The whole frame
+is decompressed only when a consumer reads the frame array, such as the ROI check, the recorder, or the publisher.
+
+The codecs are:
+
+- 'bslz4', bitshuffle LZ4 stream as written by bitshuffle.compress_lz4 and the areaDetector codec; the chunks are
+  runs of the stream blocks, requires bitshuffle
+- 'lz4', the frame compressed as LZ4 blocks of chunk_size pixels, a single block for the areaDetector codec,
+  requires lz4
+
+The chunked reductions are compared with the reductions of the decompressed frame, and timed, with:
+
+    python -m controller.utilities.chunked --shape 2048 2048 --codec bslz4
+"""
+
+import argparse
+import os
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import controller.monitoring.kernels as kn
+
+try:
+    import bitshuffle
+except ImportError:
+    bitshuffle = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['ChunkedFrame',
+           'from_bslz4',
+           'from_lz4',
+           'from_header',
+           'compress']
+
+
+# uncompressed bytes of a chunk, the chunk and its reduction temporaries fit in the core cache
+CHUNK_BYTES = 256 * 1024
+
+# the threads decompressing the chunks, created with the first chunked frame
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='decompress')
+        return executor
+
+
+def bslz4_block_size(itemsize):
+    # the default block size of bitshuffle, in pixels
+    return max(128, (8192 // itemsize) // 8 * 8)
+
+
+class ChunkedFrame(object):
+    """
+    This class holds compressed frame as a list of chunks, each chunk is a tuple of the first pixel, number of
+    pixels, and offset and length of the compressed chunk in the buffer.
+    """
+
+    def __init__(self, codec, buffer, chunks, shape, dtype, block_size=0):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        codec : str
+            'bslz4' or 'lz4'
+        buffer : bytes
+            the compressed frame
+        chunks : list
+            tuples of the first pixel, number of pixels, compressed offset and length of each chunk
+        shape : tuple
+            frame shape
+        dtype : numpy.dtype
+            frame data type
+        block_size : int
+            bitshuffle block size in pixels
+        """
+        if codec == 'bslz4' and bitshuffle is None:
+            raise ValueError('codec bslz4 requires bitshuffle')
+        if codec == 'lz4' and lz4 is None:
+            raise ValueError('codec lz4 requires lz4')
+        if codec not in ('bslz4', 'lz4'):
+            raise ValueError('codec ' + str(codec) + ' is not supported')
+        self.codec = codec
+        self.buffer = buffer
+        self.chunks = chunks
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        # the decompressed frame, set when a consumer reads the frame array
+        self.frame = None
+
+
+    def decompress_chunk(self, chunk):
+        start, count, offset, length = chunk
+        if self.codec == 'bslz4':
+            compressed = np.frombuffer(self.buffer, dtype=np.uint8, count=length, offset=offset)
+            return bitshuffle.decompress_lz4(compressed, (count,), self.dtype, self.block_size)
+        compressed = memoryview(self.buffer)[offset:offset + length]
+        return np.frombuffer(lz4.block.decompress(compressed, uncompressed_size=count * self.dtype.itemsize),
+                             dtype=self.dtype)
+
+
+    def array(self):
+        """
+        This function returns the decompressed frame, the chunks are decompressed in parallel once.
+
+        Two threads reading the frame at the same time may both decompress it, they get equal arrays.
+        """
+        if self.frame is None:
+            frame = np.empty(int(np.prod(self.shape)), dtype=self.dtype)
+
+            def decompress(chunk):
+                frame[chunk[0]:chunk[0] + chunk[1]] = self.decompress_chunk(chunk)
+
+            list(get_executor().map(decompress, self.chunks))
+            self.frame = frame.reshape(self.shape)
+        return self.frame
+
+
+    def reductions(self, acq_time, thresholds, index):
+        """
+        This function computes the reductions of kernels.frame_reductions chunk by chunk, without decompressing the
+        whole frame. If the frame was decompressed, the reductions are computed on the frame.
+        """
+        if self.frame is not None:
+            return kn.frame_reductions(self.frame, acq_time, thresholds, index)
+
+        def reduce(chunk):
+            start, count = chunk[0], chunk[1]
+            # the masked pixels of the chunk, the mask index is sorted
+            chunk_index = None
+            if index is not None:
+                low, high = np.searchsorted(index, (start, start + count))
+                if high > low:
+                    chunk_index = index[low:high] - start
+            # the chunks are reduced in parallel threads, each chunk by the serial loop
+            return kn.frame_reductions(self.decompress_chunk(chunk).reshape(1, count), acq_time, thresholds,
+                                       chunk_index, parallel=False)
+
+        sum = 0
+        counts = np.zeros(len(thresholds), dtype=np.int64)
+        for chunk_sum, chunk_counts in get_executor().map(reduce, self.chunks):
+            sum += chunk_sum
+            counts += chunk_counts
+        return sum, counts
+
+
+def split(count, chunk):
+    return [(start, min(chunk, count - start)) for start in range(0, count, chunk)]
+
+
+def from_bslz4(buffer, shape, dtype, block_size=0, chunk_bytes=CHUNK_BYTES):
+    """
+    This function creates chunked frame from bitshuffle LZ4 stream, a chunk is a run of the stream blocks.
+
+    Each block is stored as 4 bytes big endian compressed size followed by the compressed block. The pixels that
+    do not fill the last block are stored as a multiple of 8 pixels block, and the remaining pixels are copied
+    uncompressed at the end of the stream; they belong to the last chunk.
+
+    Parameters
+    ----------
+    buffer : bytes
+        the compressed frame
+    shape : tuple
+        frame shape
+    dtype : numpy.dtype
+        frame data type
+    block_size : int
+        bitshuffle block size in pixels, 0 for the default
+    chunk_bytes : int
+        uncompressed bytes of a chunk, rounded to whole blocks
+
+    Returns
+    -------
+    frame : ChunkedFrame
+        the chunked frame
+    """
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    block_size = block_size or bslz4_block_size(dtype.itemsize)
+    view = memoryview(buffer).cast('B')
+    blocks_per_chunk = max(1, chunk_bytes // (block_size * dtype.itemsize))
+    full_blocks = count // block_size
+    chunks = []
+    offset = 0
+    for start, length in split(full_blocks, blocks_per_chunk):
+        chunk_offset = offset
+        for i in range(length):
+            offset += 4 + int.from_bytes(view[offset:offset + 4], 'big')
+        chunks.append((start * block_size, length * block_size, chunk_offset, offset - chunk_offset))
+    remaining = count - full_blocks * block_size
+    if remaining > 0:
+        chunks.append((count - remaining, remaining, offset, len(view) - offset))
+    return ChunkedFrame('bslz4', buffer, chunks, shape, dtype, block_size)
+
+
+def from_lz4(buffer, sizes, chunk_size, shape, dtype):
+    """
+    This function creates chunked frame from LZ4 blocks of chunk_size pixels, the last block may be shorter.
+
+    Parameters
+    ----------
+    buffer : bytes
+        the compressed blocks, one after another
+    sizes : list
+        compressed size of each block
+    chunk_size : int
+        pixels in a block
+    """
+    count = int(np.prod(shape))
+    chunks = []
+    offset = 0
+    for (start, length), size in zip(split(count, chunk_size), sizes):
+        chunks.append((start, length, offset, size))
+        offset += size
+    return ChunkedFrame('lz4', buffer, chunks, shape, dtype)
+
+
+def from_header(header, buffer):
+    """
+    This function creates chunked frame from the frame message header with 'codec', 'dtype' and 'shape', and the
+    compressed buffer. For 'bslz4' the header can give 'block_size', for 'lz4' it gives 'chunks' sizes and
+    'chunk_size'.
+    """
+    if header['codec'] == 'bslz4':
+        return from_bslz4(buffer, header['shape'], header['dtype'], header.get('block_size', 0))
+    if header['codec'] == 'lz4':
+        return from_lz4(buffer, header['chunks'], header['chunk_size'], header['shape'], header['dtype'])
+    raise ValueError('codec ' + str(header['codec']) + ' is not supported')
+
+
+def compress(frame, codec, chunk_bytes=CHUNK_BYTES):
+    """
+    This function compresses frame for from_header.
+
+    Returns
+    -------
+    buffer : bytes
+        the compressed frame
+    header : dict
+        codec fields of the frame message header
+    """
+    frame = np.ascontiguousarray(frame)
+    if codec == 'bslz4':
+        if bitshuffle is None:
+            raise ValueError('codec bslz4 requires bitshuffle')
+        return bitshuffle.compress_lz4(frame.reshape(-1)).tobytes(), {'codec': 'bslz4'}
+    if codec == 'lz4':
+        if lz4 is None:
+            raise ValueError('codec lz4 requires lz4')
+        flat = frame.reshape(-1)
+        chunk_size = max(1, chunk_bytes // frame.itemsize)
+        blocks = [lz4.block.compress(flat[start:start + length], store_size=False)
+                  for start, length in split(flat.size, chunk_size)]
+        return b''.join(blocks), {'codec': 'lz4', 'chunks': [len(block) for block in blocks], 'chunk_size': chunk_size}
+    raise ValueError('codec ' + str(codec) + ' is not supported')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify and time the reductions of compressed frames.')
+    parser.add_argument('--shape', type=int, nargs=2, default=(2048, 2048), help='frame rows and columns')
+    parser.add_argument('--dtype', default='uint16', help='frame data type')
+    parser.add_argument('--codec', default='bslz4', help='bslz4 or lz4')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frame = rng.poisson(60, tuple(args.shape)).astype(args.dtype)
+    index = np.sort(rng.choice(frame.size, frame.size // 100, replace=False))
+    thresholds = np.array([500.0, 600.0, 800.0])
+    buffer, header = compress(frame, args.codec)
+    header.update({'shape': frame.shape, 'dtype': frame.dtype.str})
+    print ('codec', args.codec, 'ratio %.2f' % (frame.nbytes / len(buffer)), 'backend', kn.BACKEND,
+           'threads', get_executor()._max_workers)
+
+    for mask in (None, index):
+        expected = kn.frame_reductions(frame, 0.1, thresholds, mask)
+        computed = from_header(header, buffer).reductions(0.1, thresholds, mask)
+        same = expected[0] == computed[0] and np.array_equal(expected[1], computed[1])
+        print ('mask' if mask is not None else 'no mask', 'reductions identical' if same else 'reductions differ')
+    print ('frame identical' if np.array_equal(from_header(header, buffer).array(), frame) else 'frame differs')
+
+    def decompress_and_reduce():
+        kn.frame_reductions(from_header(header, buffer).array(), 0.1, thresholds, index)
+
+    def reduce_chunks():
+        from_header(header, buffer).reductions(0.1, thresholds, index)
+
+    for name, function in (('decompressed frame', decompress_and_reduce), ('chunks', reduce_chunks)):
+        function()
+        start = time.time()
+        for i in range(10):
+            function()
+        print ('%s %.3f ms per frame' % (name, (time.time() - start) * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module measures memory allocated by the pipeline stages: feed read, frame data, each check, notify, and adjust.
+
+When enabled, the allocations are traced with tracemalloc, which includes NumPy array buffers. For each run of a
+stage, the peak of traced memory above the start of the stage, and the memory retained at the end of the stage are
+recorded per frame. The peak includes the temporary arrays, so a new frame size temporary shows as a step of the
+peak, and retained memory that grows shows a leak.
+
+The stages run in several threads, while tracemalloc counts the memory of the whole process. To attribute the
+allocations to a stage, the stages are serialized while tracing, so the tracing mode is meant for diagnosis, not
+for production rates. Nothing is traced while disabled.
+
+The stage report is served at /memory of the metrics server. The allocation budget can be verified on synthetic
+frames with:
+
+    python -m controller.utilities.memory config/cntl_conf --shape 2048 2048 --budget 8000000
+"""
+
+import argparse
+import sys
+import threading
+import tracemalloc
+import numpy as np
+import controller.utilities.metrics as mt
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['MemoryTracker',
+           'enable',
+           'disable',
+           'stage']
+
+
+# the enabled tracker, or None
+tracker = None
+
+
+class MemoryTracker(object):
+    """
+    This class holds the allocation statistics of each stage.
+    """
+
+    def __init__(self, budget=None):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        budget : int
+            peak bytes allowed per frame in any stage, or None
+        """
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # stage name to frames, runs, total peak, maximal peak per frame, total retained
+        self.stats = {}
+        self.over = {}
+
+
+    def add(self, name, frames, peak, retained):
+        stats = self.stats.setdefault(name, [0, 0, 0, 0, 0])
+        stats[0] += frames
+        stats[1] += 1
+        stats[2] += peak
+        stats[3] = max(stats[3], peak // frames)
+        stats[4] += retained
+        if self.budget is not None and peak // frames > self.budget:
+            self.over[name] = self.over.get(name, 0) + 1
+            mt.MEMORY_OVER_BUDGET.labels(name).inc()
+            if self.over[name] == 1:
+                print ('stage', name, 'allocated', peak // frames, 'bytes per frame, over budget', self.budget)
+
+
+    def over_budget(self):
+        """
+        This function returns the names of stages that exceeded the budget.
+        """
+        return sorted(self.over)
+
+
+    def report(self):
+        """
+        This function returns the stage statistics as text table.
+        """
+        lines = ['%-40s %8s %14s %14s %14s' % ('stage', 'frames', 'peak/frame', 'max peak', 'retained/frame')]
+        for name in sorted(self.stats):
+            frames, runs, peak, max_peak, retained = self.stats[name]
+            lines.append('%-40s %8d %14d %14d %14d' % (name, frames, peak // frames, max_peak, retained // frames))
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append('traced %d bytes, peak %d bytes' % (current, peak))
+        if self.budget is not None:
+            lines.append('budget %d bytes per frame, stages over budget: %s' %
+                         (self.budget, ', '.join(self.over_budget()) or 'none'))
+        return '\n'.join(lines) + '\n'
+
+
+class Stage(object):
+    """
+    This class measures a run of a stage. A stage nested in other stage of the same thread is not measured apart, its
+    allocations count to the outer stage.
+    """
+    __slots__ = ('tracker', 'name', 'frames', 'start', 'nested')
+
+    def __init__(self, tracker, name, frames):
+        self.tracker = tracker
+        self.name = name
+        self.frames = frames
+
+
+    def __enter__(self):
+        local = self.tracker.local
+        self.nested = getattr(local, 'active', False)
+        if self.nested:
+            return self
+        self.tracker.lock.acquire()
+        local.active = True
+        tracemalloc.reset_peak()
+        self.start = tracemalloc.get_traced_memory()[0]
+        return self
+
+
+    def __exit__(self, *args):
+        if self.nested:
+            return False
+        current, peak = tracemalloc.get_traced_memory()
+        self.tracker.local.active = False
+        try:
+            self.tracker.add(self.name, max(self.frames, 1), peak - self.start, current - self.start)
+        finally:
+            self.tracker.lock.release()
+        return False
+
+
+class NoStage(object):
+    """
+    This class is the stage used while the tracing is disabled, it does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        return False
+
+
+NO_STAGE = NoStage()
+
+
+def stage(name, frames=1):
+    """
+    This function returns context measuring the allocations of the enclosed code as a run of the stage.
+
+    Parameters
+    ----------
+    name : str
+        stage name
+    frames : int
+        number of frames processed in the run, the statistics are per frame
+
+    Returns
+    -------
+    stage : context
+        the measuring context, or context doing nothing if tracing is disabled
+    """
+    if tracker is None:
+        return NO_STAGE
+    return Stage(tracker, name, frames)
+
+
+def enable(budget=None):
+    """
+    This function starts tracing allocations and adds /memory path to the metrics server.
+
+    Parameters
+    ----------
+    budget : int
+        peak bytes allowed per frame in any stage, or None
+
+    Returns
+    -------
+    tracker : MemoryTracker
+        the enabled tracker
+    """
+    global tracker
+    tracemalloc.start()
+    tracker = MemoryTracker(budget)
+    mt.add_handler('/memory', lambda query: tracker.report())
+    return tracker
+
+
+def disable():
+    global tracker
+    tracker = None
+    tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure memory allocated by the checks on synthetic frames.')
+    parser.add_argument('conf', help='controller configuration file')
+    parser.add_argument('--shape', type=int, nargs=2, default=(512, 512), help='frame rows and columns')
+    parser.add_argument('--dtype', default='uint16', help='frame data type')
+    parser.add_argument('--frames', type=int, default=20, help='number of frames')
+    parser.add_argument('--batch', type=int, default=4, help='frames in a batch, the batch path is measured too')
+    parser.add_argument('--acq-time', type=float, default=0.1, help='acquire time')
+    parser.add_argument('--budget', type=int, default=None, help='peak bytes allowed per frame in a stage')
+    args = parser.parse_args()
+
+    from configobj import ConfigObj
+    import controller.monitoring.checks as checks
+    # run as script, this module is __main__, the checks use the imported module
+    import controller.utilities.memory as mem
+    import controller.utilities.plan as pl
+    import controller.utilities.utils as ut
+
+    plan = pl.compile_plan(ConfigObj(args.conf))
+    shape = tuple(args.shape)
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 1000, shape).astype(args.dtype) for i in range(args.frames)]
+    pl.prepare_plan(plan, shape)
+
+    # the stages are measured from the second frame, the first frame allocates the caches
+    for data in [ut.Data(frames[0], {'acq_time': ('acq_time', args.acq_time)})]:
+        checks.run_quality_checks(data, plan)
+        checks.run_quality_checks_batch([data] * max(args.batch, 2), plan)
+    memory = mem.enable(args.budget)
+    for i, frame in enumerate(frames):
+        with mem.stage('frame data'):
+            data = ut.Data(frame, {'acq_time': ('acq_time', args.acq_time)}, i)
+        checks.run_quality_checks(data, plan)
+    if args.batch > 1:
+        for i in range(0, len(frames) - args.batch + 1, args.batch):
+            batch = [ut.Data(frame, {'acq_time': ('acq_time', args.acq_time)}, i)
+                     for frame in frames[i:i + args.batch]]
+            checks.run_quality_checks_batch(batch, plan)
+    print (memory.report())
+    if len(memory.over_budget()) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
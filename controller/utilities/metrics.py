@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module maintains the controller metrics and serves them on a local HTTP port in Prometheus text format.
+
+The counters and summaries keep a separate cell for each thread that updates them, so the hot paths increment
+without taking a lock. The cells are added up when the metrics are scraped.
+"""
+
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['Counter',
+           'Summary',
+           'Gauge',
+           'Registry',
+           'registry',
+           'add_handler',
+           'start_server']
+
+
+class Cells(object):
+    """
+    This class holds per thread cells of a metric.
+
+    Each thread writes only its own cell. When a new thread registers its cell, and when the values are collected,
+    the cells of finished threads are folded into the base cell, so the short lived notify threads do not accumulate
+    cells, whether the metrics are collected or not.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.base = [0] * size
+        self.cells = []
+
+
+    def cell(self):
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = [0] * self.size
+            self.local.cell = cell
+            with self.lock:
+                self.fold()
+                self.cells.append((threading.current_thread(), cell))
+            return cell
+
+
+    def fold(self):
+        # called with the lock held; a finished thread no longer writes its cell
+        alive = []
+        for thread, cell in self.cells:
+            if thread.is_alive():
+                alive.append((thread, cell))
+            else:
+                for i in range(self.size):
+                    self.base[i] += cell[i]
+        self.cells = alive
+
+
+    def collect(self):
+        with self.lock:
+            self.fold()
+            totals = list(self.base)
+            for thread, cell in self.cells:
+                for i in range(self.size):
+                    totals[i] += cell[i]
+        return totals
+
+
+class Metric(object):
+    """
+    This is a base class of metrics. A metric with label names has a child metric for each label value.
+    """
+    type = None
+
+    def __init__(self, name, help, labelnames=(), labelvalues=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.labelvalues = tuple(labelvalues)
+        self.children = {}
+        self.lock = threading.Lock()
+
+
+    def labels(self, *values):
+        """
+        This function returns the child metric for given label values.
+        """
+        try:
+            return self.children[values]
+        except KeyError:
+            with self.lock:
+                if values not in self.children:
+                    self.children[values] = self.__class__(self.name, self.help, self.labelnames, values)
+                return self.children[values]
+
+
+    def label_str(self, extra=None):
+        pairs = list(zip(self.labelnames, self.labelvalues))
+        if extra is not None:
+            pairs.append(extra)
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+    def samples(self):
+        return []
+
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        metrics = [self.children[k] for k in sorted(self.children)] if self.labelnames else [self]
+        for metric in metrics:
+            for suffix, value in metric.samples():
+                lines.append('%s%s%s %s' % (self.name, suffix[0], metric.label_str(suffix[1]), repr(float(value))))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    This class is a monotonic counter.
+    """
+    type = 'counter'
+
+    def __init__(self, *args):
+        Metric.__init__(self, *args)
+        self.cells = Cells(1)
+
+
+    def inc(self, amount=1):
+        self.cells.cell()[0] += amount
+
+
+    def value(self):
+        return self.cells.collect()[0]
+
+
+    def samples(self):
+        return [(('', None), self.value())]
+
+
+class Summary(Metric):
+    """
+    This class counts observations and adds up observed values, typically durations in seconds.
+    """
+    type = 'summary'
+
+    def __init__(self, *args):
+        Metric.__init__(self, *args)
+        self.cells = Cells(2)
+
+
+    def observe(self, value):
+        cell = self.cells.cell()
+        cell[0] += 1
+        cell[1] += value
+
+
+    def samples(self):
+        count, sum = self.cells.collect()
+        return [(('_count', None), count), (('_sum', None), sum)]
+
+
+class Gauge(Metric):
+    """
+    This class is a value that can go up and down. If a function is given, the value is read from it when scraped.
+    """
+    type = 'gauge'
+
+    def __init__(self, *args):
+        Metric.__init__(self, *args)
+        self.current = 0
+        self.function = None
+
+
+    def set(self, value):
+        self.current = value
+
+
+    def set_function(self, function):
+        self.function = function
+
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                return [(('', None), self.function())]
+            except Exception:
+                return []
+        return [(('', None), self.current)]
+
+
+class Registry(object):
+    """
+    This class holds metrics and renders them in Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def expose(self):
+        return '\n'.join(metric.expose() for metric in self.metrics) + '\n'
+
+
+registry = Registry()
+
+FRAMES_RECEIVED = registry.add(Counter('controller_frames_received_total', 'Frames received by the feed'))
+FRAMES_DROPPED = registry.add(Counter('controller_frames_dropped_total', 'Frames that could not be read'))
+MISSING_FRAMES = registry.add(Counter('controller_missing_frames_total', 'Frames missed according to the counter'))
+CHECK_SECONDS = registry.add(Summary('controller_check_duration_seconds', 'Time spent in a check', ['check']))
+EVENTS = registry.add(Counter('controller_events_total', 'Events raised by checks', ['check']))
+CHECK_EVENT_RATE = registry.add(Gauge('controller_check_event_rate',
+                                      'Moving average of events per evaluated frame', ['check']))
+ADJUSTMENTS = registry.add(Counter('controller_adjustments_total', 'Adjustments issued', ['check']))
+PUT_SECONDS = registry.add(Summary('controller_put_latency_seconds', 'Time spent writing adjusted PV'))
+QUEUE_DEPTH = registry.add(Gauge('controller_queue_depth', 'Number of items waiting in a queue', ['queue']))
+RECORDS_DROPPED = registry.add(Counter('controller_records_dropped_total', 'Records dropped by the recorder'))
+FRAMES_NOT_PUBLISHED = registry.add(Counter('controller_frames_not_published_total',
+                                            'Frames dropped by the publisher'))
+PREVIEW_DECIDED = registry.add(Counter('controller_preview_decided_total',
+                                       'Check evaluations decided on binned frame', ['check']))
+PREVIEW_FALLBACKS = registry.add(Counter('controller_preview_fallbacks_total',
+                                         'Check evaluations repeated in full resolution after preview', ['check']))
+MEMORY_OVER_BUDGET = registry.add(Counter('controller_memory_over_budget_total',
+                                          'Stage runs allocating more than the memory budget per frame', ['stage']))
+
+
+# functions serving other paths than metrics, they take the query dictionary and return text
+handlers = {}
+
+
+def add_handler(path, function):
+    """
+    This function adds a path served by the metrics server, such as a control command.
+    """
+    handlers[path] = function
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path in handlers:
+            try:
+                body = handlers[path](parse_qs(query)).encode('utf-8')
+            except Exception as e:
+                self.send_error(400, str(e))
+                return
+        elif path in ('/', '/metrics'):
+            body = registry.expose().encode('utf-8')
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port, host='127.0.0.1'):
+    """
+    This function starts HTTP server serving the metrics in a daemon thread.
+
+    Parameters
+    ----------
+    port : int
+        port number
+    host : str
+        interface to bind, local by default
+
+    Returns
+    -------
+    server : HTTPServer
+        the running server
+    """
+    server = HTTPServer((host, int(port)), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
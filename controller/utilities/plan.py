@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module compiles the bounds and checks configuration files into an immutable control plan, and watches the
+files, so a changed configuration is swapped in while the controller is running.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+import controller.utilities.registry as reg
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['Bounds',
+           'Check',
+           'Plan',
+           'compile_bounds',
+           'compile_plan',
+           'prepare_plan',
+           'PlanWatcher']
+
+
+# name of the bounds entry holding per pixel rate bounds, shared by the Npix checks
+PIX_BOUNDS = 'pix_sat_cnt_rate'
+
+INF = float('inf')
+
+# numeric bounds of one check; a bound that is not configured is set to infinity, so it never triggers
+Bounds = namedtuple('Bounds', ['low_limit', 'high_limit', 'low_threshold', 'high_threshold', 'target'])
+
+# the inputs of the check function that change with each frame, the other inputs are bound when the plan is compiled
+PER_FRAME_INPUTS = ('data', 'mask', 'stats')
+
+# a check resolved to functions, its compiled bounds, and check specific parameters, such as ROIs, or None;
+# batch is the function evaluating a batch of frames, or None; skips are names of checks not evaluated when this
+# check reaches a limit; inputs and batch_inputs are the keyword arguments the check declares for the functions;
+# preview is the function evaluating binned frame, or None; call and preview_call are the function and the preview
+# bound to the check inputs by bind
+Check = namedtuple('Check', ['name', 'function', 'batch', 'adjuster', 'bounds', 'pix_bounds', 'params', 'skips',
+                             'inputs', 'batch_inputs', 'preview', 'call', 'preview_call'])
+
+# the whole control plan; checks are in evaluation order, by_name maps check name to Check, mask is a Mask of
+# excluded pixels or None
+Plan = namedtuple('Plan', ['checks', 'by_name', 'mask', 'version'])
+
+
+def compile_bounds(bounds):
+    """
+    This function converts a bounds dictionary into Bounds instance.
+
+    Parameters
+    ----------
+    bounds : dict
+        a dictionary containing limit, threshold, and target values
+
+    Returns
+    -------
+    bounds : Bounds
+        compiled bounds
+    """
+    target = bounds.get('target')
+    return Bounds(float(bounds.get('low_limit', -INF)),
+                  float(bounds.get('high_limit', INF)),
+                  float(bounds.get('low_threshold', -INF)),
+                  float(bounds.get('high_threshold', INF)),
+                  None if target is None else float(target))
+
+
+def bind(function, inputs, bounds, pix_bounds, params):
+    """
+    This function binds the bounds, per pixel bounds, and parameters the check declares to the check function, so
+    they are not collected for each frame.
+
+    Parameters
+    ----------
+    function : callable
+        function evaluating a frame, or None
+    inputs : tuple
+        names of the keyword arguments the function takes
+
+    Returns
+    -------
+    call : callable
+        function taking the frame inputs data, mask, and stats, and other keyword arguments, such as bin, that calls
+        the function with the declared inputs, or None if function is None
+    """
+    if function is None:
+        return None
+    static = {'bounds': bounds, 'pix_bounds': pix_bounds, 'params': params}
+    bound = functools.partial(function, **{name: static[name] for name in inputs if name in static})
+    frame_inputs = tuple(name for name in PER_FRAME_INPUTS if name in inputs)
+    if frame_inputs == PER_FRAME_INPUTS:
+        return lambda data, mask, stats, **kws: bound(data=data, mask=mask, stats=stats, **kws)
+
+    def call(data, mask, stats, **kws):
+        frame = {'data': data, 'mask': mask, 'stats': stats}
+        for name in frame_inputs:
+            kws[name] = frame[name]
+        return bound(**kws)
+
+    return call
+
+
+def compile_plan(config, version=0):
+    """
+    This function reads the bounds and checks files, and the mask file if configured, and compiles them into a Plan.
+
+    Each check name is resolved through the registry to the check functions and the adjuster function, and the
+    bounds are converted to numbers. The inputs the check declares must be configured: per pixel bounds, parameters,
+    and the pvs read with the frame, if the configuration has 'pvs' file. The optional 'skip_on_limit' list in check
+    bounds names checks that are not evaluated when the check reaches a limit; a skipped check cannot skip other
+    checks, so the outcome does not depend on evaluation order.
+    A configuration error raises exception, so the running plan is not replaced with a broken one.
+
+    Parameters
+    ----------
+    config : dict
+        configuration containing 'bounds' and 'checks' file names, and optional 'mask' file name
+    version : int
+        version number given to the plan
+
+    Returns
+    -------
+    plan : Plan
+        compiled control plan
+    """
+    # imported here to avoid circular imports, the checks module imports utilities
+    import controller.monitoring.masks as msk
+
+    with open(config['bounds']) as file:
+        bounds = json.loads(file.read())
+    with open(config['checks']) as file:
+        check_names = json.loads(file.read())
+    pvs = None
+    if 'pvs' in config:
+        with open(config['pvs']) as file:
+            pvs = json.loads(file.read())
+
+    pix_bounds = compile_bounds(bounds[PIX_BOUNDS]) if PIX_BOUNDS in bounds else None
+    compiled = []
+    for name in check_names:
+        spec = reg.get_check(name)
+        if name not in bounds:
+            raise ValueError('bounds for check ' + name + ' are not configured')
+        for input in spec.inputs:
+            if input not in reg.FRAME_INPUTS:
+                raise ValueError('check ' + name + ' declares unknown input ' + input)
+        batch_inputs = spec.batch_inputs if spec.batch is not None else ()
+        for input in batch_inputs:
+            if input not in reg.BATCH_INPUTS:
+                raise ValueError('check ' + name + ' declares unknown batch input ' + input)
+        inputs = set(spec.inputs) | set(batch_inputs)
+        if 'pix_bounds' in inputs and pix_bounds is None:
+            raise ValueError('check ' + name + ' needs ' + PIX_BOUNDS + ' bounds that are not configured')
+        if 'params' in inputs and spec.params is None:
+            raise ValueError('check ' + name + ' takes parameters, but has no function compiling them')
+        for pv in spec.pvs:
+            if pvs is not None and pv not in pvs:
+                raise ValueError('check ' + name + ' reads pv ' + pv + ' that is not configured')
+        params = spec.params(bounds[name]) if spec.params is not None else None
+        skips = tuple(bounds[name].get('skip_on_limit', ()))
+        check_bounds = compile_bounds(bounds[name])
+        compiled.append(Check(name, spec.function, spec.batch, reg.get_adjuster(name), check_bounds, pix_bounds,
+                              params, skips, tuple(spec.inputs), tuple(batch_inputs), spec.preview,
+                              bind(spec.function, spec.inputs, check_bounds, pix_bounds, params),
+                              bind(spec.preview, spec.inputs, check_bounds, pix_bounds, params)))
+
+    skipped = set(name for ck in compiled for name in ck.skips)
+    for ck in compiled:
+        for name in ck.skips:
+            if name not in check_names:
+                raise ValueError('check ' + ck.name + ' skips check ' + name + ' that is not configured')
+        if len(ck.skips) > 0 and ck.name in skipped:
+            raise ValueError('check ' + ck.name + ' is skipped by other check and cannot skip checks')
+
+    mask = msk.load_mask(config['mask']) if 'mask' in config else None
+
+    compiled = tuple(compiled)
+    return Plan(compiled, MappingProxyType({ck.name: ck for ck in compiled}), mask, version)
+
+
+def prepare_plan(plan, shape, dtype=None):
+    """
+    This function compiles the plan mask and the check parameters, such as ROIs, for a frame shape. If the frame data
+    type is given, the frame reduction loops are compiled for it.
+
+    The compiled geometry is kept per shape, so frames of the previous shape that are still processed use their own.
+    Preparing the plan when the shape changes, before the first frame of the new shape, keeps the compilation out of
+    the check timing.
+
+    Parameters
+    ----------
+    plan : Plan
+        compiled control plan
+    shape : tuple
+        frame shape
+    dtype : numpy.dtype
+        frame data type, or None
+
+    Returns
+    -------
+    nothing
+    """
+    # imported here to avoid circular imports, as in compile_plan
+    import controller.monitoring.kernels as kn
+
+    mask = plan.mask.for_shape(shape) if plan.mask is not None else None
+    for ck in plan.checks:
+        if hasattr(ck.params, 'for_shape'):
+            ck.params.for_shape(shape, mask)
+    if dtype is not None:
+        kn.warm(dtype, mask is not None)
+
+
+class PlanWatcher(threading.Thread):
+    """
+    This class watches the bounds, checks, and mask files and recompiles the plan when any of them changes.
+
+    The new plan is assigned to the 'plan' attribute of every consumer. The consumers read the attribute once per
+    frame, so the plan is swapped between frames. The files are watched with inotify if the inotify_simple package is
+    installed, otherwise the file modification times are polled.
+    """
+
+    def __init__(self, config, consumers, plan, poll_interval=1.0):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        config : dict
+            configuration containing 'bounds' and 'checks' file names
+        consumers : list
+            objects having 'plan' attribute
+        plan : Plan
+            currently used plan
+        poll_interval : float
+            seconds between modification time checks, used when inotify is not available
+        """
+        threading.Thread.__init__(self, name='plan-watcher')
+        self.daemon = True
+        self.config = config
+        self.consumers = consumers
+        self.plan = plan
+        self.poll_interval = poll_interval
+        self.files = [os.path.abspath(config['bounds']), os.path.abspath(config['checks'])]
+        if 'mask' in config:
+            self.files.append(os.path.abspath(config['mask']))
+        self.done = False
+
+
+    def reload(self):
+        """
+        This function compiles a new plan and passes it to consumers. If compilation fails, the current plan is kept.
+        """
+        try:
+            plan = compile_plan(self.config, self.plan.version + 1)
+        except Exception as e:
+            print ('configuration not reloaded, keeping current plan', e)
+            return
+        self.plan = plan
+        for consumer in self.consumers:
+            consumer.plan = plan
+        print ('reloaded plan version', plan.version)
+
+
+    def watch_inotify(self):
+        inotify = inotify_simple.INotify()
+        mask = inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO | inotify_simple.flags.CREATE
+        # watch directories, editors often replace the file instead of writing it
+        watched = {}
+        for dir in set(os.path.dirname(f) for f in self.files):
+            watched[inotify.add_watch(dir, mask)] = dir
+        while not self.done:
+            changed = False
+            for event in inotify.read(timeout=int(self.poll_interval * 1000)):
+                if os.path.join(watched[event.wd], event.name) in self.files:
+                    changed = True
+            if changed:
+                self.reload()
+        inotify.close()
+
+
+    def watch_poll(self):
+        def mtimes():
+            times = []
+            for f in self.files:
+                try:
+                    times.append(os.stat(f).st_mtime)
+                except OSError:
+                    times.append(None)
+            return times
+
+        last = mtimes()
+        while not self.done:
+            time.sleep(self.poll_interval)
+            current = mtimes()
+            if current != last:
+                last = current
+                self.reload()
+
+
+    def run(self):
+        if inotify_simple is not None:
+            self.watch_inotify()
+        else:
+            self.watch_poll()
+
+
+    def stop(self):
+        self.done = True
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module profiles the running controller on demand.
+
+When triggered, a sampling thread reads the stacks of all threads with sys._current_frames at a fixed interval for
+the given duration. The samples are written as collapsed stacks, one line per distinct stack with its count, that
+flamegraph.pl or speedscope read directly, and as per function totals. Nothing runs while the profiler is not
+triggered.
+
+The profiling is triggered by SIGUSR1 signal, or by GET request /profile?seconds=10 to the metrics server.
+"""
+
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+import controller.utilities.metrics as mt
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['Profiler',
+           'install']
+
+
+class Profiler(object):
+    """
+    This class samples the stacks of all threads and writes the profile files.
+    """
+
+    def __init__(self, dir='.', seconds=10.0, interval=0.005):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        dir : str
+            directory where the profile files are written
+        seconds : float
+            default profiling duration
+        interval : float
+            time between samples in seconds
+        """
+        self.dir = dir
+        self.seconds = float(seconds)
+        self.interval = float(interval)
+        self.lock = threading.Lock()
+        self.thread = None
+
+
+    def start(self, seconds=None):
+        """
+        This function starts profiling in a thread, unless profiling is already running.
+
+        Parameters
+        ----------
+        seconds : float
+            profiling duration, the default duration if None
+
+        Returns
+        -------
+        started : bool
+            True if the profiling started
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+            self.thread = threading.Thread(target=self.run, args=(self.seconds if seconds is None else seconds,),
+                                           name='profiler')
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+
+
+    def sample(self, seconds):
+        """
+        This function samples the stacks of all threads, except the profiler thread.
+
+        Returns
+        -------
+        stacks : Counter
+            number of samples of each stack, the stack is a tuple of thread name and functions from the outermost
+        samples : int
+            number of sampling rounds
+        """
+        stacks = collections.Counter()
+        me = threading.current_thread().ident
+        rounds = 0
+        end = time.time() + seconds
+        while time.time() < end:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%d' % ident))
+                stacks[tuple(reversed(stack))] += 1
+            rounds += 1
+            time.sleep(self.interval)
+        return stacks, rounds
+
+
+    def run(self, seconds):
+        print ('profiling', seconds, 's')
+        stacks, rounds = self.sample(seconds)
+        now = time.time()
+        name = os.path.join(self.dir, 'profile_%s_%03d' % (time.strftime('%Y%m%d_%H%M%S', time.localtime(now)),
+                                                          int(now * 1000) % 1000))
+        self.write_collapsed(name + '.folded', stacks)
+        self.write_totals(name + '.txt', stacks, rounds)
+        print ('profile written to', name + '.folded', name + '.txt')
+
+
+    @staticmethod
+    def write_collapsed(file, stacks):
+        with open(file, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(';'.join(stack) + ' ' + str(count) + '\n')
+
+
+    @staticmethod
+    def write_totals(file, stacks, rounds):
+        """
+        This function writes for each function the samples where it runs (self) and where it is on the stack (total).
+        """
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in stacks.items():
+            own[stack[-1]] += count
+            # a recursive function is counted once per sample
+            for function in set(stack[1:]):
+                total[function] += count
+        with open(file, 'w') as f:
+            f.write('sampling rounds %d\n' % rounds)
+            f.write('%10s %10s  %s\n' % ('self', 'total', 'function'))
+            for function, count in total.most_common():
+                f.write('%10d %10d  %s\n' % (own[function], count, function))
+
+
+def install(profiler, signum=None):
+    """
+    This function sets the profiler triggers: the signal handler, and the /profile path of the metrics server.
+
+    The signal handler can be set only in the main thread.
+
+    Parameters
+    ----------
+    profiler : Profiler
+        the profiler
+    signum : int
+        signal triggering the profiling, SIGUSR1 by default
+
+    Returns
+    -------
+    nothing
+    """
+    if signum is None:
+        signum = signal.SIGUSR1
+    signal.signal(signum, lambda sig, frame: profiler.start())
+
+    def profile(query):
+        seconds = float(query['seconds'][0]) if 'seconds' in query else None
+        if profiler.start(seconds):
+            return 'profiling started\n'
+        return 'profiling is already running\n'
+
+    mt.add_handler('/profile', profile)
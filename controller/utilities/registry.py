@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module resolves the check and adjuster names configured in checks.json to their implementations.
+
+The built-in checks and adjusters are listed by name with the module and attribute that implement them. Other
+checks and adjusters are discovered through the 'controller.checks' and 'controller.adjusters' entry points of
+installed packages, for example in setup.py of a plugin package:
+
+    entry_points = {'controller.checks': ['my_check = my_package.checks:my_check'],
+                    'controller.adjusters': ['my_check = my_package.adjusters:my_check_adj']}
+
+A check entry point refers to CheckSpec, an adjuster entry point refers to the adjuster function. A module is
+imported only when a configured check names it.
+
+A check function returns a tuple of the evaluation, the result, and the event arguments, a dictionary or None. When
+the evaluation is an event, the arguments are passed as keywords to controller.utilities.utils.Event. The keys known
+to the built-in adjusters are 'result', 'points_over_threshold', 'roi', 'rois', and 'acq_time', the latter a tuple of
+the acquire time pv name and value; other keys are kept in the event 'extra' dictionary.
+
+An adjuster is called with keyword arguments 'event', the Event, and 'bounds', the compiled bounds of the check. It
+writes the pv and returns a tuple of the pv name and the written value, which the responder records; it returns None
+if it writes no pv.
+"""
+
+import importlib
+from collections import namedtuple
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:
+    entry_points = None
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['CheckSpec',
+           'get_check',
+           'get_adjuster',
+           'check_names']
+
+
+CHECKS_GROUP = 'controller.checks'
+ADJUSTERS_GROUP = 'controller.adjusters'
+
+# keyword arguments the function evaluating a frame can take, and the function evaluating a batch of frames
+FRAME_INPUTS = ('data', 'bounds', 'pix_bounds', 'params', 'mask', 'stats')
+BATCH_INPUTS = ('frames', 'acq_times', 'data', 'bounds', 'pix_bounds', 'params', 'mask')
+
+# implementation of a check: the function evaluating a frame, the function evaluating a batch of frames or None,
+# the function compiling check parameters from the check bounds or None, the keyword arguments each function takes,
+# and the names of pvs the check reads from the frame pvs; by default the functions take all inputs; preview is the
+# function evaluating the frame binned by 'bin', taking the frame inputs and 'bin', that returns None when the
+# binned frame does not decide the evaluation, or None if the check has no preview
+CheckSpec = namedtuple('CheckSpec', ['function', 'batch', 'params', 'inputs', 'batch_inputs', 'pvs', 'preview'])
+CheckSpec.__new__.__defaults__ = (None, None, FRAME_INPUTS, BATCH_INPUTS, (), None)
+
+# maps the built-in check name to the module and attribute of its CheckSpec
+CHECKS = {
+          'intensity_rate': 'controller.monitoring.checks:intensity_rate_check',
+          'Npix_oversat_cnt_rate': 'controller.monitoring.checks:Npix_oversat_cnt_rate_check',
+          'Npix_undersat_cnt_rate': 'controller.monitoring.checks:Npix_undersat_cnt_rate_check',
+          'roi_intensity_rate': 'controller.monitoring.checks:roi_intensity_rate_check',
+         }
+
+# maps the built-in check name to the module and attribute of its adjuster function
+ADJUSTERS = {
+             'intensity_rate': 'controller.response.adjusters:intensity_rate_adj',
+             'Npix_oversat_cnt_rate': 'controller.response.adjusters:Npix_oversat_cnt_rate_adj',
+             'Npix_undersat_cnt_rate': 'controller.response.adjusters:Npix_undersat_cnt_rate_adj',
+             'roi_intensity_rate': 'controller.response.adjusters:roi_intensity_rate_adj',
+            }
+
+
+def group_entry_points(group):
+    if entry_points is None:
+        return []
+    eps = entry_points()
+    # the selection by group was added in Python 3.10, before it is a dictionary of groups
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=group))
+    return list(eps.get(group, []))
+
+
+def load(name, builtins, group):
+    if name in builtins:
+        module, attribute = builtins[name].split(':')
+        return getattr(importlib.import_module(module), attribute)
+    for ep in group_entry_points(group):
+        if ep.name == name:
+            return ep.load()
+    return None
+
+
+def get_check(name):
+    """
+    This function imports the check implementation for the check name.
+
+    Parameters
+    ----------
+    name : str
+        check name, as configured in checks.json
+
+    Returns
+    -------
+    spec : CheckSpec
+        the check implementation
+    """
+    spec = load(name, CHECKS, CHECKS_GROUP)
+    if spec is None:
+        raise ValueError('check ' + name + ' is not defined, available checks: ' + ', '.join(check_names()))
+    if not isinstance(spec, CheckSpec):
+        raise ValueError('check ' + name + ' does not refer to CheckSpec')
+    return spec
+
+
+def get_adjuster(name):
+    """
+    This function imports the adjuster function for the check name, or returns None if the check has no adjuster.
+    """
+    return load(name, ADJUSTERS, ADJUSTERS_GROUP)
+
+
+def check_names():
+    """
+    This function returns sorted names of the built-in and installed checks, without importing them.
+    """
+    return sorted(set(CHECKS) | set(ep.name for ep in group_entry_points(CHECKS_GROUP)))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module saves the controller state periodically, and restores it when the controller restarts.
+
+The state is the adjustment delays of the responder, and the check profile deciding the evaluation order. The delays
+are saved as wall clock expiry times, so after a restart the checks adjusted before the restart are not adjusted
+again until their delay expires, and the first frame is controlled with the learned check order.
+
+The snapshot is written into a temporary file that replaces the snapshot file, so a crash while writing leaves the
+previous snapshot. It is restored only when it was saved for the same detector and configuration; the configuration
+hash covers the content of the bounds, checks, and pvs files, so other entries, such as the metrics or recording
+settings, can change without losing the state.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+__author__ = "Barbara Frosik"
+__copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['Snapshot',
+           'config_hash']
+
+
+VERSION = 2
+
+# times a dict updated by other threads is copied before the snapshot is given up
+COPY_RETRIES = 10
+
+
+def config_hash(config):
+    """
+    This function returns hash of the content of the bounds, checks, and pvs files, the files deciding the checks and
+    the adjustments.
+    """
+    digest = hashlib.sha1()
+    for key in ('bounds', 'checks', 'pvs'):
+        digest.update(key.encode())
+        if key in config and os.path.isfile(config[key]):
+            with open(config[key], 'rb') as file:
+                digest.update(file.read())
+    return digest.hexdigest()
+
+
+def copy(mapping):
+    """
+    This function copies a dict that other threads update. A copy interrupted by an update raises RuntimeError, and
+    is repeated.
+    """
+    for i in range(COPY_RETRIES - 1):
+        try:
+            return dict(mapping)
+        except RuntimeError:
+            pass
+    return dict(mapping)
+
+
+class Snapshot(threading.Thread):
+    """
+    This class saves the state of monitor and responder into a file in an interval, and restores it.
+    """
+
+    def __init__(self, file, config, monitor, responder, interval=5.0):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        file : str
+            snapshot file name
+        config : dict
+            controller configuration, with 'detector'
+        monitor : Monitor
+            monitor holding the check profile
+        responder : Responder
+            responder holding the adjustment delays
+        interval : float
+            seconds between snapshots
+        """
+        threading.Thread.__init__(self, name='snapshot')
+        self.daemon = True
+        self.file = file
+        self.config = config
+        self.monitor = monitor
+        self.responder = responder
+        self.interval = interval
+        self.done = threading.Event()
+
+
+    def state(self):
+        profile = self.monitor.profile
+        return {'version': VERSION,
+                'detector': self.config['detector'],
+                'config_hash': config_hash(self.config),
+                'time': time.time(),
+                'adjusted': copy(self.responder.adjusted),
+                'profile': {'cost': copy(profile.cost), 'limit_rate': copy(profile.limit_rate),
+                            'event_rate': copy(profile.event_rate)}}
+
+
+    def save(self):
+        """
+        This function writes the state into temporary file, and replaces the snapshot file with it. A failure is
+        printed, the next snapshot is tried in the interval.
+        """
+        tmp = self.file + '.tmp'
+        try:
+            with open(tmp, 'w') as file:
+                json.dump(self.state(), file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp, self.file)
+        except Exception as e:
+            print ('snapshot not saved:', e)
+
+
+    def restore(self):
+        """
+        This function restores the state from the snapshot file, if the file was saved for the same detector and
+        configuration. The adjustment delays that expired are not restored.
+
+        Returns
+        -------
+        restored : bool
+            True if the state was restored
+        """
+        if not os.path.isfile(self.file):
+            return False
+        try:
+            with open(self.file) as file:
+                state = json.load(file)
+        except (OSError, ValueError) as e:
+            print ('snapshot', self.file, 'not restored:', e)
+            return False
+        if state.get('version') != VERSION or state.get('detector') != self.config['detector'] or \
+                state.get('config_hash') != config_hash(self.config):
+            print ('snapshot', self.file, 'not restored, it was saved for other detector or configuration')
+            return False
+        now = time.time()
+        self.responder.adjusted.update({check: expiry for check, expiry in state['adjusted'].items() if expiry > now})
+        profile = self.monitor.profile
+        profile.cost.update(state['profile']['cost'])
+        profile.limit_rate.update(state['profile']['limit_rate'])
+        profile.event_rate.update(state['profile'].get('event_rate', {}))
+        print ('snapshot saved %.1f s ago restored, delayed checks: %s' %
+               (now - state['time'], ', '.join(sorted(self.responder.adjusted)) or 'none'))
+        return True
+
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.save()
+
+
+    def stop(self):
+        """
+        This function stops the periodic snapshots and saves the final state.
+        """
+        self.done.set()
+        self.save()
@@ -1,5 +1,6 @@
 import threading
 from abc import ABCMeta, abstractmethod
+import numpy as np
 
 
 class Observable(object):
@@ -12,7 +13,7 @@ class Observable(object):
         self.observer = observer
 
     def notify(self, *args, **kwargs):
-        t = threading.Thread(target=self.observer.update, args=(args, kwargs))
+        t = threading.Thread(target=self.observer.update, args=(args, kwargs), name='notify')
         print('staring thread t ' + t.name)
         t.start()
 #        self.observer.update(args, kwargs)
@@ -28,18 +29,134 @@ class Observer(object):
 
 class Data(object):
     """
-    This class is a container of data.
+    This class is a container of frame data.
+
+    The slice is the 2D frame. The pvs is a dictionary of pv key and tuple of pv name and value read with the frame.
+    The acquire time value and pv name are kept in separate fields, as they are used by every check.
+    A Data instance taken from a FramePool must be released when processed, so the instance and its frame buffer
+    can be reused. A consumer that keeps the frame after processing retains the instance and releases it later.
+    A compressed frame is held as ChunkedFrame in chunked, it is decompressed when the slice is first read.
     """
-    def __init__(self, slice, kwargs):
-        self.slice = slice
-        for key in kwargs:
-            setattr(self, key, kwargs[key])
+    __slots__ = ('frame', 'chunked', 'counter', 'timestamp', 'acq_time', 'acq_time_pv', 'pvs', 'pool', 'refs')
+
+    def __init__(self, slice=None, pvs=None, counter=-1, timestamp=0.0, pool=None, chunked=None):
+        self.frame = slice
+        self.chunked = chunked
+        self.counter = counter
+        self.timestamp = timestamp
+        self.acq_time = None
+        self.acq_time_pv = None
+        self.pvs = {}
+        self.pool = pool
+        self.refs = 0
+        if pvs is not None:
+            self.set_pvs(pvs)
+
+
+    def set_pvs(self, pvs):
+        self.pvs = pvs
+        pair = pvs.get('acq_time')
+        if pair is not None:
+            self.acq_time_pv, self.acq_time = pair
+
+
+    @property
+    def slice(self):
+        if self.frame is None and self.chunked is not None:
+            self.frame = self.chunked.array()
+        return self.frame
+
+
+    @slice.setter
+    def slice(self, slice):
+        self.frame = slice
+
+
+    @property
+    def shape(self):
+        # the shape of compressed frame is known without decompressing it
+        return self.chunked.shape if self.frame is None and self.chunked is not None else self.frame.shape
+
+
+    def retain(self):
+        if self.pool is not None:
+            self.pool.retain(self)
+
+
+    def release(self):
+        if self.pool is not None:
+            self.pool.release(self)
+
+
+class FramePool(object):
+    """
+    This class holds preallocated Data instances with frame buffers of given shape and type.
+
+    The instances are reused when released by all holders, so the frame handling does not allocate memory in a
+    steady state. If all instances are in use, a new one is allocated outside of the pool.
+    """
+
+    def __init__(self, shape, dtype, size):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        shape : tuple
+            frame shape
+        dtype : numpy.dtype
+            frame data type
+        size : int
+            number of preallocated instances
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.Lock()
+        self.free = [Data(np.empty(self.shape, self.dtype), pool=self) for i in range(size)]
+        self.misses = 0
+
+
+    def acquire(self):
+        """
+        This function returns a free Data instance, retained once by the caller.
+        """
+        with self.lock:
+            if len(self.free) > 0:
+                data = self.free.pop()
+                data.refs = 1
+                return data
+            self.misses += 1
+        return Data(np.empty(self.shape, self.dtype))
+
+
+    def retain(self, data):
+        with self.lock:
+            data.refs += 1
+
+
+    def release(self, data):
+        with self.lock:
+            data.refs -= 1
+            if data.refs == 0:
+                self.free.append(data)
 
 
 class Event(object):
     """
-    This class is a container of event.
+    This class is a container of event, holding the check result passed to the adjuster.
+
+    The event arguments returned by a check other than the named ones are kept in extra dictionary, so a plugin check
+    can pass its own values to its adjuster. The counter is the counter of the frame that raised the event, it is set
+    by the check runner, so the pv writes of the adjuster can be related to the frame.
     """
-    def __init__(self, kwargs):
-        for key in kwargs:
-            setattr(self, key, kwargs[key])
+    __slots__ = ('result', 'points_over_threshold', 'roi', 'rois', 'acq_time', 'counter', 'extra')
+
+    def __init__(self, result=None, points_over_threshold=None, roi=None, rois=None, acq_time=None, **extra):
+        self.result = result
+        self.points_over_threshold = points_over_threshold
+        # index of the ROI that raised the event, and results of all ROIs
+        self.roi = roi
+        self.rois = rois
+        self.acq_time = acq_time
+        self.counter = -1
+        self.extra = extra
@@ -7,6 +7,7 @@ setup(
     description = 'Controller',
     packages = find_packages(),
     zip_safe = False,
+    entry_points = {'console_scripts': ['controller = controller.control:main']},
     url='http://dquality.readthedocs.org',
     download_url='https://github.com/advancedPhotonSource/controller.git',
     license='BSD-3',
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+import controller.monitoring.checks as checks
+import controller.response.adjusters as aj
+import controller.utilities.plan as pl
+import controller.utilities.utils as ut
+
+
+ACQ_TIME = 0.1
+PIX_BOUNDS = pl.compile_bounds({'target': 400000, 'low_limit': 5000, 'high_limit': 600000})
+
+
+@pytest.fixture
+def puts(monkeypatch):
+    puts = []
+    monkeypatch.setattr(aj, 'caput', lambda pvname, value, **kws: puts.append((pvname, value)))
+    return puts
+
+
+def limit_event(check, bounds, bright):
+    # a frame with the given number of pixels over all per pixel bounds, evaluated by the check
+    frame = np.zeros((64, 64), dtype=np.uint16)
+    frame.ravel()[:bright] = 62000
+    data = ut.Data(frame, {'acq_time': ('acq_time', ACQ_TIME)})
+    eval, res, args = check(data=data, bounds=bounds, pix_bounds=PIX_BOUNDS, mask=None, stats=None)
+    assert eval in (checks.E_LOW_LM, checks.E_HIGH_LM)
+    return ut.Event(**args)
+
+
+def test_undersat_count_zero(puts):
+    bounds = pl.compile_bounds({'low_threshold': 10, 'low_limit': 10, 'target': 10})
+    event = limit_event(checks.Npix_undersat_cnt_rate, bounds, 0)
+    put = aj.Npix_undersat_cnt_rate_adj(event=event, bounds=bounds)
+    assert put == ('acq_time', ACQ_TIME * aj.MAX_STEP)
+    assert puts == [put]
+
+
+def test_undersat_count_at_target(puts):
+    bounds = pl.compile_bounds({'low_limit': 30, 'target': 20})
+    event = limit_event(checks.Npix_undersat_cnt_rate, bounds, 20)
+    assert aj.Npix_undersat_cnt_rate_adj(event=event, bounds=bounds) is None
+    assert puts == []
+
+
+def test_oversat_count_zero(puts):
+    bounds = pl.compile_bounds({'low_limit': 5, 'target': 10})
+    event = limit_event(checks.Npix_oversat_cnt_rate, bounds, 0)
+    assert aj.Npix_oversat_cnt_rate_adj(event=event, bounds=bounds) is None
+    assert puts == []
+
+
+def test_oversat_count_at_target(puts):
+    bounds = pl.compile_bounds({'high_limit': 5, 'target': 20})
+    event = limit_event(checks.Npix_oversat_cnt_rate, bounds, 20)
+    assert aj.Npix_oversat_cnt_rate_adj(event=event, bounds=bounds) is None
+    assert puts == []
+
+
+@pytest.mark.parametrize('bright', (11, 21, 40, 4000))
+def test_oversat_step_limited(puts, bright):
+    bounds = pl.compile_bounds({'high_limit': 10, 'target': 10})
+    event = limit_event(checks.Npix_oversat_cnt_rate, bounds, bright)
+    put = aj.Npix_oversat_cnt_rate_adj(event=event, bounds=bounds)
+    assert ACQ_TIME / aj.MAX_STEP <= put[1] <= ACQ_TIME * aj.MAX_STEP
@@ -0,0 +1,16 @@
+import os
+import pytest
+
+pytest.importorskip('configobj')
+
+import controller.simulation.benchmark as bm
+
+
+def test_converges_with_sim_bounds(monkeypatch):
+    # the configuration names files relative to the repository
+    monkeypatch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    results = bm.benchmark('config/sim/cntl_conf', no_frames=400, timeout=60, frame_period=0.02, seed=0)
+    assert results['converged']
+    assert results['frames_to_convergence'] < results['frames_processed']
+    # the spot saturates and the intensity rate reaches the target within the thresholds
+    assert 5.0 < results['final_acq_time'] < 10.0
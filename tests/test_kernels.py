@@ -0,0 +1,137 @@
+import threading
+import numpy as np
+import pytest
+
+import controller.monitoring.kernels as kn
+
+
+DTYPES = ('uint8', 'uint16', 'uint32', 'int32')
+
+
+def frames(dtype, shape=(64, 96), seed=0):
+    rng = np.random.default_rng(seed)
+    high = min(np.iinfo(dtype).max, 100000)
+    return rng.integers(0, high, shape).astype(dtype)
+
+
+def edge_thresholds(frame, acq_time):
+    # rates of pixels, so the comparison at equal rate is covered, and the thresholds no pixel or every pixel is over
+    rates = np.unique(frame / acq_time)
+    return np.sort(np.array([-1.0, 0.0, rates[0], rates[len(rates) // 2], rates[-1],
+                             np.nextafter(rates[-1], -np.inf), 1.0e300, np.inf]))
+
+
+@pytest.fixture
+def loaded():
+    pytest.importorskip('numba')
+    assert kn.load()
+
+
+@pytest.mark.usefixtures('loaded')
+@pytest.mark.parametrize('dtype', DTYPES)
+@pytest.mark.parametrize('masked', (False, True))
+def test_frame_reductions_match_numpy(dtype, masked):
+    frame = frames(dtype)
+    acq_time = 0.37
+    thresholds = edge_thresholds(frame, acq_time)
+    index = np.sort(np.random.default_rng(1).choice(frame.size, frame.size // 10, replace=False)) if masked else None
+    assert kn.compiled(frame)
+    expected = kn.frame_reductions_numpy(frame, acq_time, thresholds, index)
+    computed = kn.frame_reductions(frame, acq_time, thresholds, index)
+    assert expected[0] == computed[0]
+    assert np.array_equal(expected[1], computed[1])
+
+
+@pytest.mark.usefixtures('loaded')
+@pytest.mark.parametrize('parallel', (True, False))
+def test_serial_and_parallel_loops_match(parallel):
+    frame = frames('uint16')
+    thresholds = edge_thresholds(frame, 0.1)
+    expected = kn.frame_reductions_numpy(frame, 0.1, thresholds, None)
+    computed = kn.frame_reductions(frame, 0.1, thresholds, None, parallel=parallel)
+    assert expected[0] == computed[0]
+    assert np.array_equal(expected[1], computed[1])
+
+
+@pytest.mark.usefixtures('loaded')
+def test_batch_reductions_match_numpy():
+    data = np.stack([frames('uint16', seed=seed) for seed in range(4)])
+    acq_times = np.array([0.01, 0.1, 0.5, 1.0])
+    thresholds = edge_thresholds(data[0], 0.1)
+    index = np.arange(0, data[0].size, 7)
+    expected = kn.batch_reductions_numpy(data, acq_times, thresholds, index)
+    computed = kn.batch_reductions(data, acq_times, thresholds, index)
+    assert np.array_equal(expected[0], computed[0])
+    assert np.array_equal(expected[1], computed[1])
+
+
+def test_integer_cuts_agree_with_rates():
+    values = np.arange(0, 5000)
+    for acq_time in (0.001, 0.1, 0.3, 1.7):
+        for threshold in (0.0, 1.0, 333.3, 1000.0, 4999 / acq_time):
+            cut = kn.integer_cuts([threshold], acq_time)[0]
+            assert np.array_equal(values >= cut, values / acq_time > threshold)
+
+
+@pytest.mark.usefixtures('loaded')
+def test_verify_finds_no_mismatch():
+    assert kn.verify(shape=(32, 48), frames=2) == []
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+@pytest.mark.parametrize('masked', (False, True))
+def test_integer_counts_match_rates(dtype, masked):
+    frame = frames(dtype)
+    acq_time = 0.37
+    thresholds = edge_thresholds(frame, acq_time)
+    index = np.sort(np.random.default_rng(1).choice(frame.size, frame.size // 10, replace=False)) if masked else None
+    expected = kn.frame_reductions_numpy(frame, acq_time, thresholds, index)[1]
+    assert np.array_equal(expected, kn.counts_numpy(frame, acq_time, thresholds, index))
+
+
+def test_integer_batch_counts_match_rates():
+    data = np.stack([frames('uint16', seed=seed) for seed in range(4)])
+    acq_times = np.array([0.01, 0.1, 0.5, 1.0])
+    thresholds = edge_thresholds(data[0], 0.1)
+    index = np.arange(0, data[0].size, 7)
+    expected = kn.batch_reductions_numpy(data, acq_times, thresholds, index)[1]
+    assert np.array_equal(expected, kn.batch_counts_numpy(data, acq_times, thresholds, index))
+
+
+@pytest.mark.usefixtures('loaded')
+def test_parallel_loop_runs_in_check_thread(monkeypatch):
+    frame = frames('uint16')
+    thresholds = edge_thresholds(frame, 0.1)
+    expected = kn.frame_reductions_numpy(frame, 0.1, thresholds, None)
+    computed = []
+
+    def fail(*args):
+        raise AssertionError('serial loop used')
+
+    monkeypatch.setattr(kn, 'reduce_rows_serial', fail)
+    thread = threading.Thread(target=lambda: computed.append(kn.frame_reductions(frame, 0.1, thresholds, None)))
+    thread.start()
+    thread.join()
+    assert len(computed) == 1
+    assert np.array_equal(expected[1], computed[0][1])
+
+
+@pytest.mark.usefixtures('loaded')
+def test_serial_loop_while_parallel_loop_runs(monkeypatch):
+    frame = frames('uint16')
+    thresholds = edge_thresholds(frame, 0.1)
+    expected = kn.frame_reductions_numpy(frame, 0.1, thresholds, None)
+
+    def fail(*args):
+        raise AssertionError('parallel loop used')
+
+    monkeypatch.setattr(kn, 'reduce_rows_parallel', fail)
+    with kn.parallel_lock:
+        computed = kn.frame_reductions(frame, 0.1, thresholds, None)
+    assert np.array_equal(expected[1], computed[1])
+
+
+@pytest.mark.usefixtures('loaded')
+def test_warm_compiles_integer_frames():
+    assert kn.warm('uint16', masked=True)
+    assert not kn.warm('float32')
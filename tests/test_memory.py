@@ -0,0 +1,110 @@
+import json
+import numpy as np
+import pytest
+
+import controller.monitoring.checks as checks
+import controller.utilities.memory as mem
+import controller.utilities.metrics as mt
+import controller.utilities.plan as pl
+import controller.utilities.utils as ut
+
+
+SHAPE = (256, 256)
+PIXELS = SHAPE[0] * SHAPE[1]
+ACQ_TIME = 0.1
+BATCH = 4
+
+BOUNDS = {'Npix_oversat_cnt_rate': {'high_threshold': 30, 'high_limit': 50, 'target': 10},
+          'Npix_undersat_cnt_rate': {'low_threshold': 10, 'low_limit': 10, 'target': 10},
+          'pix_sat_cnt_rate': {'target': 400000, 'low_threshold': 10000, 'low_limit': 5000,
+                               'high_threshold': 500000, 'high_limit': 600000},
+          'intensity_rate': {'target': 100000, 'low_threshold': 50000, 'low_limit': 30000,
+                             'high_threshold': 150000, 'high_limit': 200000}}
+CHECKS = ['Npix_oversat_cnt_rate', 'Npix_undersat_cnt_rate', 'intensity_rate']
+
+# the batch stacks a uint16 copy of each frame, the NumPy counts allocate a boolean frame; a float64 temporary of
+# the frame, 8 bytes per pixel, is over the budget
+BUDGET = 2 * PIXELS + 16 * 1024
+
+
+@pytest.fixture
+def plan(tmp_path):
+    (tmp_path / 'bounds.json').write_text(json.dumps(BOUNDS))
+    (tmp_path / 'checks.json').write_text(json.dumps(CHECKS))
+    plan = pl.compile_plan({'bounds': str(tmp_path / 'bounds.json'), 'checks': str(tmp_path / 'checks.json')})
+    pl.prepare_plan(plan, SHAPE)
+    # the first frames allocate the caches, they are not measured
+    data = [ut.Data(frame, {'acq_time': ('acq_time', ACQ_TIME)}) for frame in frames(BATCH)]
+    checks.run_quality_checks(data[0], plan)
+    checks.run_quality_checks_batch(data, plan)
+    return plan
+
+
+@pytest.fixture(autouse=True)
+def disabled():
+    yield
+    mem.disable()
+
+
+def frames(count):
+    """
+    Background frames with bright pixels. The pixel rates span all per pixel bounds, so the counts are not decided
+    by the frame maximum and minimum, and the frames alternate the Npix over saturation count within limits, where
+    the target count is evaluated too, and over the limit.
+    """
+    rng = np.random.default_rng(0)
+    result = []
+    for i in range(count):
+        frame = rng.integers(0, 1000, SHAPE).astype(np.uint16)
+        bright = rng.choice(PIXELS, 40 if i % 2 == 0 else 80, replace=False)
+        frame.ravel()[bright] = 62000
+        result.append(frame)
+    return result
+
+
+def run(plan, frames):
+    for i, frame in enumerate(frames):
+        with mem.stage('frame data'):
+            data = ut.Data(frame, {'acq_time': ('acq_time', ACQ_TIME)}, i)
+        checks.run_quality_checks(data, plan)
+    batch = [ut.Data(frame, {'acq_time': ('acq_time', ACQ_TIME)}, i) for i, frame in enumerate(frames)]
+    return checks.run_quality_checks_batch(batch, plan)
+
+
+def test_frames_reach_count_paths(plan):
+    results = [{} for i in range(BATCH)]
+    for frame, res in zip(frames(BATCH), results):
+        checks.run_quality_checks(ut.Data(frame, {'acq_time': ('acq_time', ACQ_TIME)}), plan, res)
+    evals = [res['Npix_oversat_cnt_rate'][0] for res in results]
+    assert evals == [checks.E_HIGH_TH, checks.E_HIGH_LM] * (BATCH // 2)
+
+
+def test_stages_under_budget(plan):
+    tracker = mem.enable(BUDGET)
+    run(plan, frames(BATCH))
+    stages = ['check ' + name for name in CHECKS] + ['batch check ' + name for name in CHECKS] + \
+             ['batch frames', 'frame data']
+    assert sorted(tracker.stats) == sorted(stages)
+    for name, (count, runs, peak, max_peak, retained) in tracker.stats.items():
+        assert count == BATCH
+        assert max_peak <= BUDGET, name
+    assert tracker.over_budget() == []
+
+
+def test_float_temporary_over_budget(plan):
+    frame = frames(1)[0]
+    tracker = mem.enable(BUDGET)
+    with mem.stage('rate'):
+        rate = frame / ACQ_TIME
+    assert tracker.over_budget() == ['rate']
+
+
+def test_over_budget_counted(plan):
+    tracker = mem.enable(1)
+    run(plan, frames(BATCH))
+    before = {name: mt.MEMORY_OVER_BUDGET.labels(name).value() for name in tracker.stats}
+    run(plan, frames(BATCH))
+    over = tracker.over_budget()
+    assert len(over) > 0
+    for name in over:
+        assert mt.MEMORY_OVER_BUDGET.labels(name).value() >= before[name] + 1
@@ -0,0 +1,62 @@
+import json
+import numpy as np
+import pytest
+
+import controller.simulation.detector as sd
+
+DETECTOR = 'SIM'
+
+
+class App(object):
+    def __init__(self):
+        self.events = []
+
+    def feed_event(self, event_str, stats):
+        self.events.append(event_str)
+
+
+@pytest.fixture
+def ca():
+    ca = sd.SimChannelAccess()
+    sd.install(ca)
+    return ca
+
+
+@pytest.fixture
+def feed(ca, tmp_path):
+    import controller.feeds.pv_feed as pf
+    (tmp_path / 'pvs.json').write_text(json.dumps({'acq_time': DETECTOR + ':cam1:AcquireTime'}))
+    ca.set(DETECTOR + ':cam1:AcquireTime', 0.1)
+    return pf.Feed({'detector': DETECTOR, 'pvs': str(tmp_path / 'pvs.json')}, App())
+
+
+def post_frame(ca, shape):
+    ca.set(DETECTOR + ':image1:ArraySize0_RBV', shape[1])
+    ca.set(DETECTOR + ':image1:ArraySize1_RBV', shape[0])
+    ca.set(DETECTOR + ':image1:ArrayData', np.arange(shape[0] * shape[1], dtype=np.uint16))
+
+
+def test_frame_dropped_on_mixed_shape(ca, feed):
+    post_frame(ca, (4, 6))
+    feed.shape = (4, 6)
+    assert feed.fetch(1).slice.shape == (4, 6)
+    # the feed saw the new number of rows, the columns monitor is not posted yet; the IOC returns as many pixels as
+    # requested, as the image PV is larger than the frame, so the image size does not reveal the wrong shape
+    post_frame(ca, (6, 4))
+    feed.shape = (6, 6)
+    assert feed.fetch(2) is None
+    assert feed.stats.shape_drops == 1
+    # the next frame is read with the shape read from both size PVs
+    data = feed.fetch(3)
+    assert data.slice.shape == (6, 4)
+    assert data.acq_time == 0.1
+    assert feed.stats.shape_drops == 1
+    assert feed.stats.shape == (6, 4)
+
+
+def test_frame_dropped_on_size_mismatch(ca, feed):
+    post_frame(ca, (4, 6))
+    ca.set(DETECTOR + ':image1:ArrayData', np.arange(20, dtype=np.uint16))
+    feed.shape = (4, 6)
+    assert feed.fetch(1) is None
+    assert feed.stats.failed == 1
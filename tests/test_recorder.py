@@ -0,0 +1,59 @@
+import glob
+import json
+import numpy as np
+import pytest
+
+import controller.monitoring.checks as checks
+import controller.recording.recorder as rc
+import controller.response.adjusters as aj
+import controller.response.responder as rs
+import controller.utilities.plan as pl
+import controller.utilities.utils as ut
+
+
+SHAPE = (32, 32)
+BOUNDS = {'intensity_rate': {'target': 100000, 'low_threshold': 50000, 'low_limit': 30000,
+                             'high_threshold': 150000, 'high_limit': 200000}}
+
+
+@pytest.fixture
+def plan(tmp_path):
+    (tmp_path / 'bounds.json').write_text(json.dumps(BOUNDS))
+    (tmp_path / 'checks.json').write_text(json.dumps(['intensity_rate']))
+    plan = pl.compile_plan({'bounds': str(tmp_path / 'bounds.json'), 'checks': str(tmp_path / 'checks.json')})
+    pl.prepare_plan(plan, SHAPE)
+    return plan
+
+
+@pytest.fixture(autouse=True)
+def puts(monkeypatch):
+    monkeypatch.setattr(aj, 'caput', lambda pvname, value, **kws: None)
+
+
+def frame_data(counter, acq_time, value):
+    frame = np.full(SHAPE, value, dtype=np.uint16)
+    return ut.Data(frame, {'acq_time': ('acq_time', acq_time)}, counter)
+
+
+def test_put_recorded_with_event_frame(plan, tmp_path):
+    recorder = rc.Recorder(str(tmp_path / 'rec'), policy=rc.POLICY_ALL)
+    recorder.start()
+    responder = rs.Responder({'adjust_time': 0}, plan)
+    responder.recorder = recorder
+    # the frame with counter 7 is over the high limit, the frames recorded after it are within thresholds
+    for counter, acq_time, value in [(5, 0.1, 10), (7, 0.2, 100), (8, 0.1, 10), (9, 0.1, 10)]:
+        data = frame_data(counter, acq_time, value)
+        results = {}
+        events = checks.run_quality_checks(data, plan, results)
+        recorder.record_frame(data, results, events)
+        if counter == 7:
+            eventful = events
+    responder.update((eventful,), {})
+    recorder.stop()
+
+    shards = [rc.load_shard(name) for name in sorted(glob.glob(str(tmp_path / 'rec' / 'shard_*.npz')))]
+    assert list(np.concatenate([shard['put_counter'] for shard in shards])) == [7]
+    assert list(shards[0]['result_counter']) == [5, 7, 8, 9]
+    assert list(shards[0]['result_acq_time']) == [0.1, 0.2, 0.1, 0.1]
+    assert list(shards[0]['frame_counter']) == [5, 7, 8, 9]
+    assert list(shards[0]['frame_acq_time']) == [0.1, 0.2, 0.1, 0.1]
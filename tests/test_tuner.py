@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+import controller.recording.recorder as rc
+import controller.recording.tuner as tn
+import controller.utilities.utils as ut
+
+
+SHAPE = (16, 16)
+BOUNDS = {'intensity_rate': {'target': 100000, 'low_threshold': 50000, 'low_limit': 30000,
+                             'high_threshold': 150000, 'high_limit': 200000}}
+
+
+@pytest.fixture(params=['npz', 'hdf5'])
+def recording(request, tmp_path):
+    """
+    Frames recorded in shards of four frames, in both shard formats, with acquire time alternating 0.1 and 0.2 s, and a frame of other
+    shape at the end. Every third frame is over the intensity rate high threshold.
+    """
+    if request.param == 'hdf5' and rc.h5py is None:
+        pytest.skip('h5py is not installed')
+    recorder = rc.Recorder(str(tmp_path / 'rec'), policy=rc.POLICY_ALL, shard_frames=4, format=request.param)
+    recorder.start()
+    frames = []
+    for counter in range(10):
+        acq_time = 0.1 if counter % 2 == 0 else 0.2
+        # pixel rate 400 gives intensity rate 102400, and 800 gives 204800
+        rate = 800 if counter % 3 == 0 else 400
+        frame = np.full(SHAPE, round(rate * acq_time), dtype=np.uint16)
+        frames.append((frame, acq_time))
+        recorder.record_frame(ut.Data(frame, {'acq_time': ('acq_time', acq_time)}, counter), {}, None)
+    recorder.record_frame(ut.Data(np.zeros((8, 8), dtype=np.uint16), {'acq_time': ('acq_time', 0.1)}, 10), {}, None)
+    recorder.stop()
+    return str(tmp_path / 'rec'), frames
+
+
+def test_load_recording(recording, tmp_path):
+    dir, frames = recording
+    acq_times, times = tn.load_recording(dir, str(tmp_path / 'frames.npy'))
+    stack = np.load(str(tmp_path / 'frames.npy'), mmap_mode='r')
+    assert stack.shape == (10,) + SHAPE
+    assert np.array_equal(stack, np.stack([frame for frame, acq_time in frames]))
+    assert list(acq_times) == [acq_time for frame, acq_time in frames]
+    assert np.all(np.diff(times) >= 0)
+
+
+def test_tune_recording(recording, tmp_path):
+    dir, frames = recording
+    acq_times, times = tn.load_recording(dir, str(tmp_path / 'frames.npy'))
+    reports = tn.tune(str(tmp_path / 'frames.npy'), BOUNDS, acq_times, 0.1, adjust_time=0.0, processes=1,
+                      times=times - times[0])
+    report = reports[0]
+    assert report['check'] == 'intensity_rate'
+    rates = [frame.sum() / acq_time for frame, acq_time in frames]
+    assert report['current_events'] == sum(rate > 150000 or rate < 50000 for rate in rates)
+    assert report['current_events'] == 4